@@ -0,0 +1,52 @@
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+
+
+class IdTokenCache:
+    # Remembers the decoded claims of ID tokens that already passed
+    # verification, until the token's own exp claim. Players send the same
+    # token with every poll and trade, so only the first request per token
+    # pays for the signature check. Keys are hashes so raw tokens aren't
+    # held in memory.
+
+    def __init__(self, verify, max_entries=10000, expiry_margin=30):
+        self._verify = verify
+        self.max_entries = max_entries
+        self.expiry_margin = expiry_margin
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def verify(self, id_token):
+        if not id_token or not isinstance(id_token, str):
+            raise ValueError('ID token must be a non-empty string')
+        key = hashlib.sha256(id_token.encode('utf-8')).hexdigest()
+        now = time.time()
+        with self._lock:
+            claims = self._entries.get(key)
+            if claims is not None and claims['exp'] - self.expiry_margin > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return dict(claims)
+            self._entries.pop(key, None)
+            self.misses += 1
+
+        claims = self._verify(id_token)
+        with self._lock:
+            self._entries[key] = dict(claims)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return claims
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,79 @@
+import os
+import threading
+import time
+
+import metrics
+
+# Firestore, Firebase Auth and OpenAI clients are created the first time
+# they're used rather than when the app is imported, together with the
+# import of their libraries. Importing the app needs no credentials, cold
+# starts don't pay for clients a request never touches, and each client can
+# be overridden, e.g. with local fakes.
+
+CREDENTIALS_PATH = os.getenv('CREDENTIALS_PATH', 'creds.json')
+
+
+class LazyClient:
+    # Stands in for the client factory() returns, creating it on first
+    # attribute access; override() replaces it outright.
+
+    def __init__(self, name, factory):
+        self._name = name
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
+        self.created_in = None
+
+    def get(self):
+        client = self._client
+        if client is None:
+            with self._lock:
+                if self._client is None:
+                    started = time.perf_counter()
+                    self._client = self._factory()
+                    self.created_in = time.perf_counter() - started
+                    print('Created %s client in %.2fs' % (self._name, self.created_in))
+                client = self._client
+        return client
+
+    def override(self, client):
+        with self._lock:
+            self._client = client
+            self.created_in = None
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self.get(), name)
+
+
+def firestore_client():
+    from google.cloud import firestore
+    from google.oauth2 import service_account
+    client = firestore.Client(credentials=service_account.Credentials.from_service_account_file(CREDENTIALS_PATH))
+    return metrics.instrument_firestore(client)
+
+
+def firebase_auth():
+    # The firebase_admin auth module, with the default app initialized
+    import firebase_admin
+    from firebase_admin import auth, credentials
+    try:
+        firebase_admin.get_app()
+    except ValueError:
+        firebase_admin.initialize_app(credentials.Certificate(CREDENTIALS_PATH))
+    return auth
+
+
+def openai_client(max_connections=20, timeout=60):
+    # One keep-alive connection pool shared by every LLM call in the
+    # process. Retries are left to the LLM gateway, which knows about the
+    # rate limits.
+    import httpx
+    from openai import OpenAI
+    http_client = httpx.Client(
+        limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections,
+                            keepalive_expiry=60),
+        timeout=httpx.Timeout(timeout, connect=10)
+    )
+    return OpenAI(api_key=os.getenv('OPEN_AI_API_KEY'), http_client=http_client, max_retries=0)
@@ -0,0 +1,27 @@
+import os
+
+import metrics
+
+# Several worker processes, each serving requests on a pool of threads. A
+# request waiting on OpenAI or Firestore only holds its own thread, and
+# open /room_events streams each hold one too, so threads are sized for
+# those rather than for CPU. Everything shared between requests lives in
+# Firestore or in per-instance files (scenario pool, quote snapshot and the
+# LLM cache with LLM_CACHE_BACKEND=sqlite) that are safe to use from several
+# processes; what's left in memory is only ever a cache.
+#
+# Not preloaded: the Firestore/gRPC clients and the background threads
+# (scenario pool, quote refresh, LLM pool) have to be created in each
+# worker after the fork.
+bind = ':%s' % os.getenv('PORT', '8080')
+worker_class = 'gthread'
+workers = int(os.getenv('GUNICORN_WORKERS', '2'))
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+timeout = int(os.getenv('GUNICORN_TIMEOUT', '300'))
+graceful_timeout = 30
+keepalive = 5
+
+
+def on_starting(server):
+    # Workers add up each other's metrics files; start from none
+    metrics.clear(os.getenv('METRICS_DIR', metrics.DEFAULT_DIR))
@@ -0,0 +1,111 @@
+# Netted positions for a portfolio: one entry per ticker with a long leg and
+# a short leg, each holding its share count and total cost. Trades on the
+# same side add to the leg, so a portfolio's size and valuation cost grow
+# with the tickers held rather than the number of trades made.
+#
+# Economics are the same as the per-trade holdings they replace: a short
+# pays its entry cost up front like a buy, and is worth
+# (entry - price) * shares + entry * shares, i.e. 2 * cost - price * shares.
+# Since that's linear in shares, netting lots together doesn't change any
+# portfolio's value.
+
+LONG = 'long'
+SHORT = 'short'
+
+
+def empty_position():
+    return {'long_shares': 0, 'long_cost': 0.0, 'short_shares': 0, 'short_cost': 0.0}
+
+
+def position_id(ticker, side):
+    return '%s:%s' % (ticker, side)
+
+
+def parse_position_id(position_id):
+    ticker, _, side = position_id.rpartition(':')
+    if not ticker or side not in (LONG, SHORT):
+        return None, None
+    return ticker, side
+
+
+def positions_from_holdings(holdings):
+    # Portfolios written before the ledger kept one holding per trade
+    positions = {}
+    for holding in holdings:
+        apply_trade(positions, holding['ticker'], holding['shares'], holding['price'])
+    return positions
+
+
+def get_positions(portfolio):
+    if 'positions' in portfolio:
+        return portfolio['positions']
+    return positions_from_holdings(portfolio.get('holdings', []))
+
+
+def apply_trade(positions, ticker, shares, price):
+    # Positive shares open or add to the long leg, negative to the short leg
+    position = positions.setdefault(ticker, empty_position())
+    if shares > 0:
+        position['long_shares'] += shares
+        position['long_cost'] += price * shares
+    else:
+        position['short_shares'] += -shares
+        position['short_cost'] += price * -shares
+
+
+def long_value(position, price):
+    return price * position['long_shares']
+
+
+def short_value(position, price):
+    return 2 * position['short_cost'] - price * position['short_shares']
+
+
+def position_value(position, price):
+    return long_value(position, price) + short_value(position, price)
+
+
+def close_leg(positions, ticker, side, price):
+    # Removes one leg and returns what it was worth at price, or None if
+    # there's no such open leg
+    position = positions.get(ticker)
+    if position is None or not position['%s_shares' % side]:
+        return None
+    if side == LONG:
+        value = long_value(position, price)
+        position['long_shares'], position['long_cost'] = 0, 0.0
+    else:
+        value = short_value(position, price)
+        position['short_shares'], position['short_cost'] = 0, 0.0
+    if not position['long_shares'] and not position['short_shares']:
+        del positions[ticker]
+    return value
+
+
+def holdings_view(positions):
+    # The per-position list clients display: one entry per open leg with its
+    # average entry price, short legs as negative shares
+    holdings = []
+    for ticker, position in positions.items():
+        if position['long_shares']:
+            holdings.append({
+                'id': position_id(ticker, LONG),
+                'ticker': ticker,
+                'price': position['long_cost'] / position['long_shares'],
+                'shares': position['long_shares']
+            })
+        if position['short_shares']:
+            holdings.append({
+                'id': position_id(ticker, SHORT),
+                'ticker': ticker,
+                'price': position['short_cost'] / position['short_shares'],
+                'shares': -position['short_shares']
+            })
+    return holdings
+
+
+def portfolio_view(portfolio):
+    # Portfolio as returned to clients, with holdings derived from positions
+    view = {key: value for key, value in portfolio.items() if key != 'positions'}
+    view['holdings'] = holdings_view(get_positions(portfolio))
+    return view
@@ -0,0 +1,152 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheMiss(LookupError):
+    pass
+
+
+class MemoryCache:
+    # In-process LRU with a TTL
+
+    def __init__(self, max_entries=5000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            value, created_at = entry
+            if self.ttl and time.time() - created_at > self.ttl:
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.time())
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class SQLiteCache:
+    # On-disk cache shared by every worker process on the instance.
+    # Expired rows are dropped on read, and the least recently used rows
+    # once the table grows past max_entries.
+
+    def __init__(self, path, max_entries=50000, ttl=3600):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute(
+                'CREATE TABLE IF NOT EXISTS llm_cache ('
+                'key TEXT PRIMARY KEY, value TEXT NOT NULL, created_at REAL NOT NULL, last_used REAL NOT NULL)'
+            )
+
+    def get(self, key):
+        now = time.time()
+        with self._lock, self._conn:
+            row = self._conn.execute('SELECT value, created_at FROM llm_cache WHERE key = ?', (key,)).fetchone()
+            if row is None:
+                return None
+            value, created_at = row
+            if self.ttl and now - created_at > self.ttl:
+                self._conn.execute('DELETE FROM llm_cache WHERE key = ?', (key,))
+                return None
+            self._conn.execute('UPDATE llm_cache SET last_used = ? WHERE key = ?', (now, key))
+            return value
+
+    def set(self, key, value):
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                'INSERT OR REPLACE INTO llm_cache (key, value, created_at, last_used) VALUES (?, ?, ?, ?)',
+                (key, value, now, now)
+            )
+            if self.ttl:
+                self._conn.execute('DELETE FROM llm_cache WHERE created_at < ?', (now - self.ttl,))
+            self._conn.execute(
+                'DELETE FROM llm_cache WHERE key IN ('
+                'SELECT key FROM llm_cache ORDER BY last_used DESC LIMIT -1 OFFSET ?)',
+                (self.max_entries,)
+            )
+
+    def __len__(self):
+        with self._lock:
+            return self._conn.execute('SELECT COUNT(*) FROM llm_cache').fetchone()[0]
+
+
+class LLMCache:
+    # Caches raw completion text keyed by a hash of the prompt type and the
+    # full request (model, messages and sampling parameters).
+    #
+    # mode 'off' never caches, 'readwrite' caches the prompt types listed in
+    # prompt_types (all of them when None) and 'replay' serves every prompt
+    # type from the cache only, raising CacheMiss instead of calling the API.
+
+    def __init__(self, backend, mode='readwrite', prompt_types=None):
+        self.backend = backend
+        self.mode = mode
+        self.prompt_types = prompt_types
+        self.hits = {}
+        self.misses = {}
+        self._lock = threading.Lock()
+
+    def enabled_for(self, prompt_type):
+        if self.mode == 'replay':
+            return True
+        return self.mode == 'readwrite' and (self.prompt_types is None or prompt_type in self.prompt_types)
+
+    @staticmethod
+    def key(prompt_type, request, variant=0):
+        payload = json.dumps({'prompt_type': prompt_type, 'variant': variant, 'request': request}, sort_keys=True)
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+
+    def _count(self, counter, prompt_type):
+        with self._lock:
+            counter[prompt_type] = counter.get(prompt_type, 0) + 1
+
+    def get(self, prompt_type, key):
+        if not self.enabled_for(prompt_type):
+            return None
+        value = self.backend.get(key)
+        if value is None:
+            self._count(self.misses, prompt_type)
+            if self.mode == 'replay':
+                raise CacheMiss('No recorded %s response for key %s' % (prompt_type, key))
+            return None
+        self._count(self.hits, prompt_type)
+        return value
+
+    def set(self, prompt_type, key, value):
+        if self.enabled_for(prompt_type) and self.mode != 'replay':
+            self.backend.set(key, value)
+
+    def stats(self):
+        with self._lock:
+            prompt_types = sorted(set(self.hits) | set(self.misses))
+            return {
+                'mode': self.mode,
+                'entries': len(self.backend),
+                'prompts': {
+                    prompt_type: {
+                        'hits': self.hits.get(prompt_type, 0),
+                        'misses': self.misses.get(prompt_type, 0),
+                    } for prompt_type in prompt_types
+                },
+            }
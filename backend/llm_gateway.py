@@ -0,0 +1,379 @@
+import contextlib
+import contextvars
+import json
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import metrics
+
+# Every OpenAI call in the process goes through one LLMGateway. It holds the
+# pooled client, paces requests to the account's requests-per-minute and
+# tokens-per-minute limits, and retries rate limits, timeouts, server
+# errors and responses that aren't valid JSON with jittered exponential
+# backoff. Many rooms generating at once then queue in the gateway instead
+# of all hitting 429s and retrying into each other.
+#
+# Tail latency is bounded three ways: a call that runs past a percentile of
+# its prompt's recent latencies gets a duplicate (hedge) request and the
+# first answer wins; when a model keeps failing the request moves down a
+# chain of fallback models; and everything gives up at the deadline set by
+# deadline_after, leaving callers to fill in locally.
+
+RETRYABLE_STATUS = (408, 409, 429)
+
+# Monotonic time by which LLM calls in this context have to be done
+current_deadline = contextvars.ContextVar('llm_deadline', default=None)
+
+
+class DeadlineExceeded(TimeoutError):
+    pass
+
+
+@contextlib.contextmanager
+def deadline_after(seconds):
+    # LLM calls made inside the block, or in work submitted from it with
+    # contextvars.copy_context, give up after seconds (0 for no deadline).
+    # An enclosing deadline that's sooner still applies.
+    if not seconds:
+        yield
+        return
+    deadline = time.monotonic() + seconds
+    outer = current_deadline.get()
+    token = current_deadline.set(deadline if outer is None else min(outer, deadline))
+    try:
+        yield
+    finally:
+        current_deadline.reset(token)
+
+
+def remaining(deadline):
+    if deadline is None:
+        return None
+    left = deadline - time.monotonic()
+    if left <= 0:
+        raise DeadlineExceeded('LLM deadline passed')
+    return left
+
+
+class TokenBucket:
+    # rate_per_minute units refilling continuously, up to a minute's worth.
+    # reserve() always takes the units, letting the level go negative, and
+    # returns how long the caller has to wait for them, so callers are
+    # served in the order they asked without polling.
+
+    def __init__(self, rate_per_minute, clock=time.monotonic):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = float(rate_per_minute)
+        self.clock = clock
+        self.level = self.capacity
+        self.updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = self.clock()
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        with self._lock:
+            self._refill()
+            self.level -= min(amount, self.capacity)
+            return max(0.0, -self.level / self.rate)
+
+    def try_reserve(self, amount):
+        # Takes the units only if they're there right now
+        with self._lock:
+            self._refill()
+            if self.level < min(amount, self.capacity):
+                return False
+            self.level -= min(amount, self.capacity)
+            return True
+
+    def refund(self, amount):
+        with self._lock:
+            self._refill()
+            self.level = min(self.capacity, self.level + amount)
+
+    def drain(self, seconds):
+        # Nothing more goes out for the next seconds, e.g. after a 429
+        with self._lock:
+            self._refill()
+            self.level = min(self.level, -seconds * self.rate)
+
+
+def estimate_tokens(request):
+    # What OpenAI counts against the TPM limit when a request is admitted:
+    # the prompt (roughly 4 characters a token) plus max_tokens
+    prompt_chars = len(json.dumps(request.get('messages', [])))
+    return prompt_chars // 4 + request.get('max_tokens', 0)
+
+
+def is_retryable(error):
+    if isinstance(error, (json.JSONDecodeError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(error, 'status_code', None)
+    if status is not None:
+        return status in RETRYABLE_STATUS or status >= 500
+    import openai  # Already loaded by the client that raised
+    return isinstance(error, openai.APIConnectionError)  # Includes timeouts
+
+
+def retry_after(error):
+    # Seconds the API asked us to wait, if it said
+    headers = getattr(getattr(error, 'response', None), 'headers', None) or {}
+    try:
+        if headers.get('retry-after-ms'):
+            return float(headers['retry-after-ms']) / 1000
+        if headers.get('retry-after'):
+            return float(headers['retry-after'])
+    except ValueError:
+        pass
+    return None
+
+
+class PromptStats:
+    def __init__(self, window=1000):
+        self.completed = 0
+        self.failures = 0
+        self.retries = 0
+        self.rate_limited = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.fallbacks = 0
+        self.local_fallbacks = 0
+        self.deadline_exceeded = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.latencies = deque(maxlen=window)
+
+    def latency_percentile(self, p):
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] if latencies else None
+
+    def to_dict(self):
+        def percentile_ms(p):
+            latency = self.latency_percentile(p)
+            return round(latency * 1000, 1) if latency is not None else 0
+
+        return {
+            'completed': self.completed,
+            'failures': self.failures,
+            'retries': self.retries,
+            'rateLimited': self.rate_limited,
+            'hedges': self.hedges,
+            'hedgeWins': self.hedge_wins,
+            'fallbacks': self.fallbacks,
+            'localFallbacks': self.local_fallbacks,
+            'deadlineExceeded': self.deadline_exceeded,
+            'promptTokens': self.prompt_tokens,
+            'completionTokens': self.completion_tokens,
+            'latencyMs': {'p50': percentile_ms(0.5), 'p95': percentile_ms(0.95), 'max': percentile_ms(1)},
+        }
+
+
+class LLMGateway:
+    # rpm/tpm of 0 leave that limit off. timeout applies to each attempt.
+    # A call is hedged once it runs past hedge_percentile of its prompt
+    # type's latencies (hedge_after seconds until hedge_min_samples calls
+    # have been seen; a percentile or hedge_after of 0 turns hedging off).
+    # fallback_models are tried in order once a model has used up its
+    # attempts, each getting fallback_reserve seconds of a deadline held
+    # back for it.
+
+    def __init__(self, client, rpm=0, tpm=0, timeout=60, max_attempts=5, backoff_base=1.0, backoff_max=30.0,
+                 hedge_percentile=0.95, hedge_after=10.0, hedge_min_samples=20, fallback_models=(),
+                 fallback_reserve=15.0, max_workers=32, sleep=time.sleep):
+        self.client = client
+        self.requests_bucket = TokenBucket(rpm) if rpm else None
+        self.tokens_bucket = TokenBucket(tpm) if tpm else None
+        self.timeout = timeout
+        self.max_attempts = max_attempts
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.hedge_percentile = hedge_percentile
+        self.hedge_after = hedge_after
+        self.hedge_min_samples = hedge_min_samples
+        self.fallback_models = list(fallback_models)
+        self.fallback_reserve = fallback_reserve
+        self.sleep = sleep
+        # Requests run here so the caller can stop waiting on a slow one
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='llm-call')
+        self._stats = {}
+        self._lock = threading.Lock()
+        self.waited = 0.0
+
+    def _prompt_stats(self, prompt_type):
+        with self._lock:
+            return self._stats.setdefault(prompt_type, PromptStats())
+
+    def record_local_fallback(self, prompt_type):
+        # For callers that gave up on the LLM and generated locally
+        stats = self._prompt_stats(prompt_type)
+        with self._lock:
+            stats.local_fallbacks += 1
+
+    def _admit(self, tokens, deadline):
+        wait_for = max(
+            self.requests_bucket.reserve(1) if self.requests_bucket else 0.0,
+            self.tokens_bucket.reserve(tokens) if self.tokens_bucket else 0.0
+        )
+        if wait_for > 0:
+            left = remaining(deadline)
+            if left is not None and wait_for > left:
+                self._release(tokens)
+                raise DeadlineExceeded('No LLM capacity before the deadline')
+            with self._lock:
+                self.waited += wait_for
+            self.sleep(wait_for)
+
+    def _try_admit(self, tokens):
+        if self.requests_bucket and not self.requests_bucket.try_reserve(1):
+            return False
+        if self.tokens_bucket and not self.tokens_bucket.try_reserve(tokens):
+            if self.requests_bucket:
+                self.requests_bucket.refund(1)
+            return False
+        return True
+
+    def _release(self, tokens):
+        if self.requests_bucket:
+            self.requests_bucket.refund(1)
+        if self.tokens_bucket:
+            self.tokens_bucket.refund(tokens)
+
+    def _settle(self, reserved, usage):
+        # Give back the part of max_tokens the response didn't use
+        if self.tokens_bucket and usage is not None:
+            self.tokens_bucket.refund(max(0, reserved - usage.total_tokens))
+
+    def backoff(self, attempt):
+        # Full jitter: anywhere up to the exponential delay for this attempt
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** (attempt - 1)))
+
+    def hedge_delay(self, stats):
+        if not self.hedge_percentile or not self.hedge_after:
+            return None
+        with self._lock:
+            if len(stats.latencies) < self.hedge_min_samples:
+                return self.hedge_after
+            return stats.latency_percentile(self.hedge_percentile)
+
+    def _call(self, prompt_type, stats, request, reserved, deadline):
+        # One request; returns the parsed JSON and raw content
+        left = remaining(deadline)
+        started = time.perf_counter()
+        labels = {'prompt': prompt_type, 'model': request['model']}
+        with metrics.timed(metrics.LLM_SECONDS, metrics.LLM_ERRORS, **labels):
+            response = self.client.chat.completions.create(
+                timeout=self.timeout if left is None else min(self.timeout, left), **request
+            )
+        usage = getattr(response, 'usage', None)
+        self._settle(reserved, usage)
+        with self._lock:
+            stats.latencies.append(time.perf_counter() - started)
+            if usage is not None:
+                stats.prompt_tokens += usage.prompt_tokens
+                stats.completion_tokens += usage.completion_tokens
+        if usage is not None:
+            metrics.LLM_TOKENS.inc(usage.prompt_tokens, kind='prompt', **labels)
+            metrics.LLM_TOKENS.inc(usage.completion_tokens, kind='completion', **labels)
+        content = response.choices[0].message.content
+        return json.loads(content or ''), content
+
+    def _attempt(self, prompt_type, stats, request, reserved, deadline):
+        # The request, plus a hedge if it's still running after the hedge
+        # delay and there's capacity to spare. The first good answer wins;
+        # the slower request finishes in the background and is dropped.
+        primary = self._executor.submit(self._call, prompt_type, stats, request, reserved, deadline)
+        pending = {primary}
+        delay = self.hedge_delay(stats)
+        if delay is not None:
+            left = remaining(deadline)
+            done, _ = wait(pending, timeout=delay if left is None else min(delay, left))
+            if not done and self._try_admit(reserved):
+                pending.add(self._executor.submit(self._call, prompt_type, stats, request, reserved, deadline))
+                with self._lock:
+                    stats.hedges += 1
+
+        error = None
+        while pending:
+            done, pending = wait(pending, timeout=remaining(deadline), return_when=FIRST_COMPLETED)
+            if not done:
+                raise DeadlineExceeded('No LLM response before the deadline')
+            for future in done:
+                if future.exception() is None:
+                    if future is not primary:
+                        with self._lock:
+                            stats.hedge_wins += 1
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _complete(self, stats, prompt_type, request, deadline):
+        reserved = estimate_tokens(request)
+        for attempt in range(1, self.max_attempts + 1):
+            remaining(deadline)
+            self._admit(reserved, deadline)
+            try:
+                return self._attempt(prompt_type, stats, request, reserved, deadline)
+            except DeadlineExceeded:
+                raise
+            except Exception as e:
+                status = getattr(e, 'status_code', None)
+                with self._lock:
+                    if status == 429:
+                        stats.rate_limited += 1
+                    if not is_retryable(e) or attempt == self.max_attempts:
+                        raise
+                    stats.retries += 1
+                delay = min(self.backoff_max, retry_after(e) or self.backoff(attempt))
+                if status == 429:
+                    # Hold everyone back, not just this caller
+                    if self.requests_bucket:
+                        self.requests_bucket.drain(delay)
+                    if self.tokens_bucket:
+                        self.tokens_bucket.drain(delay)
+                left = remaining(deadline)
+                if left is not None and delay >= left:
+                    raise DeadlineExceeded('No time left to retry %s' % prompt_type)
+                print('Retrying %s after %s (attempt %d) in %.1fs' % (prompt_type, type(e).__name__, attempt, delay))
+                self.sleep(delay)
+
+    def complete_json(self, prompt_type, request, deadline=None):
+        # Returns the response parsed as JSON, its raw content and the model
+        # that answered. deadline defaults to the one set by deadline_after.
+        stats = self._prompt_stats(prompt_type)
+        if deadline is None:
+            deadline = current_deadline.get()
+        models = [request['model']] + [model for model in self.fallback_models if model != request['model']]
+        for i, model in enumerate(models):
+            fallbacks_left = len(models) - 1 - i
+            model_deadline = deadline
+            if deadline is not None and fallbacks_left:
+                model_deadline = deadline - self.fallback_reserve * fallbacks_left
+            try:
+                result, content = self._complete(stats, prompt_type, dict(request, model=model), model_deadline)
+            except Exception as e:
+                if not fallbacks_left:
+                    with self._lock:
+                        stats.failures += 1
+                        if isinstance(e, DeadlineExceeded):
+                            stats.deadline_exceeded += 1
+                    raise
+                print('%s failed on %s (%s), falling back to %s' % (prompt_type, model, type(e).__name__, models[i + 1]))
+                continue
+            with self._lock:
+                stats.completed += 1
+                if i:
+                    stats.fallbacks += 1
+            return result, content, model
+
+    def stats(self):
+        with self._lock:
+            return {
+                'limiterWaitSeconds': round(self.waited, 3),
+                'prompts': {prompt_type: stats.to_dict() for prompt_type, stats in sorted(self._stats.items())},
+            }
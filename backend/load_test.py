@@ -0,0 +1,102 @@
+import argparse
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Drives a running backend with the requests players make while a game is in
+# progress (status, round completion and leaderboard polls, plus market data
+# reads when an ID token is given) at increasing concurrency, and prints the
+# throughput and latency at each level. Run it against a server started with
+# different GUNICORN_WORKERS / GUNICORN_THREADS to compare, e.g.
+#
+#   GUNICORN_WORKERS=1 GUNICORN_THREADS=1 gunicorn -c gunicorn.conf.py 'main:create_app()'
+#   GUNICORN_WORKERS=2 GUNICORN_THREADS=16 gunicorn -c gunicorn.conf.py 'main:create_app()'
+#   python load_test.py --game-code ABC123 --round-code XYZ789
+#
+# --slow-url adds a request that ties up a worker for a long time (such as
+# /start_game waiting on OpenAI) running alongside, to show whether other
+# requests queue up behind it.
+
+
+def player_requests(args):
+    base = args.url.rstrip('/')
+    room = {'gameCode': args.game_code, 'roundCode': args.round_code}
+    calls = [
+        lambda session: session.get(base + '/check_game_status', params={'gameCode': args.game_code}),
+        lambda session: session.get(base + '/leaderboard', params={'gameCode': args.game_code}),
+    ]
+    if args.round_code:
+        calls.append(lambda session: session.post(base + '/check_round_completion', json=room))
+        if args.id_token:
+            calls.append(lambda session: session.post(
+                base + '/get_round_market_data', json=dict(room, idToken=args.id_token)
+            ))
+    return calls
+
+
+def run_level(args, concurrency):
+    calls = player_requests(args)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.time() + args.duration
+
+    def player():
+        session = requests.Session()
+        while time.time() < deadline:
+            start = time.time()
+            try:
+                ok = random.choice(calls)(session).status_code < 500
+            except requests.RequestException:
+                ok = False
+            with lock:
+                latencies.append(time.time() - start)
+                if not ok:
+                    errors[0] += 1
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for _ in range(concurrency):
+            executor.submit(player)
+    elapsed = time.time() - started
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(len(latencies) - 1, int(len(latencies) * p))] * 1000 if latencies else 0
+
+    return len(latencies), len(latencies) / elapsed, percentile(0.5), percentile(0.95), percentile(0.99), errors[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Load test the FinSim backend')
+    parser.add_argument('--url', default='http://localhost:8080')
+    parser.add_argument('--game-code', required=True)
+    parser.add_argument('--round-code')
+    parser.add_argument('--id-token', help='Firebase ID token of a player in the room')
+    parser.add_argument('--concurrency', default='1,2,4,8,16,32', help='Comma-separated client counts')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds per concurrency level')
+    parser.add_argument('--slow-url', help='URL to keep requesting in the background, e.g. a slow endpoint')
+    args = parser.parse_args()
+
+    stop = threading.Event()
+    if args.slow_url:
+        def slow_requests():
+            while not stop.is_set():
+                try:
+                    requests.get(args.slow_url, timeout=600)
+                except requests.RequestException:
+                    time.sleep(1)
+        threading.Thread(target=slow_requests, daemon=True).start()
+
+    print('%11s %9s %9s %9s %9s %9s %7s' % ('concurrency', 'requests', 'req/s', 'p50 ms', 'p95 ms', 'p99 ms', 'errors'))
+    for concurrency in [int(c) for c in args.concurrency.split(',')]:
+        print('%11d %9d %9.1f %9.1f %9.1f %9.1f %7d' % ((concurrency,) + run_level(args, concurrency)))
+    stop.set()
+
+
+if __name__ == '__main__':
+    main()
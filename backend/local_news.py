@@ -0,0 +1,39 @@
+import random
+
+# Stand-in headlines for when the LLM can't write a round's news in time.
+# They're deterministic (the same ticker, round and count always give the
+# same headlines) and use wording price_engine's sentiment scoring knows, so
+# prices still react to them.
+
+COMPANY_TEMPLATES = [
+    '{ticker} beats quarterly earnings expectations on strong demand',
+    '{ticker} shares rally after analysts upgrade the stock',
+    '{ticker} announces record revenue and raises full-year guidance',
+    '{ticker} expands into new markets with a major partnership',
+    '{ticker} misses revenue estimates as losses widen',
+    '{ticker} faces lawsuit over product safety concerns',
+    '{ticker} shares plunge after a weak outlook for next quarter',
+    '{ticker} announces layoffs amid slowing growth',
+    '{ticker} holds annual shareholder meeting with no major announcements',
+    '{ticker} trades in line with the broader market this week',
+]
+
+GLOBAL_TEMPLATES = [
+    'Global growth beats forecasts as trade picks up',
+    'Central banks signal rate cuts and boost markets worldwide',
+    'New trade deal expected to lift exports across major economies',
+    'Inflation concerns rise as energy prices surge',
+    'Political tensions escalate, sending markets lower',
+    'Manufacturing decline deepens in several large economies',
+    'Markets await next week\'s employment report',
+]
+
+
+def company_headlines(ticker, count, round_number=0):
+    rng = random.Random('%s:%d' % (ticker, round_number))
+    return [template.format(ticker=ticker) for template in rng.sample(COMPANY_TEMPLATES, count)]
+
+
+def global_headlines(round_number=0, count=3):
+    rng = random.Random('global:%d' % round_number)
+    return rng.sample(GLOBAL_TEMPLATES, count)
@@ -1,419 +1,711 @@
-from flask import Flask, request, jsonify
+import time
+IMPORT_STARTED = time.perf_counter()
+
+from flask import Blueprint, Flask, Response, request, jsonify, g, send_file, stream_with_context
 from google.cloud import firestore
-from google.oauth2 import service_account
 from flask_cors import CORS, cross_origin
-import firebase_admin
-from firebase_admin import credentials, auth
-import requests
-import yfinance as yf
 import random
 from datetime import datetime, timedelta
 import json
-from openai import OpenAI
-import json
+import math
 import os
+import queue
 import uuid
+import contextvars
 import copy 
+import functools
+import hmac
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from dotenv import load_dotenv
+from clients import LazyClient
+import clients
+from scenario_pool import ScenarioPool
+from llm_cache import LLMCache, MemoryCache, SQLiteCache
+from llm_gateway import LLMGateway, deadline_after
+import local_news
+import metrics
+import profiling
+import prompts
+from prompts import parse_batch_prices, is_headline_list
+from quotes import QuoteCache
+from auth_cache import IdTokenCache
+from room_events import RoomEventBroker, format_sse
+from room_store import (
+    get_room_ref, get_portfolio_ref, write_game, write_pending_round, take_over_pending_rounds, delete_pending_rounds,
+    append_round
+)
+from room_cache import RoomCache
+import price_engine
+from market_index import MarketIndex
+import ledger
+import valuation
 load_dotenv()
 
-OPEN_AI_API_KEY = os.getenv('OPEN_AI_API_KEY')
+# Created on first use; create_app can swap any of them out
+db = LazyClient('Firestore', clients.firestore_client)
+firebase_auth = LazyClient('Firebase Auth', clients.firebase_auth)
+openai_client = LazyClient('OpenAI', lambda: clients.openai_client(LLM_HTTP_CONNECTIONS, LLM_TIMEOUT))
+LAZY_CLIENTS = {'db': db, 'firebase_auth': firebase_auth, 'openai_client': openai_client}
+
+# Max number of OpenAI requests in flight at once across all games being generated
+LLM_CONCURRENCY = int(os.getenv('LLM_CONCURRENCY', '8'))
+llm_executor = ThreadPoolExecutor(max_workers=LLM_CONCURRENCY, thread_name_prefix='llm')
+
+def submit_llm(fn, *args):
+    # Runs fn on the LLM executor under the caller's LLM deadline
+    return llm_executor.submit(contextvars.copy_context().run, fn, *args)
+
+# Every OpenAI call goes through one gateway per process, paced to the
+# account's LLM_RPM requests and LLM_TPM tokens a minute (0 turns a limit
+# off), split evenly between the LLM_PROCESSES worker processes sharing the
+# key. Each attempt times out after LLM_TIMEOUT seconds; rate limits,
+# timeouts, server errors and invalid JSON are retried up to
+# LLM_MAX_ATTEMPTS times with jittered exponential backoff.
+LLM_RPM = int(os.getenv('LLM_RPM', '500'))
+LLM_TPM = int(os.getenv('LLM_TPM', '200000'))
+LLM_PROCESSES = int(os.getenv('LLM_PROCESSES', os.getenv('GUNICORN_WORKERS', '2')))
+LLM_TIMEOUT = float(os.getenv('LLM_TIMEOUT', '60'))
+LLM_MAX_ATTEMPTS = int(os.getenv('LLM_MAX_ATTEMPTS', '5'))
+LLM_HTTP_CONNECTIONS = int(os.getenv('LLM_HTTP_CONNECTIONS', '20'))
+
+# Tail latency: a call still running past the LLM_HEDGE_PERCENTILE latency
+# of its prompt type (LLM_HEDGE_AFTER seconds until there's enough history;
+# 0 turns hedging off) gets a duplicate request. A model that keeps failing
+# hands over to the next of LLM_FALLBACK_MODELS (comma-separated, cheaper
+# models), each kept LLM_FALLBACK_RESERVE seconds of the deadline. Every
+# round's LLM calls share an LLM_ROUND_DEADLINE (0 for none); anything not
+# back by then is generated locally, unless LLM_LOCAL_FALLBACK is off.
+LLM_HEDGE_PERCENTILE = float(os.getenv('LLM_HEDGE_PERCENTILE', '0.95'))
+LLM_HEDGE_AFTER = float(os.getenv('LLM_HEDGE_AFTER', '10'))
+LLM_FALLBACK_MODELS = [model for model in os.getenv('LLM_FALLBACK_MODELS', '').split(',') if model.strip()]
+LLM_FALLBACK_RESERVE = float(os.getenv('LLM_FALLBACK_RESERVE', '15'))
+LLM_ROUND_DEADLINE = float(os.getenv('LLM_ROUND_DEADLINE', '90'))
+LLM_LOCAL_FALLBACK = os.getenv('LLM_LOCAL_FALLBACK', 'true').lower() == 'true'
+LOCAL_FALLBACK_SEED = 0
+
+llm_gateway = LLMGateway(
+    openai_client,
+    rpm=LLM_RPM // LLM_PROCESSES,
+    tpm=LLM_TPM // LLM_PROCESSES,
+    timeout=LLM_TIMEOUT,
+    max_attempts=LLM_MAX_ATTEMPTS,
+    hedge_percentile=LLM_HEDGE_PERCENTILE,
+    hedge_after=LLM_HEDGE_AFTER,
+    fallback_models=LLM_FALLBACK_MODELS,
+    fallback_reserve=LLM_FALLBACK_RESERVE,
+    max_workers=LLM_HTTP_CONNECTIONS
+)
+
+# 'batch' prices every ticker of a round in one request, 'per_stock' makes one request per ticker
+PRICING_MODE = os.getenv('PRICING_MODE', 'batch')
+PRICING_BATCH_RETRIES = int(os.getenv('PRICING_BATCH_RETRIES', '2'))
+
+# 'batch' writes every ticker's headlines (and the global ones) in one request per round
+NEWS_MODE = os.getenv('NEWS_MODE', 'batch')
+
+# Every prompt is sent at version 1 unless PROMPT_VERSIONS picks another
+# version in prompts.py, e.g. 'stock_price=2'
+PROMPT_VERSIONS = prompts.parse_versions(os.getenv('PROMPT_VERSIONS', ''))
+
+# Pre-generated games kept on disk per round count, each refilled once a game
+# of that length has been started. A size of 0 turns the pool off.
+SCENARIO_POOL_SIZE = int(os.getenv('SCENARIO_POOL_SIZE', '1'))
+SCENARIO_POOL_ROUNDS = [int(r) for r in os.getenv('SCENARIO_POOL_ROUNDS', '4,6,8,10,12').split(',') if r.strip()]
+SCENARIO_POOL_DIR = os.getenv('SCENARIO_POOL_DIR', os.path.join(tempfile.gettempdir(), 'finsim_scenarios'))
+SCENARIO_POOL_MAX_AGE = int(os.getenv('SCENARIO_POOL_MAX_AGE', str(24 * 60 * 60)))
+
+# Cache for OpenAI responses. LLM_CACHE_MODE is 'off', 'readwrite' or 'replay'
+# (serve only from the cache, never call the API). Headline prompts are
+# deliberately left out by default so rooms don't all get the same news.
+LLM_CACHE_MODE = os.getenv('LLM_CACHE_MODE', 'readwrite')
+LLM_CACHE_BACKEND = os.getenv('LLM_CACHE_BACKEND', 'memory')
+LLM_CACHE_PATH = os.getenv('LLM_CACHE_PATH', os.path.join(tempfile.gettempdir(), 'finsim_llm_cache.sqlite3'))
+LLM_CACHE_TTL = int(os.getenv('LLM_CACHE_TTL', '3600'))
+LLM_CACHE_MAX_ENTRIES = int(os.getenv('LLM_CACHE_MAX_ENTRIES', '5000'))
+LLM_CACHE_PROMPTS = os.getenv('LLM_CACHE_PROMPTS', 'stock_price,stock_prices_batch')
+
+if LLM_CACHE_BACKEND == 'sqlite':
+    llm_cache_backend = SQLiteCache(LLM_CACHE_PATH, LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL)
+else:
+    llm_cache_backend = MemoryCache(LLM_CACHE_MAX_ENTRIES, LLM_CACHE_TTL)
+llm_cache = LLMCache(
+    llm_cache_backend,
+    LLM_CACHE_MODE,
+    None if LLM_CACHE_PROMPTS == '*' else set(LLM_CACHE_PROMPTS.split(','))
+)
+
+TOP_STOCK_TICKERS = ['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'META', 'TSLA', 'BRK-B', 'JNJ', 'V', 'WMT']
+
+# Shared yfinance quotes for game starts and /stonks, refreshed at most once per TTL
+quote_cache = QuoteCache(
+    TOP_STOCK_TICKERS,
+    os.getenv('QUOTE_SNAPSHOT_PATH', os.path.join(tempfile.gettempdir(), 'finsim_quotes.json')),
+    ttl_open=int(os.getenv('QUOTE_TTL_OPEN', '60')),
+    ttl_closed=int(os.getenv('QUOTE_TTL_CLOSED', str(30 * 60)))
+)
+
+# 'llm' prices every round through OpenAI, 'local' uses the seeded price_engine
+PRICE_MODELS = ('llm', 'local')
+PRICE_MODEL_BY_DIFFICULTY = dict(
+    item.split(':') for item in os.getenv('PRICE_MODEL_BY_DIFFICULTY', 'easy:llm,medium:llm,hard:llm').split(',')
+)
+
+# uid -> (display name, cached at) for players whose room predates playerNames
+DISPLAY_NAME_TTL = int(os.getenv('DISPLAY_NAME_TTL', '3600'))
+display_name_cache = {}
+display_name_lock = threading.Lock()
+
+STARTING_CASH = 100000
+
+# Games are generated by background start jobs, at most GAME_START_WORKERS
+# at once per process (round jobs below share the same workers). A job whose
+# progress hasn't moved in JOB_STALE_AFTER seconds is taken to be dead and is
+# resumed from the rounds it had already saved. START_ROUND_SECONDS is the
+# per-round time used for the ETA until the first round of a job has finished.
+GAME_START_WORKERS = int(os.getenv('GAME_START_WORKERS', '4'))
+JOB_STALE_AFTER = int(os.getenv('JOB_STALE_AFTER', '180'))
+START_ROUND_SECONDS = float(os.getenv('START_ROUND_SECONDS', '10'))
+game_start_executor = ThreadPoolExecutor(max_workers=GAME_START_WORKERS, thread_name_prefix='game-start')
+JOB_ACTIVE = ('queued', 'running', 'writing')
+
+# With ROUND_GENERATION=progressive, games priced by the LLM start as soon
+# as their first round is generated. Later rounds come from round jobs that
+# keep ROUND_LOOKAHEAD rounds ready beyond the one being played, so a game
+# that's abandoned early never pays for the rest. ROUND_GENERATION=eager
+# generates every round before the game starts. A failed round job is
+# retried after ROUND_RETRY_DELAY seconds when a round ends or a waiting
+# player polls.
+ROUND_GENERATION = os.getenv('ROUND_GENERATION', 'progressive')
+ROUND_LOOKAHEAD = max(1, int(os.getenv('ROUND_LOOKAHEAD', '1')))
+ROUND_RETRY_DELAY = int(os.getenv('ROUND_RETRY_DELAY', '5'))
+
+# Keep an append-only log of every trade under each portfolio's trades
+# collection, for auditing; positions themselves are netted per ticker
+TRADE_LOG = os.getenv('TRADE_LOG', 'true').lower() == 'true'
+
+# Attempts for the read-modify-write transactions in the trade endpoints
+# before giving up on contention
+TRANSACTION_MAX_ATTEMPTS = int(os.getenv('TRANSACTION_MAX_ATTEMPTS', '10'))
+
+# Server-sent event streams for room state, off unless ROOM_EVENTS_ENABLED:
+# App Engine standard buffers responses, so streams only work where they're
+# passed through as they're written, and each open stream holds a worker
+# thread. Clients poll check_round_completion either way; a stream only gets
+# them there sooner. A worker keeps at most ROOM_EVENTS_MAX_STREAMS streams
+# open so they can't take the threads trades and round completions need.
+# Idle streams get a comment line every ROOM_EVENTS_KEEPALIVE seconds so
+# proxies don't close them. Events go through Firestore so every worker's
+# streams see them; ROOM_EVENTS_SHARED=false keeps them in process, which is
+# only right for a single worker.
+ROOM_EVENTS_ENABLED = os.getenv('ROOM_EVENTS_ENABLED', 'false').lower() == 'true'
+ROOM_EVENTS_MAX_STREAMS = int(os.getenv('ROOM_EVENTS_MAX_STREAMS', '4'))
+ROOM_EVENTS_KEEPALIVE = int(os.getenv('ROOM_EVENTS_KEEPALIVE', '15'))
+ROOM_EVENTS_QUEUE_SIZE = int(os.getenv('ROOM_EVENTS_QUEUE_SIZE', '100'))
+ROOM_EVENTS_SHARED = os.getenv('ROOM_EVENTS_SHARED', 'true').lower() == 'true'
+
+# /metrics reports every worker of the instance: each one writes its metrics
+# to METRICS_DIR every METRICS_FLUSH_SECONDS. An empty METRICS_DIR reports
+# only the worker serving the scrape.
+METRICS_DIR = os.getenv('METRICS_DIR', metrics.DEFAULT_DIR)
+METRICS_FLUSH_SECONDS = float(os.getenv('METRICS_FLUSH_SECONDS', '5'))
+
+# /metrics, the *_stats routes and /profiles need ADMIN_TOKEN, sent as
+# X-Admin-Token or as a bearer token (what Prometheus can be set up to send).
+# Without an ADMIN_TOKEN they're refused.
+ADMIN_TOKEN = os.getenv('ADMIN_TOKEN', '')
+
+# Profiling a request: send X-Profile: sample (stacks sampled every
+# PROFILE_SAMPLE_INTERVAL seconds, saved as collapsed stacks for a flamegraph)
+# or X-Profile: cprofile along with the admin token; without it the header is
+# ignored. PROFILE_SAMPLE_RATE samples that fraction of all requests. The
+# last PROFILE_KEEP profiles are kept in PROFILE_DIR and listed at /profiles.
+PROFILE_SAMPLE_RATE = float(os.getenv('PROFILE_SAMPLE_RATE', '0'))
+PROFILE_SAMPLE_INTERVAL = float(os.getenv('PROFILE_SAMPLE_INTERVAL', '0.005'))
+PROFILE_DIR = os.getenv('PROFILE_DIR', os.path.join(tempfile.gettempdir(), 'finsim_profiles'))
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '200'))
+
+bp = Blueprint('finsim', __name__)
+
+# Room metadata and portfolios are served from memory and kept current by
+# Firestore listeners; rounds are cached for as long as the room is active
+room_cache = RoomCache(
+    db,
+    max_rooms=int(os.getenv('ROOM_CACHE_MAX_ROOMS', '500')),
+    idle_timeout=int(os.getenv('ROOM_CACHE_IDLE_TIMEOUT', '600')),
+    listen=os.getenv('ROOM_CACHE_LISTEN', 'true').lower() == 'true'
+)
+
+room_events = RoomEventBroker(db if ROOM_EVENTS_SHARED else None, max_queue_size=ROOM_EVENTS_QUEUE_SIZE,
+                              max_subscribers=ROOM_EVENTS_MAX_STREAMS)
+
+def publish_room_event(game_code, event_type, data):
+    # Events follow changes that are already saved, so a failed publish is
+    # logged rather than failing the request; clients still see the change
+    # by polling
+    if not ROOM_EVENTS_ENABLED:
+        return
+    try:
+        room_events.publish(game_code, event_type, data)
+    except Exception as e:
+        print('Failed to publish %s to room %s: %s' % (event_type, game_code, e))
+
+request_profiler = profiling.RequestProfiler(PROFILE_DIR, keep=PROFILE_KEEP, sample_interval=PROFILE_SAMPLE_INTERVAL,
+                                             sample_rate=PROFILE_SAMPLE_RATE)
+
+def verify_id_token(id_token):
+    with metrics.timed(metrics.AUTH_SECONDS, metrics.AUTH_ERRORS, call='verify_id_token'):
+        return firebase_auth.verify_id_token(id_token)
+
+# Verified tokens are reused until they expire. The Admin SDK client behind
+# auth.verify_id_token is created once per app and keeps Google's signing
+# certificates cached in process for as long as their Cache-Control allows.
+id_token_cache = IdTokenCache(
+    verify_id_token,
+    max_entries=int(os.getenv('ID_TOKEN_CACHE_SIZE', '10000'))
+)
+
+def require_id_token(view):
+    # Verifies the idToken in the JSON body and exposes the caller as g.uid
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        data = request.get_json(silent=True) or {}
+        try:
+            g.uid = id_token_cache.verify(data.get('idToken'))['uid']
+        except Exception as e:
+            return jsonify({'error': 'Invalid ID token'}), 401
+        return view(*args, **kwargs)
+    return wrapper
+
+def has_admin_token():
+    token = request.headers.get('X-Admin-Token', '')
+    authorization = request.headers.get('Authorization', '')
+    if not token and authorization.startswith('Bearer '):
+        token = authorization[len('Bearer '):]
+    return bool(ADMIN_TOKEN) and hmac.compare_digest(token.encode(), ADMIN_TOKEN.encode())
+
+def require_admin_token(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if not has_admin_token():
+            return jsonify({'error': 'Invalid admin token'}), 403
+        return view(*args, **kwargs)
+    return wrapper
+
+def prompt_version(name):
+    return PROMPT_VERSIONS.get(name, 1)
+
+def chat_completion_json(prompt_type, variant, prompt_input):
+    # variant separates requests that are identical on purpose but should get
+    # different answers, e.g. the same headline prompt for round 1 and round 2.
+    # Only replies the prompt can use, from the requested model, are cached;
+    # a cached reply that isn't usable is asked for again.
+    prompt = prompts.get_prompt(prompt_type, prompt_version(prompt_type))
+    request = prompt.request(prompt_input)
+    key = llm_cache.key(prompt_type, request, variant)
+    content = llm_cache.get(prompt_type, key)
+    if content is not None:
+        result = json.loads(content)
+        if prompt.validate(prompt_input, result):
+            return result
+    result, content, model = llm_gateway.complete_json(prompt_type, request)
+    if model == request['model'] and prompt.validate(prompt_input, result):
+        llm_cache.set(prompt_type, key, content)
+    return result
 
-client = OpenAI(api_key=OPEN_AI_API_KEY)
+def simulate_stock_price(example):
+    return chat_completion_json('stock_price', 0, example)
+
+def simulate_stock_prices(assets, variant=0):
+    return chat_completion_json('stock_prices_batch', variant, {"assets": assets})
+
+def predict_next_prices(stocks):
+    # Price every stock of the round in one request and re-ask only for the
+    # tickers that came back missing or malformed. Anything still unpriced
+    # after the retries falls back to one simulate_stock_price call per
+    # ticker; tickers that still fail are left out.
+    pending = {stock['ticker']: stock for stock in stocks}
+    new_prices = {}
+    for attempt in range(1 + PRICING_BATCH_RETRIES):
+        if not pending:
+            break
+        assets = [{
+            "ticker": stock['ticker'],
+            "current_price": stock['price'],
+            "news": stock['news']
+        } for stock in pending.values()]
+        try:
+            # A retry is never answered from the cache
+            response = simulate_stock_prices(assets, variant=attempt)
+        except Exception as e:
+            print('Batch pricing failed: %s' % e)
+            continue
+        for ticker, price in parse_batch_prices(response, list(pending)).items():
+            new_prices[ticker] = price
+            del pending[ticker]
 
-app = Flask(__name__)
-CORS(app)
+    for ticker, stock in pending.items():
+        try:
+            new_prices[ticker] = predict_next_price(stock)
+        except Exception as e:
+            print('Pricing %s failed: %s' % (ticker, e))
+    return new_prices
 
-db_cred = service_account.Credentials.from_service_account_file('creds.json')
-db = firestore.Client(credentials=db_cred)
+def generate_news_headlines(next_company, variant=0):
+    return chat_completion_json('company_news', variant, next_company)
 
-# Initialize Firebase Admin SDK
-cred = credentials.Certificate('creds.json')
-firebase_admin.initialize_app(cred)
+def generate_global_news_headline(variant=0):
+    return chat_completion_json('global_news', variant, None)
 
-def simulate_stock_price(example):
-    str_example = json.dumps(example)
-    response = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-            "role": "system",
-            "content": [
-                {
-                "type": "text",
-                "text": "Simulate stock market prices for a given asset. Consider the current stock price and a list of news articles, then determine the new price based on the expected impact of the news.\n\nUse provided inputs in JSON format and calculate a reasonable new stock price based on the nature of the given news. Each news item may have a positive, negative, or neutral effect on the stock.\n\n# Steps\n\n1. **Process Input**: Receive the input JSON containing the company's current stock price and a list of news items.\n2. **Analyze News Impact**: For each piece of news, determine if its tone is positive, negative, or neutral.\n3. **Adjust Stock Price**: Depending on the combined influence of the news items:\n   - Positive news should boost the price. Determine a range between 0 - 40% of the current price\n   - Negative news should decrease the price. Determine a range between 0 - 40% of the current price\n   - Neutral/balanced news should not significantly affect the stock price.\n4. **Output Result**: Output the adjusted stock price as JSON, including a breakdown of how each news item affected the final value.\n\n# Output Format\n\nThe output should be in JSON format with the following structure:\n- `asset`: the name of the asset.\n- `current_price`: the original price provided.\n- `new_price`: the calculated new stock price.\n\nExample Output:\n```json\n{\n  \"asset\": \"[Company Name]\",\n  \"current_price\": [Current Price],\n  \"new_price\": [Calculated New Price]\n}\n```\n\n# Example\n\n### Input:\n```json\n{\n  \"asset\": \"TechCo\",\n  \"current_price\": 150.00,\n  \"news\": [\n    \"TechCo reports 20% increase in quarterly revenue.\",\n    \"Lawsuit filed against TechCo over privacy concerns.\",\n    \"TechCo launches new smartphone model.\"\n  ]\n}\n```\n\n### Reasoning:\n- News headline 1: Very positive news, will likely boost stock price due to strong earnings.\n- News headline 2: Negative news, expected to partially offset gains due to potential legal costs.\n- News headline 3: New product launch, likely positive, but depends on market response.\n\n### Output:\n```json\n{\n  \"asset\": \"TechCo\",\n  \"current_price\": 150.00,\n  \"new_price\": 165.50\n}\n```\n\n# Notes\n\n- With conflicting news, the model should try to balance the impact proportionally.\n- Some news might not have significant impact. In such cases, the impact can be zero.\n- Consider edge cases like highly impactful news or unclear sentiment and provide a conservative change.\n- If the news are clearly super impactful feel free to give it a return between -40% to 40%.\n"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"AAPL\",\n  \"current_price\": 250,\n  \"news\": [\n    \"AAPL reports 50% increase in quarterly revenue. Beats Projected goal for End of Quarter\",\n    \"Lawsuit filed against AAPL over privacy concerns.\",\n    \"AAPL launches new smartphone model with new features that integrate with the upcoming Vision Pros.\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"AAPL\",\n  \"current_price\": 250,\n  \"new_price\": 280.00\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 100,\n  \"news\": [\n    \"MSFT reports hiring another 10 thosand new graduates.\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 100\n  \"new_price\": 120.00\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"TSLA\",\n  \"current_price\": 150,\n  \"news\": [\n    \"TSLA reports an explosion in their new gigafactory location, which is the main location for manufacturing\",\n    \"Industry experts dislike the new Cybertruck car - They say it looks like a dumpster\",\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"TSLA\",\n  \"current_price\": 150,\n  \"new_price\": 100.00\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 500,\n  \"news\": [\n    \"Microsoft Announces Mind-Controlled Video Games: 'Xbox Your Brain'!\",\n    \"Microsoft's New AI-Powered Clippy Crashes Stock Trading: 'Paperclips Everywhere!'\",\n    \"Windows 13 Rollout Stumbles as Users Complain of Unexpected Blue Screens\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 500,\n  \"new_price\": 465.00\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 465,\n  \"news\": [\n    \"Microsoft Acquires Espresso Tech: Future Office Meetings to Be Powered by Coffee!\",\n    \"New Windows Update Touted as 'Perfect' by Developers, But Users Find Bugs Quickly\",\n    \"Microsoft's Cloud Gaming Expansion Faces Backlash from Traditional Gamers\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 495,\n  \"new_price\": 465.00\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": str_example
-                }
-            ]
-            },
-        ],
-        temperature=1,
-        max_tokens=7665,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-        response_format={
-            "type": "json_object"
-        }
-    )
-    return json.loads(response.choices[0].message.content)
-
-def generate_news_headlines(next_company):
-    response_two = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-            "role": "system",
-            "content": [
-                {
-                "type": "text",
-                "text": "Generate positive and negative news headlines for a stock trading simulation game. You will receive the name of a company or its ticker symbol, and your task is to create a few relevant and imaginative news headlines that can be either positive or negative\n\n- The headlines can be humorous, surprising, or reflect something unexpected about the company.\n- Randomly decide if the news can be negative or upsetting themes. Feel free to be creative\n- Each headline should be succinct and convey its message clearly in an attention-grabbing way.\n\n# Steps\n\n1. Receive the company name or ticker.\n2. Create 1 to 3 distinct and engaging headlines that relate to the company.\n3. Ensure they vary in theme—mix reality-based humor, tragedies, failures, growth announcements, fictional innovations, partnership, rumors, gossip, etc.\n\n# Output Format\n\nReturn a JSON object structured as follows:\n- `headlines`: An array of strings, each representing a news headline.\n- There should be between 1 and 3 headlines in the array.\n\n```json\n{\n  \"headlines\": [\n    \"Headline 1\",\n    \"Headline 2\",\n    \"Headline 3\"\n  ]\n}\n```\n\n# Examples\n\n### Example 1 - Input:\nCompany: \"Tesla\"\n\n### Example 1 - Output:\n```json\n{\n  \"headlines\": [\n    \"Tesla Unveils Self-Driving Electric Helicopter. Elon Calls It 'Top Secret Fun Project'\",\n    \"Tesla Teams Up With SpaceX to Offer 'Martian-Ready' Cybertrucks for the Future Red Planet Colony\",\n    \"Industry experts dislike the new Cybertruck car. They say it looks like a dumpster\"\n  ]\n}\n```\n\n### Example 2 - Input:\nCompany: \"Apple\"\n\n### Example 2 - Output:\n```json\n{\n  \"headlines\": [\n    \"Apple Launches 'iPlant,' a Smart Home Device That Monitors Your Plants' Emotions\",\n    \"Apple and Disney sued by over privacy concerns.\",\n  ]\n}\n```\n\n# Notes\n\n- Headlines should be creative way, positive, and negative\n- Ensure headlines are suitable for a light-hearted stock simulation game but include some negative news\n- Keep each headline concise yet interesting, and vary their focus as much as possible."
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "AAPL"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"headlines\": [\n    \"Apple Launches 'iPlant,' a Smart Home Device That Monitors Your Plants' Emotions and reports record-breaking sales\",\n    \"Rumor Mill: Apple Reportedly Fails to develop Foldable iPhone. Losing competition to Google\",\n    \"Apple and Disney sued by over privacy concerns.\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "TSLA"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"headlines\": [\n    \"TSLA reports an explosion in their new gigafactory location\",\n    \"Industry experts dislike the new Cybertruck car.\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "MSFT"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"headlines\": [\n    \"Microsoft Announces Mind-Controlled Video Games: 'Xbox Your Brain'!\",\n    \"Microsoft's New AI-Powered Clippy Crashes Stock Trading: 'Paperclips Everywhere!'\",\n    \"Windows 13 Rollout Stumbles as Users Complain of Unexpected Blue Screens\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "MSFT"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"headlines\": [\n    \"Microsoft Acquires Espresso Tech: Future Office Meetings to Be Powered by Coffee!\",\n    \"New Windows Update Touted as 'Perfect' by Developers, But Users Find Bugs Quickly\",\n    \"Microsoft's Cloud Gaming Expansion Faces Backlash from Traditional Gamers\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": next_company
-                }
-            ]
-            }
-        ],
-        temperature=1.2,
-        max_tokens=6261,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-        response_format={
-            "type": "json_object"
-        }
-    )
-    return json.loads(response_two.choices[0].message.content)
-
-def generate_global_news_headline():
-    response_two = client.chat.completions.create(
-        model="gpt-4o-mini",
-        messages=[
-            {
-            "role": "system",
-            "content": [
-                {
-                "type": "text",
-                "text": "Generate three positive or negative news headlines related to the world, economy, or politics for a stock trading game. The headlines should be informative, relevant to global news, and present impactful scenarios that could influence stock trading decisions. Mix both positive and negative news to simulate realistic market conditions. \n\n# Requirements:\n- Headline topics should be relevant to global news concerning politics, economy, or significant regional/world events.\n- Headlines must be clear, informative, and impactful.\n- Avoid repetition in news themes to provide variety in the scenario.\n- Include a mix of both optimistic and pessimistic viewpoints.\n\n# Output Format\n\nThe response must be in JSON format pointing to an array with exactly three string headlines:\n```\n{\n  \"headlines\": [\n    \"[headline_1]\",\n    \"[headline_2]\",\n    \"[headline_3]\"\n  ]\n}\n```\n\n# Headlines Characteristics\n- Each headline should convey either a positive or negative impact, e.g., an economic growth report or political turmoil.\n- Each headline should be presented in a format that would affect market sentiment clearly (e.g. \"global economy growth surpasses estimates\" or \"political conflict in region X leads to unrest\").\n  \n# Examples\n\n### Example 1:\n\n**Input Context**: Generate news headlines.\n\n**Output**:\n{\n  \"headlines\": [\n    \"Global market booms as tech companies report record-breaking profits\",\n    \"Political turmoil in Region X sends currencies in freefall amid rising tensions\",\n    \"Trade agreement between the EU and Asian economies promises significant growth by year-end\"\n  ]\n}\n\n### Example 2:\n\n**Input Context**: Generate news headlines.\n\n**Output**:\n{\n  \"headlines\": [\n    \"Massive infrastructure investment approved by U.S. government boosts hopes for economic recovery\",\n    \"Uncertainty rises as international sanctions weaken Region Y's economy, causing global disruptions\",\n    \"Tourism revival in Southeast Asia accelerates regional economic recovery beyond expectations\"\n  ]\n}\n\n(Note: In real examples, a mix of optimistic and pessimistic viewpoints is common. Vary between topics such as trade, conflict, policies, and technological advances.)\n  \n# Notes\n- Headlines should ideally invoke immediate emotional responses of optimism or pessimism, simulating real financial impacts.\n- Keep the headlines in line with typical news formats—short, descriptive, and informative.\n- Avoid overly sensational or unrealistic headlines for better immersion in the trading game scenario."
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "Generate news headlines"
-                }
-            ]
-            },
-            {
-            "role": "assistant",
-            "content": [
-                {
-                "type": "text",
-                "text": "{\n  \"headlines\": [\n    \"Emerging markets rally as new trade deal expands opportunities across South America\",\n    \"Escalating tensions in the Middle East disrupts global oil supply, causing market volatility\",\n    \"Surging demand for green technology fuels robust growth in renewable energy stocks worldwide\"\n  ]\n}"
-                }
-            ]
-            },
-            {
-            "role": "user",
-            "content": [
-                {
-                "type": "text",
-                "text": "Generate news headlines"
-                }
-            ]
-            }
-        ],
-        temperature=1,
-        max_tokens=2000,
-        top_p=1,
-        frequency_penalty=0,
-        presence_penalty=0,
-        response_format={
-            "type": "json_object"
-        }
-    )
-    return json.loads(response_two.choices[0].message.content)
+def generate_batch_news_headlines(tickers, include_global=False, variant=0):
+    news_request = {"tickers": tickers, "include_global": include_global}
+    return chat_completion_json('company_news_batch', variant, news_request)
+
+def generate_round_news(num_articles, include_global=False, variant=0):
+    # num_articles maps ticker -> how many headlines that ticker gets this round.
+    # Tickers missing from the batched reply (or a reply that isn't JSON) fall
+    # back to the one-ticker generate_company_news call.
+    tickers = list(num_articles)
+    try:
+        response = generate_batch_news_headlines(tickers, include_global, variant)
+    except Exception as e:
+        print('Batch news failed: %s' % e)
+        response = {}
+    companies = response.get('companies') if isinstance(response, dict) else None
+    if not isinstance(companies, dict):
+        companies = {}
+
+    company_news = {}
+    for ticker in tickers:
+        headlines = companies.get(ticker)
+        if is_headline_list(headlines):
+            company_news[ticker] = headlines[:num_articles[ticker]]
+        else:
+            company_news[ticker] = generate_company_news(ticker, num_articles[ticker], variant)
+
+    global_news = None
+    if include_global:
+        global_news = response.get('global') if isinstance(response, dict) else None
+        if not is_headline_list(global_news):
+            global_news = generate_global_news(variant)
+    return company_news, global_news
+
+def user_display_name(user):
+    return user.display_name if user.display_name else user.email.split('@')[0]
+
+def cache_display_name(uid, name):
+    with display_name_lock:
+        display_name_cache[uid] = (name, time.time())
+
+def cached_display_name(uid):
+    with display_name_lock:
+        entry = display_name_cache.get(uid)
+    if entry is None or time.time() - entry[1] > DISPLAY_NAME_TTL:
+        return None
+    return entry[0]
+
+def get_display_name(uid):
+    name = cached_display_name(uid)
+    if name is None:
+        with metrics.timed(metrics.AUTH_SECONDS, metrics.AUTH_ERRORS, call='get_user'):
+            user = firebase_auth.get_user(uid)
+        name = user_display_name(user)
+        cache_display_name(uid, name)
+    return name
+
+def resolve_display_names(uids, room_names):
+    # Names stored on the room at join time come first, then the process
+    # cache, and whatever is still missing is fetched in one get_users call
+    names = {}
+    missing = []
+    for uid in uids:
+        name = room_names.get(uid) or cached_display_name(uid)
+        if name is None:
+            missing.append(uid)
+        else:
+            names[uid] = name
+
+    for start in range(0, len(missing), 100):  # get_users takes at most 100 identifiers
+        try:
+            with metrics.timed(metrics.AUTH_SECONDS, metrics.AUTH_ERRORS, call='get_users'):
+                result = firebase_auth.get_users([firebase_auth.UidIdentifier(uid) for uid in missing[start:start + 100]])
+        except Exception as e:
+            print('Failed to look up display names for %d players: %s' % (len(missing[start:start + 100]), e))
+            continue
+        for user in result.users:
+            names[user.uid] = user_display_name(user)
+            cache_display_name(user.uid, names[user.uid])
+
+    for uid in uids:
+        names.setdefault(uid, "Unknown")
+    return names
 
 def say_hello():
     return 'Hello, World!'
 
-@app.route('/')
+@bp.route('/')
 @cross_origin()
 def index():
     return say_hello()
 
-@app.route('/hello/<name>')
+@bp.route('/hello/<name>')
 @cross_origin()
 def hello_name(name):
     return 'Hello, ' + name
 
-@app.route('/hello', methods=['POST'])
+@bp.route('/hello', methods=['POST'])
 @cross_origin()
 def hello():
     name = request.form['name']
     return 'Hello, ' + name
 
-def generate_company_news(ticker, num_articles):
-    headlines = generate_news_headlines(ticker)
-    return headlines['headlines'][:num_articles]
+def generate_company_news(ticker, num_articles, variant=0):
+    try:
+        headlines = generate_news_headlines(ticker, variant)
+        return headlines['headlines'][:num_articles]
+    except Exception as e:
+        if not LLM_LOCAL_FALLBACK:
+            raise
+        print('News for %s failed, using local headlines: %s' % (ticker, e))
+        llm_gateway.record_local_fallback('company_news')
+        return local_news.company_headlines(ticker, num_articles, variant)
+
+def generate_global_news(variant=0):
+    try:
+        headlines = generate_global_news_headline(variant)
+        return headlines['headlines']
+    except Exception as e:
+        if not LLM_LOCAL_FALLBACK:
+            raise
+        print('Global news failed, using local headlines: %s' % e)
+        llm_gateway.record_local_fallback('global_news')
+        return local_news.global_headlines(variant)
+
+def predict_next_price(stock):
+    prediction = simulate_stock_price({
+        "asset": stock['ticker'],
+        "current_price": stock['price'],
+        "news": stock['news']
+    })
+    return prediction['new_price']
 
-def generate_global_news():
-    headlines = generate_global_news_headline()
-    return headlines['headlines']
+# A price model takes the stocks carried over from the previous round (with
+# that round's news) and returns {ticker: new_price} for the next round
+
+def llm_price_model(stocks, previous_round, round_number):
+    # This round's prices depend on last round's news, so pricing can only
+    # fan out across tickers. Tickers the LLM couldn't price are priced by
+    # price_engine from the same news.
+    if PRICING_MODE == 'batch':
+        prices = predict_next_prices(stocks)
+    else:
+        prices = {}
+        price_futures = [submit_llm(predict_next_price, stock) for stock in stocks]
+        for stock, future in zip(stocks, price_futures):
+            try:
+                prices[stock['ticker']] = future.result()
+            except Exception as e:
+                print('Pricing %s failed: %s' % (stock['ticker'], e))
+
+    unpriced = [stock for stock in stocks if stock['ticker'] not in prices]
+    if unpriced:
+        if not LLM_LOCAL_FALLBACK:
+            raise RuntimeError('No price for %s' % ', '.join(stock['ticker'] for stock in unpriced))
+        llm_gateway.record_local_fallback('stock_price')
+        prices.update(price_engine.next_prices(
+            unpriced, previous_round, round_number, price_engine.VOLATILITY_BY_DIFFICULTY['medium'], LOCAL_FALLBACK_SEED
+        ))
+    return prices
+
+def local_price_model(volatility, seed):
+    def price_model(stocks, previous_round, round_number):
+        return price_engine.next_prices(stocks, previous_round, round_number, volatility, seed)
+    return price_model
+
+def room_volatility(room_data):
+    return price_engine.VOLATILITY_BY_DIFFICULTY.get(room_data.get('difficulty'), price_engine.VOLATILITY_BY_DIFFICULTY['medium'])
+
+def submit_round_news(num_articles, include_global, round_number=0):
+    # Starts the news requests for one round and returns a function that
+    # waits for them and gives back (company_news, global_news)
+    if NEWS_MODE == 'batch':
+        return submit_llm(generate_round_news, num_articles, include_global, round_number).result
+
+    news_futures = {
+        ticker: submit_llm(generate_company_news, ticker, count, round_number)
+        for ticker, count in num_articles.items()
+    }
+    global_news_future = submit_llm(generate_global_news, round_number) if include_global else None
+    return lambda: (
+        {ticker: future.result() for ticker, future in news_futures.items()},
+        global_news_future.result() if global_news_future is not None else None
+    )
 
-def simulate_market(previous_round=None):
+def simulate_market(previous_round=None, global_news_future=None, price_model=llm_price_model, round_number=0):
     if previous_round is None:
         stocks = get_top_stocks()
+    else:
+        stocks = previous_round['stocks']
+
+    # Draw article counts up front so the random sequence doesn't depend on
+    # which request finishes first. News only needs the tickers, so it is
+    # requested before pricing and the two overlap.
+    num_articles = {stock['ticker']: random.randint(1, 3) for stock in stocks}
+    collect_news = submit_round_news(num_articles, global_news_future is None, round_number)
+
+    if previous_round is None:
         interest_rate = round(random.uniform(0, 5), 2)
         inflation_rate = round(random.uniform(0, 5), 2)
         gdp_growth_rate = round(random.uniform(0, 5), 2)
     else:
-        stocks = previous_round['stocks']
+        new_prices = price_model(stocks, previous_round, round_number)
         for stock in stocks:
-            predict_next_price = simulate_stock_price({
-                "asset": stock['ticker'],
-                "current_price": stock['price'],
-                "news": stock['news']
-            })
-            stock['price'] = predict_next_price['new_price']
+            stock['price'] = new_prices[stock['ticker']]
         interest_rate = round(previous_round['interest_rate'] + random.uniform(-0.5, 0.5), 2)
         inflation_rate = round(previous_round['inflation_rate'] + random.uniform(-0.5, 0.5), 2)
         gdp_growth_rate = round(previous_round['gdp_growth_rate'] + random.uniform(-0.5, 0.5), 2)
 
+    company_news, global_news = collect_news()
+    if global_news_future is not None:
+        global_news = global_news_future.result()
+
     market_data = {
         'stocks': stocks,
         'interest_rate': interest_rate,
         'inflation_rate': inflation_rate,
         'gdp_growth_rate': gdp_growth_rate,
-        'global_news': generate_global_news()
+        'global_news': global_news
     }
 
     for stock in market_data['stocks']:
-        stock['news'] = generate_company_news(stock['ticker'], random.randint(1, 3))
+        stock['news'] = company_news[stock['ticker']]
 
     return market_data
 
 def generate_round_id():
     return ''.join(random.choices('0123456789ABCDEFGHIJKLMNOPQRSTUVWXYZ', k=6))
 
-def generate_all_rounds(rounds, time_per_round):
-    market_data = []
-    previous_round = None
-    for _ in range(rounds):
-        new_round = simulate_market(previous_round)
+def generate_all_rounds(rounds, time_per_round, price_model=llm_price_model, completed=None, on_round=None):
+    # completed continues a game from rounds generated earlier; on_round is
+    # called with each new round's index and data as soon as it's ready
+    market_data = list(completed or [])
+    first_round = len(market_data)
+
+    # Global headlines don't depend on anything, so request every round's up
+    # front. Batched news folds them into each round's news request instead.
+    # Each round's LLM calls get LLM_ROUND_DEADLINE from when they start.
+    global_news_futures = [None] * rounds
+    if NEWS_MODE != 'batch':
+        for round_number in range(first_round, rounds):
+            with deadline_after(LLM_ROUND_DEADLINE):
+                global_news_futures[round_number] = submit_llm(generate_global_news, round_number)
+
+    previous_round = copy.deepcopy(market_data[-1]) if market_data else None
+    for round_number in range(first_round, rounds):
+        with deadline_after(LLM_ROUND_DEADLINE):
+            new_round = simulate_market(previous_round, global_news_futures[round_number], price_model, round_number)
         new_round['round_id'] = generate_round_id()
         market_data.append(new_round)
+        if on_round is not None:
+            on_round(round_number, new_round)
         previous_round = copy.deepcopy(new_round)  # Make a deep copy of the round data
     return market_data
 
-@app.route('/create_room', methods=['POST'])
+def generate_next_round(previous_round, round_number, price_model=llm_price_model):
+    # One round following on from previous_round, for games whose rounds are
+    # generated as they're played
+    with deadline_after(LLM_ROUND_DEADLINE):
+        new_round = simulate_market(copy.deepcopy(previous_round), None, price_model, round_number)
+    new_round['round_id'] = generate_round_id()
+    return new_round
+
+def generate_local_rounds(rounds, volatility, seed, on_round=None):
+    # Same output as generate_all_rounds with local_price_model, but since
+    # prices don't wait on the LLM every round's news is requested at once
+    # and the whole price timeline comes out of a single price_engine call
+    stocks = get_top_stocks()
+    tickers = [stock['ticker'] for stock in stocks]
+    news_collectors = []
+    for round_number in range(rounds):
+        with deadline_after(LLM_ROUND_DEADLINE):
+            news_collectors.append(
+                submit_round_news({ticker: random.randint(1, 3) for ticker in tickers}, True, round_number)
+            )
+    round_news = []
+    for round_number, collect_news in enumerate(news_collectors):
+        round_news.append(collect_news())
+        if on_round is not None:
+            on_round(round_number, None)
+
+    macro = price_engine.simulate_macro_paths(rounds, seed)
+    prices = price_engine.simulate_price_paths(
+        [stock['price'] for stock in stocks],
+        price_engine.sentiment_matrix([company_news for company_news, _ in round_news[:-1]], tickers),
+        [price_engine.news_sentiment(global_news) for _, global_news in round_news[:-1]],
+        {key: values[:-1] for key, values in macro.items()},
+        volatility,
+        seed
+    )
+
+    market_data = []
+    for round_number, (company_news, global_news) in enumerate(round_news):
+        market_data.append({
+            'stocks': [{
+                'ticker': ticker,
+                'price': float(prices[round_number, column]),
+                'news': company_news[ticker]
+            } for column, ticker in enumerate(tickers)],
+            'interest_rate': float(macro['interest_rate'][round_number]),
+            'inflation_rate': float(macro['inflation_rate'][round_number]),
+            'gdp_growth_rate': float(macro['gdp_growth_rate'][round_number]),
+            'global_news': global_news,
+            'round_id': generate_round_id()
+        })
+    return market_data
+
+scenario_pool = ScenarioPool(
+    SCENARIO_POOL_DIR,
+    SCENARIO_POOL_ROUNDS,
+    SCENARIO_POOL_SIZE,
+    lambda rounds: generate_all_rounds(rounds, None),
+    max_age=SCENARIO_POOL_MAX_AGE
+)
+
+@bp.route('/create_room', methods=['POST'])
 @cross_origin()
+@require_id_token
 def create_room():
     data = request.get_json()
     game_code = data.get('gameCode')
     rounds = int(data.get('rounds'))  # Convert rounds to integer
     time_per_round = data.get('timePerRound')
     difficulty = data.get('difficulty')
-    id_token = data.get('idToken')
+
+    price_model = data.get('priceModel') or PRICE_MODEL_BY_DIFFICULTY.get(difficulty, 'llm')
 
     if not game_code:
         return jsonify({'error': 'Game code is required'}), 400
 
+    if price_model not in PRICE_MODELS:
+        return jsonify({'error': 'Invalid price model'}), 400
+
+    uid = g.uid
     try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        user = auth.get_user(uid)
-        display_name = user.display_name if user.display_name else user.email.split('@')[0]
+        display_name = get_display_name(uid)
     except Exception as e:
         return jsonify({'error': 'Invalid ID token'}), 401
 
-    room_ref = db.collection('rooms').document(game_code)
+    room_ref = get_room_ref(db, game_code)
     room_ref.set({
         'gameCode': game_code,
         'rounds': rounds,
         'timePerRound': int(time_per_round),
         'difficulty': difficulty,
+        'priceModel': price_model,
+        'seed': random.randrange(2 ** 32),
         'players': [display_name],
+        'playerNames': {uid: display_name},
         'authorizedPlayers': [uid],
         'createdBy': uid,
         'started': False
@@ -421,144 +713,383 @@ def create_room():
 
     return jsonify({'message': 'Room created', 'gameCode': game_code, 'roomId': room_ref.id}), 200
 
-@app.route('/get_room', methods=['GET'])
+@bp.route('/get_room', methods=['GET'])
 @cross_origin()
 def get_room():
     game_code = request.args.get('gameCode')
     if not game_code:
         return jsonify({'error': 'Game code is required'}), 400
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
-
-    room_data = room.to_dict()
+    room_data.pop('market_index', None)  # Holds every future price
     return jsonify(room_data), 200
 
-@app.route('/join_room', methods=['POST'])
+@bp.route('/join_room', methods=['POST'])
 @cross_origin()
+@require_id_token
 def join_room():
     data = request.get_json()
     game_code = data.get('gameCode')
-    id_token = data.get('idToken')
 
     if not game_code:
         return jsonify({'error': 'Game code is required'}), 400
 
+    uid = g.uid
     try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-        user = auth.get_user(uid)
-        display_name = user.display_name if user.display_name else user.email.split('@')[0]
+        display_name = get_display_name(uid)
     except Exception as e:
         return jsonify({'error': 'Invalid ID token'}), 401
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_ref = get_room_ref(db, game_code)
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
-
-    room_data = room.to_dict()
     if room_data.get('started'):
         return jsonify({'error': 'The game has already started', 'started': True}), 403
 
     if uid not in room_data['authorizedPlayers']:
         room_ref.update({
             'players': firestore.ArrayUnion([display_name]),
+            f'playerNames.{uid}': display_name,
             'authorizedPlayers': firestore.ArrayUnion([uid])
         })
+        room_cache.invalidate_room(game_code)
+        players = room_data['players'] + ([display_name] if display_name not in room_data['players'] else [])
+        publish_room_event(game_code, 'player_joined', {'player': display_name, 'players': players})
 
     return jsonify({'message': 'Joined room', 'gameCode': game_code, 'started': False}), 200
 
-@app.route('/start_game', methods=['POST'])
+class JobSuperseded(Exception):
+    pass
+
+def job_state(job):
+    # A start or round job, with status 'stalled' if it stopped reporting
+    if not job:
+        return None
+    job = dict(job)
+    if job['status'] in JOB_ACTIVE and time.time() - job['updatedAt'] > JOB_STALE_AFTER:
+        job['status'] = 'stalled'
+    return job
+
+def start_job_state(room_data):
+    return job_state(room_data.get('startJob'))
+
+def rounds_at_start(room_data):
+    # Progressive games start once their first round is ready
+    if ROUND_GENERATION == 'progressive' and room_data.get('priceModel') != 'local':
+        return min(1, room_data['rounds'])
+    return room_data['rounds']
+
+def start_job_progress(job):
+    done, total = job['roundsDone'], job['roundsTotal']
+    if job['status'] == 'done':
+        eta = 0
+    elif job.get('runningSince') and done > job.get('resumedRounds', 0):
+        seconds_per_round = (job['updatedAt'] - job['runningSince']) / (done - job.get('resumedRounds', 0))
+        eta = seconds_per_round * (total - done)
+    else:
+        eta = START_ROUND_SECONDS * (total - done)
+    progress = {
+        'id': job['id'],
+        'status': job['status'],
+        'roundsDone': done,
+        'roundsTotal': total,
+        'progress': round(100 * done / total) if total else 100,
+        'etaSeconds': round(eta)
+    }
+    if job.get('error'):
+        progress['error'] = job['error']
+    return progress
+
+@firestore.transactional
+def claim_start_job(transaction, room_ref, retry_failed):
+    # Returns (job, True) for a new job the caller has to run, or the job
+    # that's already going with False. Stalled jobs are always replaced;
+    # failed ones only when retry_failed is set.
+    room_data = room_ref.get(transaction=transaction).to_dict()
+    if room_data.get('started'):
+        return None, False
+    job = start_job_state(room_data)
+    if job is not None and (job['status'] in JOB_ACTIVE + ('done',) or (job['status'] == 'failed' and not retry_failed)):
+        return job, False
+
+    now = time.time()
+    resume = job is not None and job['status'] in ('stalled', 'failed')
+    new_job = {
+        'id': uuid.uuid4().hex,
+        'status': 'queued',
+        'roundsDone': job['roundsDone'] if resume else 0,
+        'roundsTotal': rounds_at_start(room_data),
+        'startedAt': now,
+        'updatedAt': now,
+        'resumeFrom': job['id'] if resume else None
+    }
+    transaction.update(room_ref, {'startJob': new_job})
+    return new_job, True
+
+@firestore.transactional
+def update_job(transaction, room_ref, job_key, job_id, updates):
+    # job_key is startJob or roundJob. False if another job took over, or
+    # for a start job, if the game already started.
+    room_data = room_ref.get(transaction=transaction).to_dict()
+    if (room_data.get(job_key) or {}).get('id') != job_id or (job_key == 'startJob' and room_data.get('started')):
+        return False
+    updates = dict(updates, updatedAt=time.time())
+    transaction.update(room_ref, {f'{job_key}.{key}': value for key, value in updates.items()})
+    return True
+
+def submit_start_job(game_code, retry_failed=False):
+    room_ref = get_room_ref(db, game_code)
+    job, is_new = claim_start_job(db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS), room_ref, retry_failed)
+    if is_new:
+        room_cache.invalidate_room(game_code)
+        game_start_executor.submit(run_start_job, game_code, job)
+    return job
+
+def run_start_job(game_code, job):
+    room_ref = get_room_ref(db, game_code)
+
+    def report(updates):
+        if not update_job(db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS), room_ref, 'startJob', job['id'], updates):
+            raise JobSuperseded()
+
+    try:
+        room_data = room_cache.get_room_data(game_code, fresh=True)
+        rounds = room_data['rounds']
+
+        if room_data.get('priceModel') == 'local':
+            report({'status': 'running', 'runningSince': time.time(), 'roundsDone': 0, 'resumedRounds': 0})
+            market_data = generate_local_rounds(
+                rounds, room_volatility(room_data), room_data['seed'],
+                on_round=lambda round_number, round_data: report({'roundsDone': round_number + 1})
+            )
+        else:
+            market_data = scenario_pool.take(rounds)
+            if market_data is None:
+                # Pick up where a dead or failed job left off; every round is
+                # saved as soon as it's generated
+                completed = []
+                if job.get('resumeFrom'):
+                    completed = take_over_pending_rounds(db, room_ref, job['resumeFrom'], job['id'])
+                report({'status': 'running', 'runningSince': time.time(),
+                        'roundsDone': len(completed), 'resumedRounds': len(completed)})
+
+                def save_round(round_number, round_data):
+                    write_pending_round(room_ref, job['id'], round_number, round_data)
+                    report({'roundsDone': round_number + 1})
+
+                market_data = generate_all_rounds(job['roundsTotal'], room_data['timePerRound'],
+                                                  completed=completed, on_round=save_round)
+
+        # Players can keep joining while the game is generated
+        room_data = room_cache.get_room_data(game_code, fresh=True)
+        portfolios = {}
+        for player_uid in room_data['authorizedPlayers']:
+            portfolios[player_uid] = {
+                'cash': STARTING_CASH,
+                'positions': {},
+                'value_history': [STARTING_CASH]
+            }
+
+        market_index = MarketIndex.from_rounds(market_data)
+        report({'roundsDone': len(market_data), 'status': 'writing'})
+        room_updates = {'startJob.status': 'done', 'startJob.updatedAt': time.time()}
+        progressive = len(market_data) < rounds
+        if progressive:
+            room_updates['roundGeneration'] = 'progressive'
+        write_game(db, room_ref, market_data, portfolios, market_index, room_updates)
+        room_cache.invalidate_room(game_code)
+        room_cache.set_market_index(game_code, market_index)
+        room_cache.invalidate_portfolios(game_code)
+        try:
+            delete_pending_rounds(db, room_ref)
+        except Exception as e:
+            print('Failed to delete pending rounds of room %s: %s' % (game_code, e))
+
+        round_code = market_data[0]['round_id']
+        publish_room_event(game_code, 'game_started', {'gameCode': game_code, 'roundCode': round_code})
+        if progressive:
+            submit_round_job(game_code)
+    except JobSuperseded:
+        print('Start job %s for room %s was superseded' % (job['id'], game_code))
+    except Exception as e:
+        print('Start job %s for room %s failed: %s' % (job['id'], game_code, e))
+        try:
+            update_job(db.transaction(), room_ref, 'startJob', job['id'], {'status': 'failed', 'error': str(e)})
+        except Exception as e:
+            print('Failed to record start job failure: %s' % e)
+
+def rounds_played(room_data):
+    # Rounds every player has completed; everyone is on the round after
+    completed_rounds = room_data.get('completed_rounds', {})
+    total_players = len(room_data.get('authorizedPlayers', []))
+    played = 0
+    for round_id in room_data.get('round_ids', []):
+        if len(completed_rounds.get(round_id, [])) < total_players:
+            break
+        played += 1
+    return played
+
+def rounds_wanted(room_data):
+    # The round being played plus ROUND_LOOKAHEAD more, up to the game's length
+    return min(room_data['rounds'], rounds_played(room_data) + 1 + ROUND_LOOKAHEAD)
+
+def round_job_wanted(room_data):
+    # Whether a progressive game is short of rounds with no live round job
+    # generating them
+    if room_data.get('roundGeneration') != 'progressive':
+        return False
+    if len(room_data['round_ids']) >= rounds_wanted(room_data):
+        return False
+    job = job_state(room_data.get('roundJob'))
+    if job is None or job['status'] in ('done', 'stalled'):
+        return True
+    return job['status'] == 'failed' and time.time() - job['updatedAt'] >= ROUND_RETRY_DELAY
+
+def next_round_pending(room_data, round_code):
+    # round_code is the last round generated so far of a progressive game
+    # that has more to come, as opposed to the last round of the game
+    round_ids = room_data.get('round_ids', [])
+    return (room_data.get('roundGeneration') == 'progressive' and round_ids[-1:] == [round_code]
+            and len(round_ids) < room_data['rounds'])
+
+@firestore.transactional
+def claim_round_job(transaction, room_ref):
+    room_data = room_ref.get(transaction=transaction).to_dict()
+    if not round_job_wanted(room_data):
+        return None
+    now = time.time()
+    job = {'id': uuid.uuid4().hex, 'status': 'running', 'startedAt': now, 'updatedAt': now}
+    transaction.update(room_ref, {'roundJob': job})
+    return job
+
+@firestore.transactional
+def save_generated_round(transaction, room_ref, job_id, round_data):
+    # Adds a round from a round job to the game; None if another job took over
+    room_data = room_ref.get(transaction=transaction).to_dict()
+    if (room_data.get('roundJob') or {}).get('id') != job_id:
+        return None
+    market_index = MarketIndex.from_document(room_data['round_ids'], room_data['market_index']).with_round(round_data)
+    append_round(transaction, room_ref, round_data, market_index, {'roundJob.updatedAt': time.time()})
+    return market_index
+
+def submit_round_job(game_code, room_data=None):
+    # room_data, when the caller has it, saves a transaction in the common
+    # case where nothing needs generating
+    if room_data is not None and not round_job_wanted(room_data):
+        return
+    job = claim_round_job(db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS), get_room_ref(db, game_code))
+    if job is not None:
+        room_cache.invalidate_room(game_code)
+        game_start_executor.submit(run_round_job, game_code, job)
+
+def run_round_job(game_code, job):
+    room_ref = get_room_ref(db, game_code)
+    try:
+        room_data = room_cache.get_room_data(game_code, fresh=True)
+        while len(room_data['round_ids']) < rounds_wanted(room_data):
+            round_ids = room_data['round_ids']
+            previous_round = room_cache.get_round(game_code, round_ids[-1])
+            new_round = generate_next_round(previous_round, len(round_ids))
+            market_index = save_generated_round(db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS),
+                                                room_ref, job['id'], new_round)
+            if market_index is None:
+                raise JobSuperseded()
+            room_cache.invalidate_room(game_code)
+            room_cache.set_market_index(game_code, market_index)
+
+            room_data = room_cache.get_room_data(game_code, fresh=True)
+            if rounds_played(room_data) == len(round_ids):
+                # Everyone already finished the round before and is waiting on this one
+                publish_room_event(game_code, 'round_ended', {
+                    'roundCode': round_ids[-1],
+                    'allUsersCompleted': True,
+                    'newRoundCode': new_round['round_id']
+                })
+        update_job(db.transaction(), room_ref, 'roundJob', job['id'], {'status': 'done'})
+        room_cache.invalidate_room(game_code)
+    except JobSuperseded:
+        print('Round job %s for room %s was superseded' % (job['id'], game_code))
+    except Exception as e:
+        print('Round job %s for room %s failed: %s' % (job['id'], game_code, e))
+        try:
+            update_job(db.transaction(), room_ref, 'roundJob', job['id'], {'status': 'failed', 'error': str(e)})
+            room_cache.invalidate_room(game_code)
+        except Exception as e:
+            print('Failed to record round job failure: %s' % e)
+
+@bp.route('/start_game', methods=['POST'])
 @cross_origin()
+@require_id_token
 def start_game():
     data = request.get_json()
     game_code = data.get('gameCode')
-    id_token = data.get('idToken')
 
     if not game_code:
         return jsonify({'error': 'Game code is required'}), 400
 
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-    except Exception as e:
-        return jsonify({'error': 'Invalid ID token'}), 401
+    uid = g.uid
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_data = room_cache.get_room_data(game_code, fresh=True)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
-
-    room_data = room.to_dict()
     if uid != room_data['createdBy']:
         return jsonify({'error': 'Only the room creator can start the game'}), 403
 
-    market_data = generate_all_rounds(room_data['rounds'], room_data['timePerRound'])
+    # The game is generated in the background; clients follow it through
+    # check_game_status (or the game_started event) until it has started
+    job = submit_start_job(game_code, retry_failed=True)
+    if job is None:
+        round_code = room_data['round_ids'][0] if room_data.get('round_ids') else None
+        return jsonify({'message': 'Game already started', 'gameCode': game_code, 'roundCode': round_code}), 200
+    return jsonify({'message': 'Game starting', 'gameCode': game_code, 'jobId': job['id'],
+                    'job': start_job_progress(job)}), 202
 
-    # Initialize portfolios
-    portfolios = {}
-    for player_uid in room_data['authorizedPlayers']:
-        portfolios[player_uid] = {
-            'cash': 100000,
-            'holdings': [],
-            'value_history': [100000]
-        }
-
-    room_ref.update({
-        'started': True,
-        'market_data': market_data,
-        'portfolios': portfolios
-    })
-    
-    # get the id of the first round and return it
-    round_code = market_data[0]['round_id']
-    return jsonify({'message': 'Game started', 'gameCode': game_code, 'roundCode': round_code}), 200
-
-@app.route('/check_game_status', methods=['GET'])
+@bp.route('/check_game_status', methods=['GET'])
 @cross_origin()
 def check_game_status():
     game_code = request.args.get('gameCode')
     if not game_code:
         return jsonify({'error': 'Game code is required'}), 400
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
-
-    room_data = room.to_dict()
     if room_data.get('started'):
-        round_code = room_data['market_data'][0]['round_id']
+        round_code = room_data['round_ids'][0]
         return jsonify({'started': True, 'gameCode': game_code, 'roundCode': round_code}), 200
-    else:
+
+    job = start_job_state(room_data)
+    if job is None:
         return jsonify({'started': False}), 200
+    if job['status'] == 'stalled':
+        # Whoever polls first restarts it, from the rounds it had saved
+        job = submit_start_job(game_code) or job
+    return jsonify({'started': False, 'job': start_job_progress(job)}), 200
 
 def get_top_stocks(n=10):
-    tickers = ['AAPL', 'MSFT', 'GOOGL', 'AMZN', 'META', 'TSLA', 'BRK-B', 'JNJ', 'V', 'WMT']
+    quotes = quote_cache.get()
     stocks = []
-    for ticker in tickers:
-        stock = yf.Ticker(ticker)
-        stock_history = stock.history(period='1d')
-        if not stock_history.empty:
-            stock_info = stock_history.iloc[-1]
+    for ticker in TOP_STOCK_TICKERS:
+        if ticker in quotes:
             stocks.append({
                 'ticker': ticker,
-                'price': round(stock_info['Close'], 2)
+                'price': round(quotes[ticker], 2)
             })
     return stocks[:n]
 
-@app.route('/stonks', methods=['GET'])
+@bp.route('/stonks', methods=['GET'])
 @cross_origin()
 def top_stocks():
     n = request.args.get('n', default=7, type=int)
     top_stocks = get_top_stocks(n)
     return jsonify(top_stocks), 200
 
-@app.route('/transact', methods=['POST'])
+@bp.route('/transact', methods=['POST'])
 @cross_origin()
+@require_id_token
 def transact():
     data = request.get_json()
     id_token = data.get('idToken')
@@ -579,30 +1110,58 @@ def transact():
     except ValueError:
         return jsonify({'error': 'Invalid amount'}), 400
 
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-    except Exception as e:
-        return jsonify({'error': 'Invalid ID token'}), 401
+    uid = g.uid
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_ref = get_room_ref(db, game_code)
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
 
-    room_data = room.to_dict()
     if uid not in room_data['authorizedPlayers']:
         return jsonify({'error': 'User not authorized in this room'}), 403
 
-    if round_index >= len(room_data['market_data']) or room_data['market_data'][round_index]['round_id'] != round_code:
+    round_ids = room_data.get('round_ids', [])
+    if round_index >= len(round_ids) or round_ids[round_index] != round_code:
         return jsonify({'error': 'Invalid round index or round code'}), 400
 
-    market_data = room_data['market_data'][round_index]
-    stock_price = next((stock['price'] for stock in market_data['stocks'] if stock['ticker'] == ticker), None)
+    stock_price = room_cache.get_market_index(game_code, room_data).price(round_code, ticker)
     if stock_price is None:
         return jsonify({'error': 'Stock not found in market data'}), 404
 
-    portfolio = room_data['portfolios'][uid]
+    transaction = db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS)
+    response = apply_transaction(transaction, get_portfolio_ref(room_ref, uid), round_code, ticker, operation, amount, stock_price)
+    room_cache.invalidate_portfolio(game_code, uid)
+    return response
+
+def save_positions(transaction, portfolio_ref, portfolio, positions):
+    updates = {'cash': portfolio['cash'], 'positions': positions}
+    if 'holdings' in portfolio:
+        updates['holdings'] = firestore.DELETE_FIELD  # Written before the ledger
+    transaction.update(portfolio_ref, updates)
+    portfolio.pop('holdings', None)
+    portfolio['positions'] = positions
+
+def log_trade(transaction, portfolio_ref, round_code, operation, ticker, shares, price, cash):
+    if TRADE_LOG:
+        transaction.set(portfolio_ref.collection('trades').document(), {
+            'round': round_code,
+            'operation': operation,
+            'ticker': ticker,
+            'shares': shares,
+            'price': price,
+            'cash': cash,
+            'time': firestore.SERVER_TIMESTAMP
+        })
+
+@firestore.transactional
+def apply_transaction(transaction, portfolio_ref, round_code, ticker, operation, amount, stock_price):
+    # Rounds never change once written, so only the portfolio needs to be
+    # read and written inside the transaction
+    portfolio_snapshot = portfolio_ref.get(transaction=transaction)
+    if not portfolio_snapshot.exists:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    portfolio = portfolio_snapshot.to_dict()
     cash = portfolio.get('cash', 0.0)
 
     # Calculate the transaction cost
@@ -619,25 +1178,21 @@ def transact():
     else:
         return jsonify({'error': 'Invalid operation'}), 400
 
-    # Append the transaction to holdings with a unique transaction ID
-    portfolio['holdings'].append({
-        'id': str(uuid.uuid4()),
-        'ticker': ticker,
-        'price': stock_price,
-        'shares': shares
-    })
+    # Add the shares to this ticker's long or short leg
+    positions = ledger.get_positions(portfolio)
+    ledger.apply_trade(positions, ticker, shares, stock_price)
 
     # Update the cash balance
     portfolio['cash'] = cash
 
-    # Save the updated portfolio back to the database
-    room_data['portfolios'][uid] = portfolio
-    room_ref.set(room_data)
+    save_positions(transaction, portfolio_ref, portfolio, positions)
+    log_trade(transaction, portfolio_ref, round_code, operation, ticker, shares, stock_price, cash)
 
-    return jsonify({'message': 'Transaction completed successfully', 'portfolio': portfolio}), 200
+    return jsonify({'message': 'Transaction completed successfully', 'portfolio': ledger.portfolio_view(portfolio)}), 200
 
-@app.route('/get_round_market_data', methods=['POST'])
+@bp.route('/get_round_market_data', methods=['POST'])
 @cross_origin()
+@require_id_token
 def get_round_market_data():
     data = request.get_json()
     game_code = data.get('gameCode')
@@ -647,53 +1202,40 @@ def get_round_market_data():
     if not all([game_code, round_code, id_token]):
         return jsonify({'error': 'Missing required parameters'}), 400
 
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-    except Exception as e:
-        return jsonify({'error': 'Invalid ID token'}), 401
+    uid = g.uid
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
 
-    room_data = room.to_dict()
-    
-    # Find the round index along with the market data
-    round_index = None
-    market_data = None
-    for idx, round_data in enumerate(room_data['market_data']):
-        if round_data['round_id'] == round_code:
-            round_index = idx
-            market_data = round_data.copy()  # Make a copy to avoid modifying original data
-            break
+    market_index = room_cache.get_market_index(game_code, room_data)
+    round_index = market_index.round_index.get(round_code) if market_index else None
+    if round_index is None:
+        return jsonify({'error': 'Round not found'}), 404
+
+    market_data = room_cache.get_round(game_code, round_code)
 
     if market_data is None:
         return jsonify({'error': 'Round not found'}), 404
 
-    # Add previous prices to stocks
+    # Add previous prices to stocks (same price for the first round)
     for stock in market_data['stocks']:
-        if round_index == 0:
-            stock['previous_price'] = stock['price']  # Same price for first round
-        else:
-            previous_round = room_data['market_data'][round_index - 1]
-            previous_stock = next((s for s in previous_round['stocks'] if s['ticker'] == stock['ticker']), None)
-            stock['previous_price'] = previous_stock['price'] if previous_stock else stock['price']
+        stock['previous_price'] = market_index.previous_price(round_code, stock['ticker'])
 
-    portfolio = room_data['portfolios'].get(uid)
-    if not portfolio:
+    portfolio = room_cache.get_portfolio(game_code, uid)
+    if portfolio is None:
         return jsonify({'error': 'Portfolio not found'}), 404
 
     return jsonify({
         'marketData': market_data, 
-        'portfolio': portfolio,
+        'portfolio': ledger.portfolio_view(portfolio),
         'roundIndex': round_index,
         'timePerRound': room_data['timePerRound']
     }), 200
 
-@app.route('/close_position', methods=['POST'])
+@bp.route('/close_position', methods=['POST'])
 @cross_origin()
+@require_id_token
 def close_position():
     data = request.get_json()
     id_token = data.get('idToken')
@@ -704,54 +1246,56 @@ def close_position():
     if not all([id_token, position_id, game_code, round_code]):
         return jsonify({'error': 'Missing required parameters'}), 400
 
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-    except Exception as e:
-        return jsonify({'error': 'Invalid ID token'}), 401
+    uid = g.uid
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_ref = get_room_ref(db, game_code)
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
 
-    room_data = room.to_dict()
-    market_data = next((round_data for round_data in room_data['market_data'] if round_data['round_id'] == round_code), None)
-    if not market_data:
+    market_index = room_cache.get_market_index(game_code, room_data)
+    if market_index is None or round_code not in market_index.round_index:
         return jsonify({'error': 'Round not found'}), 404
 
-    portfolio = room_data['portfolios'].get(uid)
-    if not portfolio:
+    transaction = db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS)
+    response = apply_close_position(transaction, get_portfolio_ref(room_ref, uid), position_id, market_index, round_code)
+    room_cache.invalidate_portfolio(game_code, uid)
+    return response
+
+@firestore.transactional
+def apply_close_position(transaction, portfolio_ref, position_id, market_index, round_code):
+    portfolio_snapshot = portfolio_ref.get(transaction=transaction)
+    if not portfolio_snapshot.exists:
         return jsonify({'error': 'Portfolio not found'}), 404
+    portfolio = portfolio_snapshot.to_dict()
 
-    position = next((pos for pos in portfolio['holdings'] if pos['id'] == position_id), None)
-    if not position:
+    # Positions are ids like AAPL:long, one per open leg of a ticker
+    positions = ledger.get_positions(portfolio)
+    ticker, side = ledger.parse_position_id(position_id)
+    if ticker not in positions:
         return jsonify({'error': 'Position not found'}), 404
 
-    stock_price = next((stock['price'] for stock in market_data['stocks'] if stock['ticker'] == position['ticker']), None)
+    stock_price = market_index.price(round_code, ticker)
     if stock_price is None:
         return jsonify({'error': 'Stock not found in market data'}), 404
 
-    # Calculate the value of the position
-    if position['shares'] < 0:
-        # Short position: calculate profit/loss based on price change
-        position_value = (position['price'] - stock_price) * abs(position['shares']) + position['price'] * abs(position['shares'])
-    else:
-        # Long position: calculate value based on current price
-        position_value = stock_price * position['shares']
+    shares = positions[ticker]['%s_shares' % side]
+    position_value = ledger.close_leg(positions, ticker, side, stock_price)
+    if position_value is None:
+        return jsonify({'error': 'Position not found'}), 404
 
     # Update the portfolio
     portfolio['cash'] += position_value
-    portfolio['holdings'] = [pos for pos in portfolio['holdings'] if pos['id'] != position_id]
 
-    # Save the updated portfolio back to the database
-    room_data['portfolios'][uid] = portfolio
-    room_ref.set(room_data)
+    save_positions(transaction, portfolio_ref, portfolio, positions)
+    log_trade(transaction, portfolio_ref, round_code, 'close', ticker, -shares if side == ledger.LONG else shares,
+              stock_price, portfolio['cash'])
 
-    return jsonify({'message': 'Position closed successfully', 'portfolio': portfolio}), 200
+    return jsonify({'message': 'Position closed successfully', 'portfolio': ledger.portfolio_view(portfolio)}), 200
 
-@app.route('/complete_round', methods=['POST'])
+@bp.route('/complete_round', methods=['POST'])
 @cross_origin()
+@require_id_token
 def complete_round():
     data = request.get_json()
     id_token = data.get('idToken')
@@ -761,49 +1305,91 @@ def complete_round():
     if not all([id_token, game_code, round_code]):
         return jsonify({'error': 'Missing required parameters'}), 400
 
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-    except Exception as e:
-        return jsonify({'error': 'Invalid ID token'}), 401
+    uid = g.uid
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_ref = get_room_ref(db, game_code)
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
 
-    room_data = room.to_dict()
-    portfolio = room_data['portfolios'].get(uid)
-    if not portfolio:
-        return jsonify({'error': 'Portfolio not found'}), 404
+    if uid not in room_data['authorizedPlayers']:
+        return jsonify({'error': 'User not authorized in this room'}), 403
 
-    # Calculate total portfolio value
-    total_value = portfolio['cash']
-    for holding in portfolio['holdings']:
-        stock_price = next((stock['price'] for stock in room_data['market_data'][-1]['stocks'] if stock['ticker'] == holding['ticker']), None)
-        if stock_price is not None:
-            if holding['shares'] < 0:
-                total_value += (holding['price'] - stock_price) * abs(holding['shares']) + holding['price'] * abs(holding['shares'])
-            else:
-                total_value += stock_price * holding['shares']
-
-    # Append total value to value_history
-    portfolio['value_history'].append(total_value)
-    room_data['portfolios'][uid] = portfolio
-
-    # Mark the user as having completed the round
-    if 'completed_rounds' not in room_data:
-        room_data['completed_rounds'] = {}
-    if round_code not in room_data['completed_rounds']:
-        room_data['completed_rounds'][round_code] = []
-    room_data['completed_rounds'][round_code].append(uid)
-
-    # Save the updated room data
-    room_ref.set(room_data)
+    market_index = room_cache.get_market_index(game_code, room_data)
+    if market_index is None or round_code not in market_index.round_index:
+        return jsonify({'error': 'Round not found'}), 404
 
+    transaction = db.transaction(max_attempts=TRANSACTION_MAX_ATTEMPTS)
+    portfolio = apply_complete_round(transaction, room_ref, uid, round_code, market_index)
+    room_cache.invalidate_room(game_code)
+    room_cache.invalidate_portfolio(game_code, uid)
+    if portfolio is None:
+        return jsonify({'error': 'Portfolio not found'}), 404
+
+    try:
+        publish_round_progress(game_code, uid, round_code, portfolio['value_history'])
+    except Exception as e:
+        print('Failed to publish round progress to room %s: %s' % (game_code, e))
+    # Ending a round moves the lookahead window of a progressive game on
+    submit_round_job(game_code, room_cache.get_room_data(game_code))
     return jsonify({'message': 'Round completed successfully'}), 200
 
-@app.route('/check_round_completion', methods=['POST'])
+@firestore.transactional
+def apply_complete_round(transaction, room_ref, uid, round_code, market_index):
+    portfolio_ref = get_portfolio_ref(room_ref, uid)
+    portfolio_snapshot = portfolio_ref.get(transaction=transaction)
+    if not portfolio_snapshot.exists:
+        return None
+    portfolio = portfolio_snapshot.to_dict()
+
+    # value_history holds the starting value and one value per round
+    # completed, so a retried or repeated completion changes nothing
+    if len(portfolio['value_history']) > market_index.round_index[round_code] + 1:
+        return portfolio
+
+    # Value the portfolio at the prices of the round just completed
+    total_value = float(valuation.mark_to_market(market_index, [portfolio], [round_code])[0, 0])
+
+    # Append the value to this player's history and mark them as done with
+    # the round, without touching anyone else's fields. ArrayUnion can't be
+    # used for the history since it drops repeated values.
+    portfolio['value_history'] = portfolio['value_history'] + [total_value]
+    transaction.update(portfolio_ref, {'value_history': portfolio['value_history']})
+    transaction.update(room_ref, {f'completed_rounds.{round_code}': firestore.ArrayUnion([uid])})
+    return portfolio
+
+def publish_round_progress(game_code, uid, round_code, value_history):
+    # One read of the room after the write, shared by everyone listening on
+    # /room_events, instead of every client polling check_round_completion
+    if not ROOM_EVENTS_ENABLED:
+        return
+    room_data = room_cache.get_room_data(game_code)
+    completed = room_data.get('completed_rounds', {}).get(round_code, [])
+    total_players = len(room_data['authorizedPlayers'])
+
+    publish_room_event(game_code, 'round_completed', {
+        'roundCode': round_code,
+        'completed': len(completed),
+        'total': total_players
+    })
+    previous_value = value_history[-2] if len(value_history) > 1 else value_history[-1]
+    publish_room_event(game_code, 'leaderboard', {
+        'player': room_data.get('playerNames', {}).get(uid) or get_display_name(uid),
+        'value': value_history[-1],
+        'change': value_history[-1] - previous_value
+    })
+    if len(completed) == total_players:
+        round_ended = {
+            'roundCode': round_code,
+            'allUsersCompleted': True,
+            'newRoundCode': room_cache.get_market_index(game_code, room_data).next_round_id(round_code)
+        }
+        if round_ended['newRoundCode'] is None and next_round_pending(room_data, round_code):
+            # The round job publishes round_ended again once it's generated
+            round_ended['pending'] = True
+        publish_room_event(game_code, 'round_ended', round_ended)
+
+@bp.route('/check_round_completion', methods=['POST'])
 @cross_origin()
 def check_round_completion():
     data = request.get_json()
@@ -813,77 +1399,129 @@ def check_round_completion():
     if not all([game_code, round_code]):
         return jsonify({'error': 'Missing required parameters'}), 400
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
-
-    room_data = room.to_dict()
     completed_rounds = room_data.get('completed_rounds', {}).get(round_code, [])
     all_users_completed = len(completed_rounds) == len(room_data['authorizedPlayers'])
 
     if all_users_completed:
-        current_round_index = next((index for index, round_data in enumerate(room_data['market_data']) if round_data['round_id'] == round_code), None)
-        if current_round_index is None or current_round_index + 1 >= len(room_data['market_data']):
-            return jsonify({'allUsersCompleted': True, 'newRoundCode': None}), 200
-
-        new_round_code = room_data['market_data'][current_round_index + 1]['round_id']
+        market_index = room_cache.get_market_index(game_code, room_data)
+        new_round_code = market_index.next_round_id(round_code) if market_index else None
+        if new_round_code is None and next_round_pending(room_data, round_code):
+            # Still being generated, not the end of the game. Retries a
+            # round job that failed or died.
+            submit_round_job(game_code, room_data)
+            return jsonify({'allUsersCompleted': True, 'newRoundCode': None, 'pending': True}), 200
         return jsonify({'allUsersCompleted': True, 'newRoundCode': new_round_code}), 200
     else:
         return jsonify({'allUsersCompleted': False}), 200
 
-@app.route('/leaderboard', methods=['GET'])
+@bp.route('/room_events', methods=['GET'])
 @cross_origin()
-def leaderboard():
+def room_event_stream():
+    if not ROOM_EVENTS_ENABLED:
+        return jsonify({'error': 'Room events are disabled'}), 404
     game_code = request.args.get('gameCode')
     if not game_code:
         return jsonify({'error': 'Game code is required'}), 400
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    # Subscribe before reading the room so nothing published in between is lost
+    subscriber = room_events.subscribe(game_code)
+    if subscriber is None:
+        return jsonify({'error': 'Too many open event streams'}), 503
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
+        room_events.unsubscribe(game_code, subscriber)
         return jsonify({'error': 'Room not found'}), 404
 
-    room_data = room.to_dict()
-    portfolios = room_data.get('portfolios', {})
+    snapshot = {
+        'players': room_data.get('players', []),
+        'started': bool(room_data.get('started')),
+        'roundCode': room_data['round_ids'][0] if room_data.get('round_ids') else None,
+        'completedRounds': {round_code: len(uids) for round_code, uids in room_data.get('completed_rounds', {}).items()},
+        'total': len(room_data.get('authorizedPlayers', []))
+    }
+
+    def stream():
+        try:
+            yield format_sse('snapshot', snapshot)
+            # A subscriber that fell too far behind is dropped by the broker;
+            # ending the stream makes EventSource reconnect and resync
+            while room_events.is_subscribed(game_code, subscriber):
+                try:
+                    event_type, event_data = subscriber.get(timeout=ROOM_EVENTS_KEEPALIVE)
+                except queue.Empty:
+                    yield ': keepalive\n\n'
+                    continue
+                yield format_sse(event_type, event_data)
+        finally:
+            room_events.unsubscribe(game_code, subscriber)
+
+    return Response(stream_with_context(stream()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+@bp.route('/leaderboard', methods=['GET'])
+@cross_origin()
+def leaderboard():
+    game_code = request.args.get('gameCode')
+    if not game_code:
+        return jsonify({'error': 'Game code is required'}), 400
+
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
+        return jsonify({'error': 'Room not found'}), 404
+    portfolios = room_cache.get_portfolios(game_code)
     authorized_players = room_data.get('authorizedPlayers', [])
+    player_names = resolve_display_names(authorized_players, room_data.get('playerNames', {}))
+    player_portfolios = [portfolios.get(uid, {}) for uid in authorized_players]
+    value_histories = [portfolio.get('value_history', []) for portfolio in player_portfolios]
+
+    # Players still on an earlier round are shown at what they'd record by
+    # completing the round in play now. A progressive game may not have
+    # generated all of its rounds yet.
+    round_ids = room_data.get('round_ids', [])
+    total_rounds = room_data.get('rounds', len(round_ids)) if round_ids else 0
+    market_index = room_cache.get_market_index(game_code, room_data)
+    if market_index is not None and player_portfolios:
+        round_in_play = round_ids[min(rounds_played(room_data), len(round_ids) - 1)]
+        live_values = valuation.mark_to_market(
+            market_index, player_portfolios, [round_in_play]
+        )[:, 0]
+    else:
+        live_values = [history[-1] if history else 0 for history in value_histories]
+    # One column for the starting value and one per round, so the value
+    # after the last round counts towards the final standings
+    columns = total_rounds + 1
+    values = valuation.history_matrix(value_histories, columns, live_values)
+    stats = valuation.performance(values, STARTING_CASH)
 
-    leaderboard_data = []
     history_data = []
-
-    for round_index, round_data in enumerate(room_data['market_data']):
-        round_history = {'round': round_index + 1}
-        for uid in authorized_players:
-            try:
-                user = auth.get_user(uid)
-                player_name = user.display_name if user.display_name else user.email.split('@')[0]
-            except Exception as e:
-                player_name = "Unknown"
-            portfolio = portfolios.get(uid, {})
-            value_history = portfolio.get('value_history', [])
-            if round_index < len(value_history):
-                latest_value = value_history[round_index]
-                round_history[player_name] = latest_value
+    for column in range(columns):
+        round_history = {'round': column + 1}
+        for i, uid in enumerate(authorized_players):
+            if not math.isnan(values[i, column]):
+                round_history[player_names[uid]] = float(values[i, column])
         history_data.append(round_history)
 
+    current = min(max([len(history) for history in value_histories] + [1]), columns) - 1
     unique_leaderboard = {}
-    for uid in authorized_players:
-        try:
-            user = auth.get_user(uid)
-            player_name = user.display_name if user.display_name else user.email.split('@')[0]
-        except Exception as e:
-            player_name = "Unknown"
-        portfolio = portfolios.get(uid, {})
-        latest_value = portfolio.get('value_history', [])[-1] if portfolio.get('value_history') else 0
-        unique_leaderboard[player_name] = latest_value
+    for i, uid in enumerate(authorized_players):
+        unique_leaderboard[player_names[uid]] = {
+            'value': float(values[i, current]),
+            'rank': int(stats['rank'][i, current]),
+            'return': float(stats['total_return'][i]),
+            'maxDrawdown': float(stats['max_drawdown'][i])
+        }
 
-    sorted_leaderboard = sorted(unique_leaderboard.items(), key=lambda x: x[1], reverse=True)
-    leaderboard_data = [{'name': name, 'value': value} for name, value in sorted_leaderboard]
+    sorted_leaderboard = sorted(unique_leaderboard.items(), key=lambda x: x[1]['value'], reverse=True)
+    leaderboard_data = [dict(entry, name=name) for name, entry in sorted_leaderboard]
 
     return jsonify({'leaderboard': leaderboard_data, 'history': history_data}), 200
 
-@app.route('/check_user_round_completion', methods=['POST'])
+@bp.route('/check_user_round_completion', methods=['POST'])
 @cross_origin()
+@require_id_token
 def check_user_round_completion():
     data = request.get_json()
     game_code = data.get('gameCode')
@@ -893,27 +1531,123 @@ def check_user_round_completion():
     if not all([game_code, round_code, id_token]):
         return jsonify({'error': 'Missing required parameters'}), 400
 
-    try:
-        decoded_token = auth.verify_id_token(id_token)
-        uid = decoded_token['uid']
-    except Exception as e:
-        return jsonify({'error': 'Invalid ID token'}), 401
+    uid = g.uid
 
-    room_ref = db.collection('rooms').document(game_code)
-    room = room_ref.get()
-    if not room.exists:
+    room_data = room_cache.get_room_data(game_code)
+    if room_data is None:
         return jsonify({'error': 'Room not found'}), 404
-
-    room_data = room.to_dict()
     completed_rounds = room_data.get('completed_rounds', {}).get(round_code, [])
     user_completed = uid in completed_rounds
 
     return jsonify({'userCompleted': user_completed}), 200
 
-@app.route('/readines_check', methods=['GET', 'POST'])
+@bp.route('/auth_stats', methods=['GET'])
+@cross_origin()
+@require_admin_token
+def auth_stats():
+    return jsonify({'idTokenCache': id_token_cache.stats()}), 200
+
+@bp.route('/metrics', methods=['GET'])
+@require_admin_token
+def metrics_endpoint():
+    return Response(metrics.render(METRICS_DIR), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/profiles', methods=['GET'])
+@require_admin_token
+def list_profiles():
+    return jsonify({'profiles': request_profiler.summaries()}), 200
+
+@bp.route('/profiles/<profile_id>.<extension>', methods=['GET'])
+@require_admin_token
+def get_profile(profile_id, extension):
+    # .json summary, .collapsed stacks, or .prof and .txt for cprofile
+    path = request_profiler.artifact(profile_id, extension)
+    if path is None:
+        return jsonify({'error': 'Profile not found'}), 404
+    return send_file(path, as_attachment=extension == 'prof')
+
+@bp.route('/llm_stats', methods=['GET'])
+@cross_origin()
+@require_admin_token
+def llm_stats():
+    return jsonify({
+        'gateway': llm_gateway.stats(),
+        'cache': llm_cache.stats(),
+        'promptVersions': {name: prompt_version(name) for name in prompts.PROMPTS}
+    }), 200
+
+@bp.route('/room_cache_stats', methods=['GET'])
+@cross_origin()
+@require_admin_token
+def room_cache_stats():
+    return jsonify(room_cache.stats()), 200
+
+@bp.route('/readines_check', methods=['GET', 'POST'])
 @cross_origin()
 def readiness_check():
-    return jsonify({'status': 'ready'}), 200
+    return jsonify({
+        'status': 'ready',
+        'startupSeconds': startup_seconds,
+        'clients': {name: client.created_in for name, client in LAZY_CLIENTS.items()}
+    }), 200
+
+startup_seconds = None
+
+def start_request_timer():
+    g.request_started = time.perf_counter()
+
+def record_request_metrics(response):
+    # Labelled by route pattern, so /get_room?gameCode=... is one series
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        metrics.HTTP_REQUEST_SECONDS.observe(time.perf_counter() - started, method=request.method, route=route)
+    metrics.HTTP_REQUESTS.inc(method=request.method, route=route, status=response.status_code)
+    if response.status_code >= 500:
+        metrics.HTTP_ERRORS.inc(method=request.method, route=route)
+    return response
+
+def start_profile():
+    mode = request.headers.get('X-Profile')
+    if mode and has_admin_token():
+        mode = 'cprofile' if mode == 'cprofile' else 'sample'
+    elif request_profiler.sampled():
+        mode = 'sample'
+    else:
+        return
+    route = request.url_rule.rule if request.url_rule is not None else 'unmatched'
+    g.profile = request_profiler.start(mode, request.method, request.path, route)
+
+def finish_profile(response):
+    profile = g.pop('profile', None)
+    if profile is not None:
+        request_profiler.finish(profile, response.status_code)
+        response.headers['X-Profile-Id'] = profile.id
+    return response
+
+def create_app(start_background_jobs=True, **overrides):
+    # overrides replaces any of LAZY_CLIENTS by name, e.g. with local fakes
+    # for Firestore, Firebase Auth and OpenAI. Background jobs (the scenario
+    # pool) aren't started for apps that only serve requests, like tests.
+    global startup_seconds
+    for name, client in overrides.items():
+        LAZY_CLIENTS[name].override(client)
+
+    app = Flask(__name__)
+    CORS(app)
+    app.register_blueprint(bp)
+    app.before_request(start_request_timer)
+    app.before_request(start_profile)
+    app.after_request(record_request_metrics)
+    app.after_request(finish_profile)
+    if start_background_jobs:
+        scenario_pool.start()
+        if METRICS_DIR:
+            metrics.start_flushing(METRICS_DIR, METRICS_FLUSH_SECONDS)
+
+    startup_seconds = time.perf_counter() - IMPORT_STARTED
+    print('App ready %.2fs after import started' % startup_seconds)
+    return app
 
 if __name__ == '__main__':
-    app.run(debug=True)
\ No newline at end of file
+    create_app().run(debug=True)
\ No newline at end of file
@@ -0,0 +1,83 @@
+import math
+
+import numpy as np
+
+
+class MarketIndex:
+    # A game's market timeline as a dense rounds x tickers price matrix, with
+    # round_id -> row and ticker -> column lookups, so any price or previous
+    # price is two dict lookups and an array read. Built once when the game
+    # starts, stored flattened on the room document (Firestore can't hold
+    # nested arrays) and kept in memory by the room cache.
+
+    def __init__(self, round_ids, tickers, prices):
+        self.round_ids = list(round_ids)
+        self.tickers = list(tickers)
+        self.round_index = {round_id: i for i, round_id in enumerate(self.round_ids)}
+        self.ticker_column = {ticker: j for j, ticker in enumerate(self.tickers)}
+        self.prices = np.asarray(prices, dtype=float).reshape(len(self.round_ids), len(self.tickers))
+
+    @classmethod
+    def from_rounds(cls, market_data):
+        # market_data is the list of rounds in play order
+        tickers = []
+        for round_data in market_data:
+            for stock in round_data['stocks']:
+                if stock['ticker'] not in tickers:
+                    tickers.append(stock['ticker'])
+        column = {ticker: j for j, ticker in enumerate(tickers)}
+
+        prices = np.full((len(market_data), len(tickers)), np.nan)
+        for i, round_data in enumerate(market_data):
+            for stock in round_data['stocks']:
+                prices[i, column[stock['ticker']]] = stock['price']
+        return cls([round_data['round_id'] for round_data in market_data], tickers, prices)
+
+    @classmethod
+    def from_document(cls, round_ids, document):
+        prices = [np.nan if price is None else price for price in document['prices']]
+        return cls(round_ids, document['tickers'], prices)
+
+    def with_round(self, round_data):
+        # A new index with round_data added as the last round, for games
+        # whose rounds are generated as they're played. Tickers it lists for
+        # the first time get a column that's unpriced in earlier rounds.
+        tickers = self.tickers + [
+            stock['ticker'] for stock in round_data['stocks'] if stock['ticker'] not in self.ticker_column
+        ]
+        prices = np.full((len(self.round_ids) + 1, len(tickers)), np.nan)
+        prices[:-1, :len(self.tickers)] = self.prices
+        column = {ticker: j for j, ticker in enumerate(tickers)}
+        for stock in round_data['stocks']:
+            prices[-1, column[stock['ticker']]] = stock['price']
+        return MarketIndex(self.round_ids + [round_data['round_id']], tickers, prices)
+
+    def to_document(self):
+        return {
+            'tickers': self.tickers,
+            'prices': [None if math.isnan(price) else price for price in self.prices.ravel().tolist()]
+        }
+
+    def price(self, round_id, ticker):
+        i = self.round_index.get(round_id)
+        j = self.ticker_column.get(ticker)
+        if i is None or j is None or np.isnan(self.prices[i, j]):
+            return None
+        return float(self.prices[i, j])
+
+    def previous_price(self, round_id, ticker):
+        # Price in the round before; the first round, or a ticker that wasn't
+        # listed in the round before, reports its current price
+        i = self.round_index.get(round_id)
+        j = self.ticker_column.get(ticker)
+        if i is None or j is None:
+            return None
+        if i > 0 and not np.isnan(self.prices[i - 1, j]):
+            return float(self.prices[i - 1, j])
+        return self.price(round_id, ticker)
+
+    def next_round_id(self, round_id):
+        i = self.round_index.get(round_id)
+        if i is None or i + 1 >= len(self.round_ids):
+            return None
+        return self.round_ids[i + 1]
@@ -0,0 +1,308 @@
+import bisect
+import contextlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+from google.cloud.firestore_v1 import _helpers
+
+import profiling
+
+# Counters and histograms for /metrics in the Prometheus text format. Every
+# gunicorn worker keeps its own in memory and writes them to a file in a
+# shared directory every few seconds; /metrics adds up the files of the
+# other workers and the serving worker's live values, so a scrape sees the
+# whole instance whichever worker answers it. The directory is cleared when
+# gunicorn starts so a new run doesn't add on to the last one.
+
+DEFAULT_DIR = os.path.join(tempfile.gettempdir(), 'finsim_metrics')
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SLOW_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+
+REGISTRY = []
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels):
+        return json.dumps([str(labels[label]) for label in self.labels])
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def merge(value, other):
+        return value + other
+
+
+class Histogram(Counter):
+    kind = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS, phase=None):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+        self.phase = phase  # What timed() reports the time as to a request being profiled
+
+    def observe(self, value, **labels):
+        # Kept per bucket (plus one past the last), summed up when rendered
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[bisect.bisect_left(self.buckets, value)] += 1
+            counts[-1] += value
+
+    def snapshot(self):
+        with self._lock:
+            return {key: list(counts) for key, counts in self._values.items()}
+
+    @staticmethod
+    def merge(value, other):
+        return [a + b for a, b in zip(value, other)]
+
+
+@contextlib.contextmanager
+def timed(histogram, errors=None, phase=None, **labels):
+    # Observes how long the block took, failed or not, and counts failures
+    started = time.perf_counter()
+    try:
+        with profiling.phase(phase or histogram.phase):
+            yield
+    except Exception:
+        if errors is not None:
+            errors.inc(**labels)
+        raise
+    finally:
+        histogram.observe(time.perf_counter() - started, **labels)
+
+
+HTTP_REQUESTS = Counter('finsim_http_requests_total', 'HTTP requests served', ('method', 'route', 'status'))
+HTTP_REQUEST_SECONDS = Histogram('finsim_http_request_duration_seconds',
+                                 'Time to build the response, not counting streamed bodies', ('method', 'route'))
+HTTP_ERRORS = Counter('finsim_http_request_errors_total', 'HTTP requests answered with a 5xx', ('method', 'route'))
+
+FIRESTORE_RPC_SECONDS = Histogram('finsim_firestore_rpc_duration_seconds', 'Firestore RPCs, until the last result',
+                                  ('method',))
+FIRESTORE_ERRORS = Counter('finsim_firestore_rpc_errors_total', 'Firestore RPCs that failed', ('method',))
+FIRESTORE_READS = Counter('finsim_firestore_documents_read_total', 'Documents read from Firestore', ('source',))
+FIRESTORE_READ_BYTES = Counter('finsim_firestore_document_bytes_read_total',
+                               'Encoded size of documents read by gets and queries', ('source',))
+FIRESTORE_WRITES = Counter('finsim_firestore_documents_written_total', 'Document writes committed', ())
+FIRESTORE_WRITE_BYTES = Counter('finsim_firestore_document_bytes_written_total',
+                                'Encoded size of the document writes committed', ())
+
+AUTH_SECONDS = Histogram('finsim_auth_call_duration_seconds', 'Firebase Auth calls', ('call',), phase='auth')
+AUTH_ERRORS = Counter('finsim_auth_call_errors_total', 'Firebase Auth calls that failed', ('call',))
+
+LLM_SECONDS = Histogram('finsim_llm_request_duration_seconds', 'OpenAI requests, including failed ones',
+                        ('prompt', 'model'), buckets=SLOW_BUCKETS, phase='openai')
+LLM_ERRORS = Counter('finsim_llm_request_errors_total', 'OpenAI requests that failed', ('prompt', 'model'))
+LLM_TOKENS = Counter('finsim_llm_tokens_total', 'OpenAI tokens used', ('prompt', 'model', 'kind'))
+
+QUOTE_FETCH_SECONDS = Histogram('finsim_quote_fetch_duration_seconds', 'yfinance quote downloads', (),
+                                buckets=SLOW_BUCKETS, phase='yfinance')
+QUOTE_FETCH_ERRORS = Counter('finsim_quote_fetch_errors_total', 'yfinance quote downloads that failed', ())
+
+
+def count_read_stream(responses, method, source, field, started):
+    # Passes the RPC's responses through, counting the documents in them as
+    # they arrive. The RPC is timed until the stream ends or is dropped; a
+    # profile only counts the time spent waiting for the next response.
+    responses = iter(responses)
+    try:
+        while True:
+            with profiling.phase('firestore_get'):
+                response = next(responses, None)
+            if response is None:
+                break
+            if response._pb.HasField(field):
+                FIRESTORE_READS.inc(source=source)
+                FIRESTORE_READ_BYTES.inc(getattr(response._pb, field).ByteSize(), source=source)
+            yield response
+    except Exception:
+        FIRESTORE_ERRORS.inc(method=method)
+        raise
+    finally:
+        FIRESTORE_RPC_SECONDS.observe(time.perf_counter() - started, method=method)
+
+
+def instrument_decoding():
+    # Times turning documents into Python values for profiles. Gets, queries
+    # and listeners all decode through _helpers.decode_dict, which also calls
+    # itself for nested maps; only the outermost call is timed. _helpers is
+    # private, so if decode_dict is gone decoding just isn't timed.
+    decode_dict = getattr(_helpers, 'decode_dict', None)
+    if decode_dict is None:
+        print('Warning: google.cloud.firestore_v1._helpers.decode_dict not found, '
+              'Firestore decoding will not be profiled')
+        return
+    if getattr(decode_dict, 'instrumented', False):
+        return
+
+    def wrapper(*args, **kwargs):
+        profile = profiling.current_profile.get()
+        if profile is None or profile.current_phase() == 'firestore_decode':
+            return decode_dict(*args, **kwargs)
+        with profiling.phase('firestore_decode'):
+            return decode_dict(*args, **kwargs)
+    wrapper.instrumented = True
+    _helpers.decode_dict = wrapper
+
+
+def instrument_firestore(client):
+    # Wraps the RPCs of the client's API stub, which every get, query, batch
+    # and transaction goes through. Snapshot listeners have their own RPC;
+    # their callbacks count what they receive with FIRESTORE_READS.
+    instrument_decoding()
+    api = client._firestore_api
+
+    def reads(method, source, field):
+        call = getattr(api, method)
+
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                with profiling.phase('firestore_get'):
+                    responses = call(*args, **kwargs)
+            except Exception:
+                FIRESTORE_ERRORS.inc(method=method)
+                FIRESTORE_RPC_SECONDS.observe(time.perf_counter() - started, method=method)
+                raise
+            return count_read_stream(responses, method, source, field, started)
+        setattr(api, method, wrapper)
+
+    def timed_call(method):
+        call = getattr(api, method)
+
+        def wrapper(*args, **kwargs):
+            with timed(FIRESTORE_RPC_SECONDS, FIRESTORE_ERRORS, 'firestore_transaction', method=method):
+                return call(*args, **kwargs)
+        setattr(api, method, wrapper)
+
+    commit = api.commit
+
+    def commit_wrapper(*args, request=None, **kwargs):
+        writes = (request or {}).get('writes') or []
+        with timed(FIRESTORE_RPC_SECONDS, FIRESTORE_ERRORS, 'firestore_set', method='commit'):
+            response = commit(*args, request=request, **kwargs)
+        FIRESTORE_WRITES.inc(len(writes))
+        FIRESTORE_WRITE_BYTES.inc(sum(getattr(write, '_pb', write).ByteSize() for write in writes))
+        return response
+
+    reads('batch_get_documents', 'get', 'found')
+    reads('run_query', 'query', 'document')
+    timed_call('begin_transaction')
+    timed_call('rollback')
+    api.commit = commit_wrapper
+    return client
+
+
+def snapshot():
+    return {metric.name: metric.snapshot() for metric in REGISTRY}
+
+
+def snapshot_path(directory, pid=None):
+    return os.path.join(directory, '%d.json' % (pid or os.getpid()))
+
+
+def write_snapshot(directory):
+    os.makedirs(directory, exist_ok=True)
+    path = snapshot_path(directory)
+    with open(path + '.tmp', 'w') as f:
+        json.dump(snapshot(), f)
+    os.replace(path + '.tmp', path)
+
+
+def start_flushing(directory, interval):
+    def flush():
+        while True:
+            time.sleep(interval)
+            try:
+                write_snapshot(directory)
+            except Exception as e:
+                print('Failed to write metrics: %s' % e)
+    threading.Thread(target=flush, daemon=True, name='metrics-flush').start()
+
+
+def clear(directory):
+    shutil.rmtree(directory, ignore_errors=True)
+
+
+def collect(directory=None):
+    # This process's values plus every other worker's latest file
+    snapshots = [snapshot()]
+    if directory and os.path.isdir(directory):
+        own = os.path.basename(snapshot_path(directory))
+        for name in os.listdir(directory):
+            if name.endswith('.json') and name != own:
+                try:
+                    with open(os.path.join(directory, name)) as f:
+                        snapshots.append(json.load(f))
+                except (OSError, ValueError):
+                    continue  # Being replaced or gone
+
+    merged = {}
+    for metric in REGISTRY:
+        values = {}
+        for process in snapshots:
+            for key, value in process.get(metric.name, {}).items():
+                values[key] = metric.merge(values[key], value) if key in values else value
+        merged[metric.name] = values
+    return merged
+
+
+def escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (name, escape(value)) for name, value in pairs)
+
+
+def format_number(value):
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def render(directory=None):
+    merged = collect(directory)
+    lines = []
+    for metric in REGISTRY:
+        lines.append('# HELP %s %s' % (metric.name, metric.help))
+        lines.append('# TYPE %s %s' % (metric.name, metric.kind))
+        for key, value in sorted(merged[metric.name].items()):
+            label_values = json.loads(key)
+            if metric.kind == 'counter':
+                lines.append('%s%s %s' % (metric.name, format_labels(metric.labels, label_values), format_number(value)))
+                continue
+            cumulative = 0
+            for bound, count in zip(metric.buckets + (float('inf'),), value[:-1]):
+                cumulative += count
+                le = '+Inf' if bound == float('inf') else format_number(float(bound))
+                lines.append('%s_bucket%s %d' % (metric.name, format_labels(metric.labels, label_values, [('le', le)]),
+                                                 cumulative))
+            lines.append('%s_sum%s %s' % (metric.name, format_labels(metric.labels, label_values), format_number(value[-1])))
+            lines.append('%s_count%s %d' % (metric.name, format_labels(metric.labels, label_values), cumulative))
+    return '\n'.join(lines) + '\n'
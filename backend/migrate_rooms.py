@@ -0,0 +1,11 @@
+from google.cloud import firestore
+from google.oauth2 import service_account
+from room_store import migrate_all_rooms
+
+# Moves market_data and portfolios of rooms created before the sub-collection
+# layout out of the room document. Rooms are also migrated lazily the first
+# time the app reads them, so running this is optional.
+if __name__ == '__main__':
+    db_cred = service_account.Credentials.from_service_account_file('creds.json')
+    db = firestore.Client(credentials=db_cred)
+    print('Migrated %d rooms' % migrate_all_rooms(db))
@@ -0,0 +1,123 @@
+import re
+
+import numpy as np
+
+# Local alternative to the LLM pricing calls. Prices move with the sentiment
+# of each ticker's headlines, a market-wide term from the global headlines,
+# a drift from the macro numbers and seeded noise. Given the same news,
+# starting prices and seed it always produces the same price paths.
+
+POSITIVE_WORDS = {
+    'record', 'beats', 'beat', 'surge', 'surges', 'soars', 'soar', 'growth', 'grows', 'boost', 'boosts',
+    'rally', 'rallies', 'profit', 'profits', 'expands', 'expansion', 'launch', 'launches', 'unveils',
+    'breakthrough', 'partnership', 'partners', 'teams', 'acquires', 'wins', 'approved', 'approves',
+    'innovation', 'innovative', 'strong', 'robust', 'recovery', 'revival', 'booms', 'boom', 'increase',
+    'hiring', 'upgrade', 'success', 'successful', 'perfect', 'exceeds', 'surpasses', 'optimism', 'deal',
+}
+NEGATIVE_WORDS = {
+    'lawsuit', 'sued', 'sues', 'explosion', 'crash', 'crashes', 'fails', 'fail', 'failure', 'decline',
+    'declines', 'plunge', 'plunges', 'scandal', 'recall', 'backlash', 'stumbles', 'bugs', 'layoffs',
+    'loss', 'losses', 'probe', 'fined', 'fine', 'tensions', 'turmoil', 'dislike', 'delay', 'delays',
+    'outage', 'complain', 'breach', 'fraud', 'investigation', 'strike', 'shortage', 'sanctions',
+    'uncertainty', 'unrest', 'freefall', 'disrupts', 'disruption', 'volatility', 'conflict', 'recession',
+    'downgrade', 'bankruptcy', 'slump', 'concerns', 'losing', 'dumpster', 'escalating', 'weaken',
+}
+
+# How far a fully positive/negative news round moves a stock, and how much
+# the global headlines move the whole market
+SENTIMENT_IMPACT = 0.15
+GLOBAL_SENTIMENT_IMPACT = 0.05
+# Same cap the LLM prompt uses
+MAX_ROUND_RETURN = 0.4
+
+VOLATILITY_BY_DIFFICULTY = {
+    'easy': 0.03,
+    'medium': 0.06,
+    'hard': 0.10,
+}
+
+
+def headline_sentiment(headline):
+    words = re.findall(r"[a-z]+", headline.lower())
+    positive = sum(1 for word in words if word in POSITIVE_WORDS)
+    negative = sum(1 for word in words if word in NEGATIVE_WORDS)
+    if positive + negative == 0:
+        return 0.0
+    return (positive - negative) / (positive + negative)
+
+
+def news_sentiment(headlines):
+    if not headlines:
+        return 0.0
+    return sum(headline_sentiment(headline) for headline in headlines) / len(headlines)
+
+
+def sentiment_matrix(company_news, tickers):
+    # company_news is one {ticker: [headlines]} dict per round
+    return np.array([
+        [news_sentiment(round_news.get(ticker, [])) for ticker in tickers]
+        for round_news in company_news
+    ], dtype=float).reshape(len(company_news), len(tickers))
+
+
+def simulate_macro_paths(rounds, seed):
+    # Same process simulate_market uses: a uniform 0-5% start, then a
+    # +/-0.5 point random walk per round
+    rng = np.random.default_rng([seed, 0])
+    start = rng.uniform(0, 5, size=3)
+    steps = rng.uniform(-0.5, 0.5, size=(max(rounds - 1, 0), 3))
+    paths = np.round(np.vstack([start, start + np.cumsum(steps, axis=0)]), 2)
+    return {
+        'interest_rate': paths[:, 0],
+        'inflation_rate': paths[:, 1],
+        'gdp_growth_rate': paths[:, 2],
+    }
+
+
+def macro_drift(interest_rate, inflation_rate, gdp_growth_rate):
+    # Growth above inflation lifts the market, rates above a neutral 2.5% weigh on it
+    return (np.asarray(gdp_growth_rate) - np.asarray(inflation_rate)) / 100 \
+        - (np.asarray(interest_rate) - 2.5) / 200
+
+
+def round_noise(seed, round_number, tickers, volatility):
+    # Each round draws from its own stream so a round priced on its own
+    # matches the same round priced as part of the whole timeline
+    return np.random.default_rng([seed, round_number]).normal(0.0, volatility, size=tickers)
+
+
+def simulate_price_paths(initial_prices, company_sentiment, global_sentiment, macro, volatility, seed, first_round=1):
+    # initial_prices: (tickers,), company_sentiment: (steps, tickers),
+    # global_sentiment: (steps,) and macro arrays: (steps,).
+    # Row r of the inputs sets the move into round first_round + r.
+    # Returns a (steps + 1, tickers) price matrix starting with initial_prices.
+    initial_prices = np.asarray(initial_prices, dtype=float)
+    company_sentiment = np.asarray(company_sentiment, dtype=float).reshape(-1, initial_prices.shape[0])
+    steps = company_sentiment.shape[0]
+
+    drift = macro_drift(macro['interest_rate'], macro['inflation_rate'], macro['gdp_growth_rate'])[:steps]
+    noise = np.array([
+        round_noise(seed, first_round + step, initial_prices.shape[0], volatility) for step in range(steps)
+    ]).reshape(company_sentiment.shape)
+    returns = SENTIMENT_IMPACT * company_sentiment \
+        + (GLOBAL_SENTIMENT_IMPACT * np.asarray(global_sentiment, dtype=float)[:steps] + drift)[:, None] \
+        + noise
+    returns = np.clip(returns, -MAX_ROUND_RETURN, MAX_ROUND_RETURN)
+
+    growth = np.vstack([np.ones((1, initial_prices.shape[0])), np.cumprod(1 + returns, axis=0)])
+    return np.round(initial_prices[None, :] * growth, 2)
+
+
+def next_prices(stocks, previous_round, round_number, volatility, seed):
+    # One step of simulate_price_paths for simulate_market's per-round path
+    tickers = [stock['ticker'] for stock in stocks]
+    prices = simulate_price_paths(
+        [stock['price'] for stock in stocks],
+        sentiment_matrix([{stock['ticker']: stock['news'] for stock in stocks}], tickers),
+        [news_sentiment(previous_round['global_news'])],
+        {key: [previous_round[key]] for key in ('interest_rate', 'inflation_rate', 'gdp_growth_rate')},
+        volatility,
+        seed,
+        first_round=round_number
+    )
+    return {ticker: float(price) for ticker, price in zip(tickers, prices[-1])}
@@ -0,0 +1,255 @@
+import contextlib
+import contextvars
+import cProfile
+import io
+import json
+import os
+import pstats
+import random
+import re
+import sys
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+# Opt-in profiling of single requests. A profile records where the request
+# thread's time went by phase (firestore_get, firestore_decode,
+# firestore_set, firestore_transaction, auth, openai, yfinance; whatever is
+# left over is compute) plus either sampled stacks, saved as collapsed stacks
+# for flamegraph tools, or a full cProfile. Phases are reported by the
+# instrumented calls in metrics.py through current_profile, including from
+# work the request hands to other threads with contextvars.copy_context,
+# which is kept apart because it overlaps the request's own time.
+
+current_profile = contextvars.ContextVar('current_profile', default=None)
+
+
+@contextlib.contextmanager
+def phase(name):
+    profile = current_profile.get()
+    if profile is None:
+        yield
+        return
+    with profile.phase(name):
+        yield
+
+
+class Profile:
+    def __init__(self, mode, method, path, route):
+        self.id = uuid.uuid4().hex[:16]
+        self.mode = mode
+        self.method = method
+        self.path = path
+        self.route = route
+        self.started_at = datetime.now(timezone.utc)
+        self.thread_id = threading.get_ident()
+        self.phases = {}  # Request thread, each phase excluding the phases inside it
+        self.concurrent = {}  # Other threads working for the request
+        self.samples = {}  # Collapsed stack -> count
+        self.profiler = None
+        self._open = []  # [name, started, seconds in nested phases] on the request thread
+        self._lock = threading.Lock()
+        self._started = time.perf_counter()
+        self._cpu_started = time.thread_time()
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        started = time.perf_counter()
+        if threading.get_ident() != self.thread_id:
+            try:
+                yield
+            finally:
+                with self._lock:
+                    self.concurrent[name] = self.concurrent.get(name, 0) + time.perf_counter() - started
+            return
+
+        entry = [name, started, 0.0]
+        self._open.append(entry)
+        try:
+            yield
+        finally:
+            self._open.pop()
+            elapsed = time.perf_counter() - started
+            with self._lock:
+                self.phases[name] = self.phases.get(name, 0) + elapsed - entry[2]
+            if self._open:
+                self._open[-1][2] += elapsed
+
+    def current_phase(self):
+        # Innermost phase open on the calling thread, if it's the request's
+        if self._open and threading.get_ident() == self.thread_id:
+            return self._open[-1][0]
+        return None
+
+    def add_sample(self, stack):
+        with self._lock:
+            self.samples[stack] = self.samples.get(stack, 0) + 1
+
+    def summary(self, status, wall, cpu):
+        with self._lock:
+            phases = {name: round(seconds, 6) for name, seconds in self.phases.items()}
+            phases['compute'] = round(max(0.0, wall - sum(self.phases.values())), 6)
+            return {
+                'id': self.id,
+                'mode': self.mode,
+                'method': self.method,
+                'path': self.path,
+                'route': self.route,
+                'status': status,
+                'startedAt': self.started_at.isoformat(),
+                'wallSeconds': round(wall, 6),
+                'cpuSeconds': round(cpu, 6),
+                'phases': phases,
+                'concurrentPhases': {name: round(seconds, 6) for name, seconds in self.concurrent.items()},
+                'samples': sum(self.samples.values()),
+            }
+
+
+def stack_key(frame):
+    # Root first, one module:function per frame, as flamegraph.pl and
+    # speedscope expect collapsed stacks
+    names = []
+    while frame is not None:
+        code = frame.f_code
+        names.append('%s:%s' % (frame.f_globals.get('__name__', '?'), getattr(code, 'co_qualname', code.co_name)))
+        frame = frame.f_back
+    return ';'.join(reversed(names)).replace(' ', '_')
+
+
+class Sampler:
+    # One thread samples the stacks of every request being profiled, and
+    # only runs while there is one
+    def __init__(self, interval):
+        self.interval = interval
+        self._targets = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def add(self, profile):
+        with self._lock:
+            self._targets[profile.thread_id] = profile
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, daemon=True, name='profile-sampler')
+                self._thread.start()
+
+    def remove(self, profile):
+        with self._lock:
+            if self._targets.get(profile.thread_id) is profile:
+                del self._targets[profile.thread_id]
+
+    def _run(self):
+        try:
+            while True:
+                time.sleep(self.interval)
+                with self._lock:
+                    if not self._targets:
+                        self._thread = None
+                        return
+                    targets = list(self._targets.items())
+                frames = sys._current_frames()
+                for thread_id, profile in targets:
+                    frame = frames.get(thread_id)
+                    if frame is not None:
+                        profile.add_sample(stack_key(frame))
+        finally:
+            # If sampling failed, let the next profile start a new thread
+            with self._lock:
+                if self._thread is threading.current_thread():
+                    self._thread = None
+
+
+class RequestProfiler:
+    # Starts and finishes profiles and keeps the latest `keep` of them in
+    # directory as <id>.json (summary) and <id>.collapsed (sample mode) or
+    # <id>.prof and <id>.txt (cprofile mode)
+
+    def __init__(self, directory, keep=200, sample_interval=0.005, sample_rate=0.0):
+        self.directory = directory
+        self.keep = keep
+        self.sample_rate = sample_rate
+        self.sampler = Sampler(sample_interval)
+        self._random = random.Random()
+
+    def sampled(self):
+        return self.sample_rate > 0 and self._random.random() < self.sample_rate
+
+    def start(self, mode, method, path, route):
+        profile = Profile(mode, method, path, route)
+        if mode == 'cprofile':
+            profile.profiler = cProfile.Profile()
+            try:
+                profile.profiler.enable()
+            except ValueError:  # Another request is already being cProfiled
+                profile.profiler = None
+                profile.mode = 'sample'
+        if profile.mode == 'sample':
+            self.sampler.add(profile)
+        profile.token = current_profile.set(profile)
+        return profile
+
+    def finish(self, profile, status):
+        wall = time.perf_counter() - profile._started
+        cpu = time.thread_time() - profile._cpu_started
+        if profile.profiler is not None:
+            profile.profiler.disable()
+        self.sampler.remove(profile)
+        current_profile.reset(profile.token)
+
+        summary = profile.summary(status, wall, cpu)
+        try:
+            self.save(profile, summary)
+        except OSError as e:
+            print('Failed to save profile %s: %s' % (profile.id, e))
+        return summary
+
+    def path(self, profile_id, extension):
+        return os.path.join(self.directory, '%s.%s' % (profile_id, extension))
+
+    def save(self, profile, summary):
+        os.makedirs(self.directory, exist_ok=True)
+        if profile.profiler is not None:
+            profile.profiler.dump_stats(self.path(profile.id, 'prof'))
+            text = io.StringIO()
+            pstats.Stats(profile.profiler, stream=text).sort_stats('cumulative').print_stats(40)
+            with open(self.path(profile.id, 'txt'), 'w') as f:
+                f.write(text.getvalue())
+        else:
+            with open(self.path(profile.id, 'collapsed'), 'w') as f:
+                for stack, count in sorted(profile.samples.items()):
+                    f.write('%s %d\n' % (stack, count))
+        with open(self.path(profile.id, 'json'), 'w') as f:
+            json.dump(summary, f, indent=2)
+        self.prune()
+
+    def summaries(self):
+        # Newest first
+        if not os.path.isdir(self.directory):
+            return []
+        paths = [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith('.json')]
+        summaries = []
+        for path in sorted(paths, key=os.path.getmtime, reverse=True):
+            try:
+                with open(path) as f:
+                    summaries.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+        return summaries
+
+    def prune(self):
+        profiles = sorted(
+            (name[:-len('.json')] for name in os.listdir(self.directory) if name.endswith('.json')),
+            key=lambda profile_id: os.path.getmtime(self.path(profile_id, 'json')),
+            reverse=True
+        )
+        for profile_id in profiles[self.keep:]:
+            for extension in ('json', 'collapsed', 'prof', 'txt'):
+                with contextlib.suppress(OSError):
+                    os.remove(self.path(profile_id, extension))
+
+    def artifact(self, profile_id, extension):
+        # Path of a saved artifact, or None
+        if not re.fullmatch(r'[0-9a-f]+', profile_id) or extension not in ('json', 'collapsed', 'prof', 'txt'):
+            return None
+        path = self.path(profile_id, extension)
+        return path if os.path.exists(path) else None
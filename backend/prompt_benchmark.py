@@ -0,0 +1,159 @@
+import argparse
+import json
+import os
+import time
+
+from dotenv import load_dotenv
+
+import prompts
+
+# Compares the versions of each prompt in prompts.py on the inputs in
+# prompt_fixtures/<prompt>.json. Prompt tokens are counted offline (with
+# tiktoken when it can load gpt-4o-mini's encoding, estimated from the length
+# otherwise). Latency, reply tokens and how many replies were JSON the game
+# can use come from the replies recorded for each version, so comparing
+# versions doesn't cost anything once they're recorded:
+#
+#   python prompt_benchmark.py                                   # recorded replies
+#   python prompt_benchmark.py --live --record                   # call OpenAI, save the replies
+#   python prompt_benchmark.py --prompt stock_price --versions 2 --live --repeat 3
+#
+# A reply cut off by max_tokens counts as invalid, so a response cap that's
+# too tight shows up as invalid and truncated replies.
+
+FIXTURES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'prompt_fixtures')
+
+
+def fixture_path(name):
+    return os.path.join(FIXTURES_DIR, name + '.json')
+
+
+def load_fixture(name):
+    with open(fixture_path(name)) as f:
+        return json.load(f)
+
+
+def save_fixture(name, fixture):
+    with open(fixture_path(name), 'w') as f:
+        json.dump(fixture, f, indent=2)
+        f.write('\n')
+
+
+def examples_ok(prompt):
+    # How many of the prompt's own few-shot answers are valid replies
+    ok = 0
+    for user, assistant in prompt.examples:
+        try:
+            example_input = json.loads(user)
+        except json.JSONDecodeError:
+            example_input = user
+        try:
+            ok += prompt.is_valid(example_input, assistant)
+        except Exception:
+            pass
+    return ok
+
+
+def record_reply(client, prompt, index, prompt_input):
+    started = time.perf_counter()
+    try:
+        response = client.chat.completions.create(**prompt.request(prompt_input))
+    except Exception as e:
+        return {'input': index, 'error': '%s: %s' % (type(e).__name__, e)}
+    choice = response.choices[0]
+    return {
+        'input': index,
+        'content': choice.message.content,
+        'finishReason': choice.finish_reason,
+        'latencyMs': round((time.perf_counter() - started) * 1000, 1),
+        'promptTokens': response.usage.prompt_tokens,
+        'completionTokens': response.usage.completion_tokens,
+    }
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] if values else None
+
+
+def summarize(prompt, inputs, replies):
+    prompt_tokens = [prompt.prompt_tokens(prompt_input) for prompt_input in inputs]
+    caps = [prompt.response_cap(prompt_input) for prompt_input in inputs]
+    answered = [reply for reply in replies if 'content' in reply]
+    latencies = [reply['latencyMs'] for reply in answered]
+    reply_tokens = [reply['completionTokens'] for reply in answered]
+    truncated = sum(1 for reply in answered if reply['finishReason'] == 'length')
+    valid = sum(1 for reply in answered
+                if reply['finishReason'] != 'length' and prompt.is_valid(inputs[reply['input']], reply['content']))
+    return {
+        'fixed': prompt.fixed_tokens(),
+        'prompt': sum(prompt_tokens) / len(prompt_tokens),
+        'cap': max(caps),
+        'examples': '%d/%d' % (examples_ok(prompt), len(prompt.examples)),
+        'replies': len(replies),
+        'p50': percentile(latencies, 0.5),
+        'p95': percentile(latencies, 0.95),
+        'replyMean': sum(reply_tokens) / len(reply_tokens) if reply_tokens else None,
+        'replyMax': max(reply_tokens) if reply_tokens else None,
+        'valid': valid,
+        'truncated': truncated,
+        'errors': len(replies) - len(answered),
+    }
+
+
+def format_value(value, pattern):
+    return pattern % value if value is not None else '-'
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Compare prompt versions on recorded fixtures')
+    parser.add_argument('--prompt', action='append', help='Prompt to benchmark (default: all); can be repeated')
+    parser.add_argument('--versions', help='Comma-separated versions to compare (default: all)')
+    parser.add_argument('--live', action='store_true', help='Call OpenAI instead of using the recorded replies')
+    parser.add_argument('--repeat', type=int, default=1, help='Live calls per fixture input')
+    parser.add_argument('--record', action='store_true', help='Save the live replies to the fixtures')
+    args = parser.parse_args()
+
+    client = None
+    if args.live:
+        load_dotenv()
+        import clients
+        client = clients.openai_client()
+
+    if prompts.get_encoding() is None:
+        print('Token counts are estimated at 4 characters a token; install tiktoken for exact counts\n')
+
+    print('%-19s %3s %6s %7s %5s %8s %7s %8s %8s %10s %7s %9s %6s' % (
+        'prompt', 'ver', 'fixed', 'prompt', 'cap', 'examples', 'replies', 'p50 ms', 'p95 ms', 'reply tok',
+        'valid', 'truncated', 'errors'))
+    for name in args.prompt or sorted(prompts.PROMPTS):
+        fixture = load_fixture(name)
+        inputs = fixture['inputs']
+        versions = sorted(prompts.PROMPTS[name])
+        if args.versions:
+            versions = [version for version in versions if str(version) in args.versions.split(',')]
+
+        for version in versions:
+            prompt = prompts.PROMPTS[name][version]
+            if args.live:
+                replies = [record_reply(client, prompt, index, prompt_input)
+                           for _ in range(args.repeat) for index, prompt_input in enumerate(inputs)]
+                if args.record:
+                    fixture['recorded'][str(version)] = replies
+            else:
+                replies = fixture['recorded'].get(str(version), [])
+
+            row = summarize(prompt, inputs, replies)
+            print('%-19s %3d %6d %7.0f %5d %8s %7d %8s %8s %10s %7s %9d %6d' % (
+                name, version, row['fixed'], row['prompt'], row['cap'], row['examples'], row['replies'],
+                format_value(row['p50'], '%.0f'), format_value(row['p95'], '%.0f'),
+                '%s/%s' % (format_value(row['replyMean'], '%.0f'), format_value(row['replyMax'], '%d')),
+                '%d/%d' % (row['valid'], row['replies']) if row['replies'] else '-',
+                row['truncated'], row['errors']))
+
+        if args.live and args.record:
+            save_fixture(name, fixture)
+
+
+if __name__ == '__main__':
+    main()
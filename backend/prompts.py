@@ -0,0 +1,278 @@
+import json
+import math
+
+# Every prompt the game sends to the LLM, kept as numbered versions so a new
+# wording can be benchmarked (prompt_benchmark.py) and rolled out or back
+# without touching the code that uses it. A version is never edited once it
+# has shipped; changes go into a new one. The LLM cache key covers the whole
+# request, so answers cached for one version are never served for another.
+#
+# A new version is only added together with its replies and the current
+# version's, recorded into prompt_fixtures with prompt_benchmark.py --live
+# --record, so the benchmark compares them on real replies rather than on
+# token estimates alone.
+
+MODEL = 'gpt-4o-mini'
+ENCODING = 'o200k_base'  # gpt-4o-mini's tokenizer
+
+_encoding = None
+_encoding_loaded = False
+
+
+def get_encoding():
+    # tiktoken's encoding, or None when tiktoken isn't installed or can't
+    # load the encoding file, in which case token counts are estimated
+    global _encoding, _encoding_loaded
+    if not _encoding_loaded:
+        try:
+            import tiktoken
+            _encoding = tiktoken.get_encoding(ENCODING)
+        except Exception as e:
+            print('Estimating token counts, tiktoken unavailable: %s' % e)
+        _encoding_loaded = True
+    return _encoding
+
+
+def count_text_tokens(text):
+    encoding = get_encoding()
+    if encoding is None:
+        return (len(text) + 3) // 4
+    return len(encoding.encode(text))
+
+
+def message_text(message):
+    content = message['content']
+    if isinstance(content, str):
+        return content
+    return ''.join(part.get('text', '') for part in content)
+
+
+def count_tokens(messages):
+    # Prompt tokens of a chat request as OpenAI bills them: the text of each
+    # message plus a few tokens of framing per message and for the reply
+    return sum(3 + count_text_tokens(message_text(message)) for message in messages) + 3
+
+
+def valid_price(price):
+    # The price as a rounded float, or None if it isn't a usable price
+    if isinstance(price, str):
+        try:
+            price = float(price)
+        except ValueError:
+            return None
+    if isinstance(price, bool) or not isinstance(price, (int, float)):
+        return None
+    if not math.isfinite(price) or price <= 0:
+        return None
+    return round(price, 2)
+
+
+def parse_batch_prices(response, tickers):
+    prices = response.get('prices') if isinstance(response, dict) else None
+    if not isinstance(prices, dict):
+        return {}
+    valid = {}
+    for ticker in tickers:
+        price = valid_price(prices.get(ticker))
+        if price is not None:
+            valid[ticker] = price
+    return valid
+
+
+def is_headline_list(headlines):
+    return isinstance(headlines, list) and len(headlines) > 0 and all(isinstance(h, str) for h in headlines)
+
+
+def valid_stock_price(example, response):
+    return isinstance(response, dict) and valid_price(response.get('new_price')) is not None
+
+
+def valid_batch_prices(price_request, response):
+    tickers = [asset['ticker'] for asset in price_request['assets']]
+    return len(parse_batch_prices(response, tickers)) == len(tickers)
+
+
+def valid_company_news(ticker, response):
+    return isinstance(response, dict) and is_headline_list(response.get('headlines'))
+
+
+def valid_global_news(_, response):
+    return isinstance(response, dict) and is_headline_list(response.get('headlines'))
+
+
+def valid_batch_news(news_request, response):
+    companies = response.get('companies') if isinstance(response, dict) else None
+    if not isinstance(companies, dict) or not all(is_headline_list(companies.get(t)) for t in news_request['tickers']):
+        return False
+    return not news_request['include_global'] or is_headline_list(response.get('global'))
+
+
+class Prompt:
+    # system and examples, a list of (user, assistant) exchanges, are sent
+    # before render(prompt_input). max_tokens is a number or a function of
+    # the input. validate(prompt_input, response) tells whether a parsed
+    # reply is usable. content_parts sends each message as a list of text
+    # parts, the way version 1 prompts always have.
+
+    def __init__(self, name, version, system, examples, render, max_tokens, validate, temperature=1,
+                 content_parts=False):
+        self.name = name
+        self.version = version
+        self.system = system
+        self.examples = examples
+        self.render = render
+        self.max_tokens = max_tokens
+        self.validate = validate
+        self.temperature = temperature
+        self.content_parts = content_parts
+
+    def message(self, role, text):
+        if self.content_parts:
+            return {"role": role, "content": [{"type": "text", "text": text}]}
+        return {"role": role, "content": text}
+
+    def fixed_messages(self):
+        messages = [self.message("system", self.system)]
+        for user, assistant in self.examples:
+            messages.append(self.message("user", user))
+            messages.append(self.message("assistant", assistant))
+        return messages
+
+    def messages(self, prompt_input):
+        return self.fixed_messages() + [self.message("user", self.render(prompt_input))]
+
+    def response_cap(self, prompt_input):
+        return self.max_tokens(prompt_input) if callable(self.max_tokens) else self.max_tokens
+
+    def request(self, prompt_input, model=MODEL):
+        return dict(
+            model=model,
+            messages=self.messages(prompt_input),
+            temperature=self.temperature,
+            max_tokens=self.response_cap(prompt_input),
+            top_p=1,
+            frequency_penalty=0,
+            presence_penalty=0,
+            response_format={
+                "type": "json_object"
+            }
+        )
+
+    def prompt_tokens(self, prompt_input):
+        return count_tokens(self.messages(prompt_input))
+
+    def fixed_tokens(self):
+        # Tokens every call pays for before its own input
+        return count_tokens(self.fixed_messages())
+
+    def is_valid(self, prompt_input, content):
+        try:
+            return bool(self.validate(prompt_input, json.loads(content or '')))
+        except json.JSONDecodeError:
+            return False
+
+
+def render_global_news(_):
+    return "Generate news headlines"
+
+
+STOCK_PRICE_V1 = Prompt(
+    'stock_price', 1,
+    system="Simulate stock market prices for a given asset. Consider the current stock price and a list of news articles, then determine the new price based on the expected impact of the news.\n\nUse provided inputs in JSON format and calculate a reasonable new stock price based on the nature of the given news. Each news item may have a positive, negative, or neutral effect on the stock.\n\n# Steps\n\n1. **Process Input**: Receive the input JSON containing the company's current stock price and a list of news items.\n2. **Analyze News Impact**: For each piece of news, determine if its tone is positive, negative, or neutral.\n3. **Adjust Stock Price**: Depending on the combined influence of the news items:\n   - Positive news should boost the price. Determine a range between 0 - 40% of the current price\n   - Negative news should decrease the price. Determine a range between 0 - 40% of the current price\n   - Neutral/balanced news should not significantly affect the stock price.\n4. **Output Result**: Output the adjusted stock price as JSON, including a breakdown of how each news item affected the final value.\n\n# Output Format\n\nThe output should be in JSON format with the following structure:\n- `asset`: the name of the asset.\n- `current_price`: the original price provided.\n- `new_price`: the calculated new stock price.\n\nExample Output:\n```json\n{\n  \"asset\": \"[Company Name]\",\n  \"current_price\": [Current Price],\n  \"new_price\": [Calculated New Price]\n}\n```\n\n# Example\n\n### Input:\n```json\n{\n  \"asset\": \"TechCo\",\n  \"current_price\": 150.00,\n  \"news\": [\n    \"TechCo reports 20% increase in quarterly revenue.\",\n    \"Lawsuit filed against TechCo over privacy concerns.\",\n    \"TechCo launches new smartphone model.\"\n  ]\n}\n```\n\n### Reasoning:\n- News headline 1: Very positive news, will likely boost stock price due to strong earnings.\n- News headline 2: Negative news, expected to partially offset gains due to potential legal costs.\n- News headline 3: New product launch, likely positive, but depends on market response.\n\n### Output:\n```json\n{\n  \"asset\": \"TechCo\",\n  \"current_price\": 150.00,\n  \"new_price\": 165.50\n}\n```\n\n# Notes\n\n- With conflicting news, the model should try to balance the impact proportionally.\n- Some news might not have significant impact. In such cases, the impact can be zero.\n- Consider edge cases like highly impactful news or unclear sentiment and provide a conservative change.\n- If the news are clearly super impactful feel free to give it a return between -40% to 40%.\n",
+    examples=[
+        ("{\n  \"asset\": \"AAPL\",\n  \"current_price\": 250,\n  \"news\": [\n    \"AAPL reports 50% increase in quarterly revenue. Beats Projected goal for End of Quarter\",\n    \"Lawsuit filed against AAPL over privacy concerns.\",\n    \"AAPL launches new smartphone model with new features that integrate with the upcoming Vision Pros.\"\n  ]\n}",
+         "{\n  \"asset\": \"AAPL\",\n  \"current_price\": 250,\n  \"new_price\": 280.00\n}"),
+        ("{\n  \"asset\": \"MSFT\",\n  \"current_price\": 100,\n  \"news\": [\n    \"MSFT reports hiring another 10 thosand new graduates.\"\n  ]\n}",
+         "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 100\n  \"new_price\": 120.00\n}"),
+        ("{\n  \"asset\": \"TSLA\",\n  \"current_price\": 150,\n  \"news\": [\n    \"TSLA reports an explosion in their new gigafactory location, which is the main location for manufacturing\",\n    \"Industry experts dislike the new Cybertruck car - They say it looks like a dumpster\",\n  ]\n}",
+         "{\n  \"asset\": \"TSLA\",\n  \"current_price\": 150,\n  \"new_price\": 100.00\n}"),
+        ("{\n  \"asset\": \"MSFT\",\n  \"current_price\": 500,\n  \"news\": [\n    \"Microsoft Announces Mind-Controlled Video Games: 'Xbox Your Brain'!\",\n    \"Microsoft's New AI-Powered Clippy Crashes Stock Trading: 'Paperclips Everywhere!'\",\n    \"Windows 13 Rollout Stumbles as Users Complain of Unexpected Blue Screens\"\n  ]\n}",
+         "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 500,\n  \"new_price\": 465.00\n}"),
+        ("{\n  \"asset\": \"MSFT\",\n  \"current_price\": 465,\n  \"news\": [\n    \"Microsoft Acquires Espresso Tech: Future Office Meetings to Be Powered by Coffee!\",\n    \"New Windows Update Touted as 'Perfect' by Developers, But Users Find Bugs Quickly\",\n    \"Microsoft's Cloud Gaming Expansion Faces Backlash from Traditional Gamers\"\n  ]\n}",
+         "{\n  \"asset\": \"MSFT\",\n  \"current_price\": 495,\n  \"new_price\": 465.00\n}"),
+    ],
+    render=json.dumps,
+    max_tokens=7665,
+    validate=valid_stock_price,
+    content_parts=True
+)
+
+STOCK_PRICES_BATCH_V1 = Prompt(
+    'stock_prices_batch', 1,
+    system="Simulate stock market prices for several assets at once. Each asset comes with its current stock price and a list of news headlines; determine each new price based on the expected impact of its news.\n\n# Rules\n\n- Positive news should boost the price by 0 - 40% of the current price.\n- Negative news should decrease the price by 0 - 40% of the current price.\n- Neutral/balanced news should not significantly affect the price.\n- With conflicting news, balance the impact proportionally. If the news is clearly super impactful, use the full -40% to 40% range.\n- Price every asset independently and return a price for every ticker in the input.\n\n# Output Format\n\nReturn a JSON object mapping each ticker to its new price as a number:\n```json\n{\n  \"prices\": {\n    \"[Ticker]\": [New Price]\n  }\n}\n```",
+    examples=[
+        ("{\"assets\": [{\"ticker\": \"AAPL\", \"current_price\": 250, \"news\": [\"AAPL reports 50% increase in quarterly revenue. Beats Projected goal for End of Quarter\", \"Lawsuit filed against AAPL over privacy concerns.\"]}, {\"ticker\": \"TSLA\", \"current_price\": 150, \"news\": [\"TSLA reports an explosion in their new gigafactory location, which is the main location for manufacturing\"]}, {\"ticker\": \"MSFT\", \"current_price\": 100, \"news\": [\"MSFT reports hiring another 10 thosand new graduates.\"]}]}",
+         "{\"prices\": {\"AAPL\": 280.00, \"TSLA\": 100.00, \"MSFT\": 120.00}}"),
+    ],
+    render=json.dumps,
+    max_tokens=lambda price_request: 50 + 25 * len(price_request['assets']),
+    validate=valid_batch_prices,
+    content_parts=True
+)
+
+COMPANY_NEWS_V1 = Prompt(
+    'company_news', 1,
+    system="Generate positive and negative news headlines for a stock trading simulation game. You will receive the name of a company or its ticker symbol, and your task is to create a few relevant and imaginative news headlines that can be either positive or negative\n\n- The headlines can be humorous, surprising, or reflect something unexpected about the company.\n- Randomly decide if the news can be negative or upsetting themes. Feel free to be creative\n- Each headline should be succinct and convey its message clearly in an attention-grabbing way.\n\n# Steps\n\n1. Receive the company name or ticker.\n2. Create 1 to 3 distinct and engaging headlines that relate to the company.\n3. Ensure they vary in theme—mix reality-based humor, tragedies, failures, growth announcements, fictional innovations, partnership, rumors, gossip, etc.\n\n# Output Format\n\nReturn a JSON object structured as follows:\n- `headlines`: An array of strings, each representing a news headline.\n- There should be between 1 and 3 headlines in the array.\n\n```json\n{\n  \"headlines\": [\n    \"Headline 1\",\n    \"Headline 2\",\n    \"Headline 3\"\n  ]\n}\n```\n\n# Examples\n\n### Example 1 - Input:\nCompany: \"Tesla\"\n\n### Example 1 - Output:\n```json\n{\n  \"headlines\": [\n    \"Tesla Unveils Self-Driving Electric Helicopter. Elon Calls It 'Top Secret Fun Project'\",\n    \"Tesla Teams Up With SpaceX to Offer 'Martian-Ready' Cybertrucks for the Future Red Planet Colony\",\n    \"Industry experts dislike the new Cybertruck car. They say it looks like a dumpster\"\n  ]\n}\n```\n\n### Example 2 - Input:\nCompany: \"Apple\"\n\n### Example 2 - Output:\n```json\n{\n  \"headlines\": [\n    \"Apple Launches 'iPlant,' a Smart Home Device That Monitors Your Plants' Emotions\",\n    \"Apple and Disney sued by over privacy concerns.\",\n  ]\n}\n```\n\n# Notes\n\n- Headlines should be creative way, positive, and negative\n- Ensure headlines are suitable for a light-hearted stock simulation game but include some negative news\n- Keep each headline concise yet interesting, and vary their focus as much as possible.",
+    examples=[
+        ("AAPL",
+         "{\n  \"headlines\": [\n    \"Apple Launches 'iPlant,' a Smart Home Device That Monitors Your Plants' Emotions and reports record-breaking sales\",\n    \"Rumor Mill: Apple Reportedly Fails to develop Foldable iPhone. Losing competition to Google\",\n    \"Apple and Disney sued by over privacy concerns.\"\n  ]\n}"),
+        ("TSLA",
+         "{\n  \"headlines\": [\n    \"TSLA reports an explosion in their new gigafactory location\",\n    \"Industry experts dislike the new Cybertruck car.\"\n  ]\n}"),
+        ("MSFT",
+         "{\n  \"headlines\": [\n    \"Microsoft Announces Mind-Controlled Video Games: 'Xbox Your Brain'!\",\n    \"Microsoft's New AI-Powered Clippy Crashes Stock Trading: 'Paperclips Everywhere!'\",\n    \"Windows 13 Rollout Stumbles as Users Complain of Unexpected Blue Screens\"\n  ]\n}"),
+        ("MSFT",
+         "{\n  \"headlines\": [\n    \"Microsoft Acquires Espresso Tech: Future Office Meetings to Be Powered by Coffee!\",\n    \"New Windows Update Touted as 'Perfect' by Developers, But Users Find Bugs Quickly\",\n    \"Microsoft's Cloud Gaming Expansion Faces Backlash from Traditional Gamers\"\n  ]\n}"),
+    ],
+    render=lambda ticker: ticker,
+    max_tokens=6261,
+    validate=valid_company_news,
+    temperature=1.2,
+    content_parts=True
+)
+
+GLOBAL_NEWS_V1 = Prompt(
+    'global_news', 1,
+    system="Generate three positive or negative news headlines related to the world, economy, or politics for a stock trading game. The headlines should be informative, relevant to global news, and present impactful scenarios that could influence stock trading decisions. Mix both positive and negative news to simulate realistic market conditions. \n\n# Requirements:\n- Headline topics should be relevant to global news concerning politics, economy, or significant regional/world events.\n- Headlines must be clear, informative, and impactful.\n- Avoid repetition in news themes to provide variety in the scenario.\n- Include a mix of both optimistic and pessimistic viewpoints.\n\n# Output Format\n\nThe response must be in JSON format pointing to an array with exactly three string headlines:\n```\n{\n  \"headlines\": [\n    \"[headline_1]\",\n    \"[headline_2]\",\n    \"[headline_3]\"\n  ]\n}\n```\n\n# Headlines Characteristics\n- Each headline should convey either a positive or negative impact, e.g., an economic growth report or political turmoil.\n- Each headline should be presented in a format that would affect market sentiment clearly (e.g. \"global economy growth surpasses estimates\" or \"political conflict in region X leads to unrest\").\n  \n# Examples\n\n### Example 1:\n\n**Input Context**: Generate news headlines.\n\n**Output**:\n{\n  \"headlines\": [\n    \"Global market booms as tech companies report record-breaking profits\",\n    \"Political turmoil in Region X sends currencies in freefall amid rising tensions\",\n    \"Trade agreement between the EU and Asian economies promises significant growth by year-end\"\n  ]\n}\n\n### Example 2:\n\n**Input Context**: Generate news headlines.\n\n**Output**:\n{\n  \"headlines\": [\n    \"Massive infrastructure investment approved by U.S. government boosts hopes for economic recovery\",\n    \"Uncertainty rises as international sanctions weaken Region Y's economy, causing global disruptions\",\n    \"Tourism revival in Southeast Asia accelerates regional economic recovery beyond expectations\"\n  ]\n}\n\n(Note: In real examples, a mix of optimistic and pessimistic viewpoints is common. Vary between topics such as trade, conflict, policies, and technological advances.)\n  \n# Notes\n- Headlines should ideally invoke immediate emotional responses of optimism or pessimism, simulating real financial impacts.\n- Keep the headlines in line with typical news formats—short, descriptive, and informative.\n- Avoid overly sensational or unrealistic headlines for better immersion in the trading game scenario.",
+    examples=[
+        ("Generate news headlines",
+         "{\n  \"headlines\": [\n    \"Emerging markets rally as new trade deal expands opportunities across South America\",\n    \"Escalating tensions in the Middle East disrupts global oil supply, causing market volatility\",\n    \"Surging demand for green technology fuels robust growth in renewable energy stocks worldwide\"\n  ]\n}"),
+    ],
+    render=render_global_news,
+    max_tokens=2000,
+    validate=valid_global_news,
+    content_parts=True
+)
+
+COMPANY_NEWS_BATCH_V1 = Prompt(
+    'company_news_batch', 1,
+    system="Generate positive and negative news headlines for a stock trading simulation game. You will receive a list of company ticker symbols and must write 1 to 3 relevant and imaginative headlines for every ticker.\n\n- The headlines can be humorous, surprising, or reflect something unexpected about the company.\n- Randomly decide if the news can be negative or upsetting themes. Mix reality-based humor, tragedies, failures, growth announcements, fictional innovations, partnerships, rumors and gossip.\n- Each headline should be succinct and attention-grabbing.\n- If `include_global` is true, also write exactly three headlines about the world, economy, or politics that could move markets, mixing optimistic and pessimistic scenarios.\n\n# Output Format\n\nReturn a JSON object with a `companies` map from every input ticker to its array of headlines, plus a `global` array when `include_global` is true:\n```json\n{\n  \"companies\": {\n    \"[Ticker]\": [\"Headline 1\", \"Headline 2\"]\n  },\n  \"global\": [\"Headline 1\", \"Headline 2\", \"Headline 3\"]\n}\n```",
+    examples=[
+        ("{\"tickers\": [\"AAPL\", \"TSLA\"], \"include_global\": true}",
+         "{\"companies\": {\"AAPL\": [\"Apple Launches 'iPlant,' a Smart Home Device That Monitors Your Plants' Emotions\", \"Apple and Disney sued over privacy concerns.\"], \"TSLA\": [\"TSLA reports an explosion in their new gigafactory location\", \"Industry experts dislike the new Cybertruck car.\", \"Tesla Teams Up With SpaceX to Offer 'Martian-Ready' Cybertrucks\"]}, \"global\": [\"Emerging markets rally as new trade deal expands opportunities across South America\", \"Escalating tensions in the Middle East disrupts global oil supply, causing market volatility\", \"Surging demand for green technology fuels robust growth in renewable energy stocks worldwide\"]}"),
+    ],
+    render=json.dumps,
+    max_tokens=lambda news_request: 150 + 100 * len(news_request['tickers']),
+    validate=valid_batch_news,
+    temperature=1.2,
+    content_parts=True
+)
+
+PROMPTS = {}
+for prompt in (STOCK_PRICE_V1, STOCK_PRICES_BATCH_V1, COMPANY_NEWS_V1, GLOBAL_NEWS_V1, COMPANY_NEWS_BATCH_V1):
+    PROMPTS.setdefault(prompt.name, {})[prompt.version] = prompt
+
+
+def parse_versions(spec):
+    # 'stock_price=1,company_news=2' -> {'stock_price': 1, 'company_news': 2}
+    versions = {}
+    for item in spec.split(','):
+        if item.strip():
+            name, version = item.split('=')
+            versions[name.strip()] = int(version)
+    return versions
+
+
+def get_prompt(name, version=None):
+    # The given version of a prompt, or its latest
+    versions = PROMPTS[name]
+    return versions[version if version is not None else max(versions)]
@@ -0,0 +1,122 @@
+import json
+import math
+import os
+import threading
+import time
+from datetime import datetime, time as dtime
+from zoneinfo import ZoneInfo
+
+import metrics
+
+MARKET_TZ = ZoneInfo('America/New_York')
+MARKET_OPEN = dtime(9, 30)
+MARKET_CLOSE = dtime(16, 0)
+
+
+def market_is_open(now=None):
+    now = now or datetime.now(MARKET_TZ)
+    return now.weekday() < 5 and MARKET_OPEN <= now.time() < MARKET_CLOSE
+
+
+def fetch_quotes(tickers):
+    # One bulk request for every ticker instead of a history() call each
+    import yfinance as yf  # Pulls in pandas; only needed once quotes are fetched
+
+    with metrics.timed(metrics.QUOTE_FETCH_SECONDS, metrics.QUOTE_FETCH_ERRORS):
+        history = yf.download(tickers, period='1d', group_by='ticker', progress=False, threads=True)
+    quotes = {}
+    if history is None or history.empty:
+        return quotes
+    for ticker in tickers:
+        try:
+            closes = history[ticker]['Close'].dropna()
+        except KeyError:
+            continue
+        if not closes.empty:
+            price = float(closes.iloc[-1])
+            if math.isfinite(price):
+                quotes[ticker] = price
+    return quotes
+
+
+class QuoteCache:
+    # Latest close for a fixed ticker list, shared by every request in the
+    # process. Quotes are refreshed at most once per TTL (short while the
+    # market is open, long while it's closed) by a single caller; everyone
+    # else gets the cached snapshot. When a refresh fails or comes back
+    # empty the last-known snapshot, persisted to disk, is served instead.
+
+    def __init__(self, tickers, snapshot_path, ttl_open=60, ttl_closed=30 * 60, fetch=fetch_quotes):
+        self.tickers = list(tickers)
+        self.snapshot_path = snapshot_path
+        self.ttl_open = ttl_open
+        self.ttl_closed = ttl_closed
+        self.fetch = fetch
+        self._lock = threading.Lock()
+        self._refreshing = None
+        self._quotes = {}
+        self._fetched_at = 0
+        self._load_snapshot()
+
+    def _load_snapshot(self):
+        try:
+            with open(self.snapshot_path) as f:
+                snapshot = json.load(f)
+            self._quotes = snapshot['quotes']
+            self._fetched_at = snapshot['fetched_at']
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def _save_snapshot(self):
+        tmp_path = self.snapshot_path + '.%d.tmp' % os.getpid()
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump({'fetched_at': self._fetched_at, 'quotes': self._quotes}, f)
+            os.replace(tmp_path, self.snapshot_path)
+        except OSError:
+            pass
+
+    def ttl(self):
+        return self.ttl_open if market_is_open() else self.ttl_closed
+
+    def is_fresh(self):
+        return bool(self._quotes) and time.time() - self._fetched_at < self.ttl()
+
+    def refresh(self):
+        try:
+            quotes = self.fetch(self.tickers)
+        except Exception as e:
+            print('Quote refresh failed: %s' % e)
+            quotes = {}
+        with self._lock:
+            if quotes:
+                # Keep last-known prices for any ticker the bulk call missed
+                self._quotes = dict(self._quotes, **quotes)
+                self._fetched_at = time.time()
+            refreshing, self._refreshing = self._refreshing, None
+        if quotes:
+            self._save_snapshot()
+        refreshing.set()
+
+    def get(self):
+        with self._lock:
+            if self.is_fresh():
+                return dict(self._quotes)
+            leader = self._refreshing is None
+            if leader:
+                self._refreshing = threading.Event()
+            refreshing = self._refreshing
+            stale = dict(self._quotes)
+
+        if stale:
+            # Serve the stale snapshot right away and refresh behind it
+            if leader:
+                threading.Thread(target=self.refresh, name='quote-refresh', daemon=True).start()
+            return stale
+
+        if leader:
+            self.refresh()
+        else:
+            refreshing.wait()
+        with self._lock:
+            return dict(self._quotes)
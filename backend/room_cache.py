@@ -0,0 +1,280 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+import metrics
+from market_index import MarketIndex
+from room_store import (
+    get_room_ref, get_round_ref, get_portfolio_ref, is_legacy_room, migrate_room, round_from_snapshot
+)
+
+# Marks an entry this process just wrote. It has to be re-read from Firestore
+# before listener snapshots are trusted for it again.
+STALE = object()
+
+
+class CachedRoom:
+    def __init__(self):
+        self.room = None  # (update_time, data), STALE or None
+        self.portfolios = {}  # uid -> (update_time, data) or STALE
+        self.portfolios_complete = False
+        self.rounds = {}
+        self.market_index = None
+        self.watches = None
+        self.last_used = time.time()
+
+
+def is_newer(entry, update_time):
+    return not isinstance(entry, tuple) or entry[0] is None or update_time is None or update_time >= entry[0]
+
+
+class RoomCache:
+    # Per-process cache of room state. Rounds never change once written, so
+    # they (and the room's MarketIndex, until more rounds are added) are kept
+    # for as long as the room stays cached. Room metadata and
+    # portfolios are kept current by Firestore snapshot listeners; each entry
+    # carries its document's update_time and an older snapshot never replaces
+    # a newer one. Writes made through this process mark the entry STALE so
+    # the next read goes to Firestore instead of waiting on the listener.
+    # Without listeners (listen=False) only rounds are cached.
+
+    def __init__(self, db, max_rooms=500, idle_timeout=600, listen=True):
+        self.db = db
+        self.max_rooms = max_rooms
+        self.idle_timeout = idle_timeout
+        self.listen = listen
+        self._rooms = OrderedDict()
+        self._lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def _entry(self, game_code):
+        # Caller holds the lock. Returns the room's entry and any rooms that
+        # were evicted to make room for it, whose listeners must be closed.
+        now = time.time()
+        cached = self._rooms.get(game_code)
+        if cached is None:
+            cached = self._rooms[game_code] = CachedRoom()
+        self._rooms.move_to_end(game_code)
+        cached.last_used = now
+
+        evicted = []
+        for code in list(self._rooms):
+            room = self._rooms[code]
+            if len(self._rooms) > self.max_rooms or now - room.last_used > self.idle_timeout:
+                evicted.append(self._rooms.pop(code))
+            else:
+                break  # Ordered by last use, so the rest are newer
+        return cached, evicted
+
+    def _close(self, evicted):
+        for room in evicted:
+            for watch in room.watches or []:
+                try:
+                    watch.unsubscribe()
+                except Exception as e:
+                    print('Failed to close room listener: %s' % e)
+
+    def _watching(self, cached):
+        return self.listen and bool(cached.watches)
+
+    def _start_listening(self, game_code, cached):
+        if not self.listen:
+            return
+        with self._lock:
+            if cached.watches is not None:
+                return
+            cached.watches = []
+
+        room_ref = get_room_ref(self.db, game_code)
+
+        def on_room(snapshots, changes, read_time):
+            metrics.FIRESTORE_READS.inc(len(snapshots), source='listen')
+            with self._lock:
+                for snapshot in snapshots:
+                    if not snapshot.exists:
+                        cached.room = None
+                    elif cached.room is not STALE and is_newer(cached.room, snapshot.update_time):
+                        cached.room = (snapshot.update_time, snapshot.to_dict())
+
+        def on_portfolios(snapshots, changes, read_time):
+            metrics.FIRESTORE_READS.inc(len(changes), source='listen')
+            with self._lock:
+                for change in changes:
+                    uid = change.document.id
+                    current = cached.portfolios.get(uid)
+                    if change.type.name == 'REMOVED':
+                        cached.portfolios.pop(uid, None)
+                    elif current is not STALE and is_newer(current, change.document.update_time):
+                        cached.portfolios[uid] = (change.document.update_time, change.document.to_dict())
+
+        try:
+            watches = [
+                room_ref.on_snapshot(on_room),
+                room_ref.collection('portfolios').on_snapshot(on_portfolios)
+            ]
+        except Exception as e:
+            print('Failed to start room listener for %s: %s' % (game_code, e))
+            with self._lock:
+                cached.watches = None
+            return
+        with self._lock:
+            cached.watches = watches
+            evicted = [cached] if self._rooms.get(game_code) is not cached else []
+        self._close(evicted)  # Evicted while the listeners were starting
+
+    def get_room_data(self, game_code, fresh=False):
+        # Room metadata, or None if the room doesn't exist. fresh=True skips
+        # the cached copy for callers that must not act on a lagging listener.
+        with self._lock:
+            cached, evicted = self._entry(game_code)
+            room = cached.room
+            if not fresh and isinstance(room, tuple) and self._watching(cached):
+                self.hits += 1
+                return copy.deepcopy(room[1])
+            self.misses += 1
+        self._close(evicted)
+
+        room_ref = get_room_ref(self.db, game_code)
+        snapshot = room_ref.get()
+        if not snapshot.exists:
+            return None
+        if is_legacy_room(snapshot.to_dict()):
+            migrate_room(self.db, room_ref)
+            snapshot = room_ref.get()
+
+        room_data = snapshot.to_dict()
+        with self._lock:
+            if is_newer(cached.room, snapshot.update_time):
+                cached.room = (snapshot.update_time, copy.deepcopy(room_data))
+        self._start_listening(game_code, cached)
+        return room_data
+
+    def get_rounds(self, game_code, round_ids):
+        # Rounds in the order of round_ids (None for any that don't exist),
+        # fetching only the ones not cached yet in one batched read
+        with self._lock:
+            cached, evicted = self._entry(game_code)
+            missing = [round_id for round_id in round_ids if round_id not in cached.rounds]
+            self.hits += len(round_ids) - len(missing)
+            self.misses += len(missing)
+        self._close(evicted)
+
+        if missing:
+            room_ref = get_room_ref(self.db, game_code)
+            refs = [get_round_ref(room_ref, round_id) for round_id in missing]
+            for snapshot in self.db.get_all(refs):
+                round_data = round_from_snapshot(snapshot)
+                if round_data is not None:
+                    with self._lock:
+                        cached.rounds[snapshot.id] = round_data
+
+        with self._lock:
+            return [copy.deepcopy(cached.rounds.get(round_id)) for round_id in round_ids]
+
+    def get_round(self, game_code, round_id):
+        return self.get_rounds(game_code, [round_id])[0]
+
+    def get_market_index(self, game_code, room_data=None):
+        # The started game's MarketIndex, or None before the game starts.
+        # Rooms started before the index was stored get one built from
+        # their rounds. Games generated progressively gain rounds as they're
+        # played, so the cached index is rebuilt once room_data lists more.
+        with self._lock:
+            cached, evicted = self._entry(game_code)
+            if cached.market_index is not None and (
+                    room_data is None or len(room_data.get('round_ids', ())) <= len(cached.market_index.round_ids)):
+                self.hits += 1
+                return cached.market_index
+        self._close(evicted)
+
+        if room_data is None:
+            room_data = self.get_room_data(game_code)
+        round_ids = (room_data or {}).get('round_ids')
+        if not round_ids:
+            return None
+        if 'market_index' in room_data:
+            market_index = MarketIndex.from_document(round_ids, room_data['market_index'])
+        else:
+            market_index = MarketIndex.from_rounds(self.get_rounds(game_code, round_ids))
+        return self.set_market_index(game_code, market_index)
+
+    def set_market_index(self, game_code, market_index):
+        with self._lock:
+            cached, evicted = self._entry(game_code)
+            cached.market_index = market_index
+        self._close(evicted)
+        return market_index
+
+    def get_portfolio(self, game_code, uid):
+        with self._lock:
+            cached, evicted = self._entry(game_code)
+            portfolio = cached.portfolios.get(uid)
+            if isinstance(portfolio, tuple) and self._watching(cached):
+                self.hits += 1
+                return copy.deepcopy(portfolio[1])
+            self.misses += 1
+        self._close(evicted)
+
+        snapshot = get_portfolio_ref(get_room_ref(self.db, game_code), uid).get()
+        if not snapshot.exists:
+            return None
+        portfolio = snapshot.to_dict()
+        with self._lock:
+            if is_newer(cached.portfolios.get(uid), snapshot.update_time):
+                cached.portfolios[uid] = (snapshot.update_time, copy.deepcopy(portfolio))
+        self._start_listening(game_code, cached)
+        return portfolio
+
+    def get_portfolios(self, game_code):
+        with self._lock:
+            cached, evicted = self._entry(game_code)
+            if (cached.portfolios_complete and self._watching(cached)
+                    and all(isinstance(portfolio, tuple) for portfolio in cached.portfolios.values())):
+                self.hits += 1
+                return {uid: copy.deepcopy(portfolio[1]) for uid, portfolio in cached.portfolios.items()}
+            self.misses += 1
+        self._close(evicted)
+
+        portfolios = {}
+        for snapshot in get_room_ref(self.db, game_code).collection('portfolios').stream():
+            portfolios[snapshot.id] = snapshot.to_dict()
+            with self._lock:
+                if is_newer(cached.portfolios.get(snapshot.id), snapshot.update_time):
+                    cached.portfolios[snapshot.id] = (snapshot.update_time, copy.deepcopy(portfolios[snapshot.id]))
+        with self._lock:
+            cached.portfolios_complete = True
+        self._start_listening(game_code, cached)
+        return portfolios
+
+    def invalidate_room(self, game_code):
+        with self._lock:
+            cached = self._rooms.get(game_code)
+            if cached is not None:
+                cached.room = STALE
+
+    def invalidate_portfolio(self, game_code, uid):
+        with self._lock:
+            cached = self._rooms.get(game_code)
+            if cached is not None:
+                cached.portfolios[uid] = STALE
+
+    def invalidate_portfolios(self, game_code):
+        with self._lock:
+            cached = self._rooms.get(game_code)
+            if cached is not None:
+                cached.portfolios = {uid: STALE for uid in cached.portfolios}
+                cached.portfolios_complete = False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'rooms': len(self._rooms),
+                'listening': sum(1 for room in self._rooms.values() if room.watches),
+                'rounds': sum(len(room.rounds) for room in self._rooms.values()),
+                'hits': self.hits,
+                'misses': self.misses,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+            }
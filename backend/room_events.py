@@ -0,0 +1,120 @@
+import json
+import queue
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+import metrics
+
+
+class RoomEventBroker:
+    # Fans out room state changes (player joins, round completions,
+    # leaderboard updates) to every /room_events stream open for the room.
+    # Each subscriber gets its own bounded queue; a subscriber that stops
+    # reading is dropped rather than slowing down the publisher.
+    #
+    # With a db, events are written to rooms/<gameCode>/events and each
+    # process keeps one listener per room it has streams open for, so a
+    # stream served by any worker or instance sees events published by any
+    # other. Without one, events only reach streams in this process.
+    # subscribe() returns None once there are max_subscribers in the process.
+
+    def __init__(self, db=None, max_queue_size=100, event_ttl=24 * 60 * 60, clock_skew=2, max_subscribers=None):
+        self.db = db
+        self.max_queue_size = max_queue_size
+        self.max_subscribers = max_subscribers
+        self.event_ttl = event_ttl
+        self.clock_skew = clock_skew
+        self._subscribers = {}
+        self._watches = {}
+        self._lock = threading.Lock()
+
+    def events_ref(self, game_code):
+        return self.db.collection('rooms').document(game_code).collection('events')
+
+    def subscribe(self, game_code):
+        subscriber = queue.Queue(maxsize=self.max_queue_size)
+        with self._lock:
+            if self.max_subscribers is not None and \
+                    sum(len(subscribers) for subscribers in self._subscribers.values()) >= self.max_subscribers:
+                return None
+            self._subscribers.setdefault(game_code, set()).add(subscriber)
+            token = None
+            if self.db is not None and game_code not in self._watches:
+                token = self._watches[game_code] = object()  # Until the listener is up
+        if token is not None:
+            self._listen(game_code, token)
+        return subscriber
+
+    def unsubscribe(self, game_code, subscriber):
+        watch = None
+        with self._lock:
+            subscribers = self._subscribers.get(game_code)
+            if subscribers is None:
+                return
+            subscribers.discard(subscriber)
+            if not subscribers:
+                del self._subscribers[game_code]
+                watch = self._watches.pop(game_code, None)
+        if hasattr(watch, 'unsubscribe'):
+            watch.unsubscribe()
+
+    def is_subscribed(self, game_code, subscriber):
+        with self._lock:
+            return subscriber in self._subscribers.get(game_code, ())
+
+    def publish(self, game_code, event_type, data):
+        if self.db is None:
+            self._deliver(game_code, event_type, data)
+            return
+        self.events_ref(game_code).document().set({
+            'type': event_type,
+            'data': data,
+            'at': time.time(),
+            # For a Firestore TTL policy on the events collection group
+            'expireAt': datetime.now(timezone.utc) + timedelta(seconds=self.event_ttl)
+        })
+
+    def _listen(self, game_code, token):
+        # Only events published from now on (allowing for clock skew between
+        # instances); a stream gets the room's current state separately
+        query = self.events_ref(game_code).where('at', '>=', time.time() - self.clock_skew)
+
+        def on_events(snapshots, changes, read_time):
+            metrics.FIRESTORE_READS.inc(len(changes), source='listen')
+            events = [change.document.to_dict() for change in changes if change.type.name == 'ADDED']
+            for event in sorted(events, key=lambda event: event['at']):
+                self._deliver(game_code, event['type'], event['data'])
+
+        try:
+            watch = query.on_snapshot(on_events)
+        except Exception as e:
+            print('Failed to listen for events in room %s: %s' % (game_code, e))
+            with self._lock:
+                if self._watches.get(game_code) is token:
+                    del self._watches[game_code]
+            return
+        with self._lock:
+            if self._watches.get(game_code) is token:
+                self._watches[game_code] = watch
+                return
+        watch.unsubscribe()  # Everyone left while the listener was starting
+
+    def _deliver(self, game_code, event_type, data):
+        with self._lock:
+            subscribers = list(self._subscribers.get(game_code, ()))
+        for subscriber in subscribers:
+            try:
+                subscriber.put_nowait((event_type, data))
+            except queue.Full:
+                self.unsubscribe(game_code, subscriber)
+
+    def subscriber_count(self, game_code=None):
+        with self._lock:
+            if game_code is not None:
+                return len(self._subscribers.get(game_code, ()))
+            return sum(len(subscribers) for subscribers in self._subscribers.values())
+
+
+def format_sse(event_type, data):
+    return 'event: %s\ndata: %s\n\n' % (event_type, json.dumps(data))
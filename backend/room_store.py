@@ -0,0 +1,172 @@
+from google.cloud import firestore
+
+# Storage layout for a game:
+#
+#   rooms/<gameCode>                   room metadata, player lists, round_ids
+#                                      (round order, which grows as rounds are
+#                                      generated in progressive games),
+#                                      completed_rounds and the market_index
+#                                      price matrix
+#   rooms/<gameCode>/rounds/<round_id> one round of market data plus its index
+#                                      (and, until the game starts, the id of
+#                                      the start job that generated it)
+#   rooms/<gameCode>/portfolios/<uid>  one player's portfolio
+#
+# Rooms created before the split kept market_data and portfolios inline in
+# the room document; migrate_room moves them out.
+
+
+def get_room_ref(db, game_code):
+    return db.collection('rooms').document(game_code)
+
+
+def get_round_ref(room_ref, round_id):
+    return room_ref.collection('rounds').document(round_id)
+
+
+def get_portfolio_ref(room_ref, uid):
+    return room_ref.collection('portfolios').document(uid)
+
+
+def is_legacy_room(room_data):
+    return 'market_data' in room_data or 'portfolios' in room_data
+
+
+def round_from_snapshot(snapshot):
+    if not snapshot.exists:
+        return None
+    round_data = snapshot.to_dict()
+    round_data.pop('index', None)
+    round_data.pop('job', None)
+    return round_data
+
+
+def get_round(room_ref, round_id):
+    return round_from_snapshot(get_round_ref(room_ref, round_id).get())
+
+
+def get_rounds(db, room_ref, round_ids):
+    # One batched read; returns rounds in the order of round_ids
+    refs = [get_round_ref(room_ref, round_id) for round_id in round_ids]
+    snapshots = {snapshot.id: snapshot for snapshot in db.get_all(refs)}
+    return [round_from_snapshot(snapshots[round_id]) for round_id in round_ids]
+
+
+def get_portfolios(room_ref):
+    return {snapshot.id: snapshot.to_dict() for snapshot in room_ref.collection('portfolios').stream()}
+
+
+def write_pending_round(room_ref, job_id, index, round_data):
+    # A round generated by a start job that hasn't finished yet, so another
+    # job can pick up from it if this one dies
+    get_round_ref(room_ref, round_data['round_id']).set(dict(round_data, index=index, job=job_id))
+
+
+def get_pending_rounds(room_ref, job_id):
+    snapshots = room_ref.collection('rounds').where('job', '==', job_id).stream()
+    rounds = sorted((snapshot.to_dict() for snapshot in snapshots), key=lambda round_data: round_data['index'])
+    for round_data in rounds:
+        round_data.pop('index')
+        round_data.pop('job')
+    return rounds
+
+
+def take_over_pending_rounds(db, room_ref, from_job_id, job_id):
+    # The rounds a dead or failed start job saved, retagged for the job
+    # replacing it so that a later resume from that job finds them too
+    rounds = get_pending_rounds(room_ref, from_job_id)
+    if rounds:
+        batch = db.batch()
+        for round_data in rounds:
+            batch.update(get_round_ref(room_ref, round_data['round_id']), {'job': job_id})
+        batch.commit()
+    return rounds
+
+
+def delete_pending_rounds(db, room_ref):
+    # write_game saves the game's rounds without a job, so any round still
+    # tagged with one was left by a job that was superseded, or by a start
+    # the scenario pool ended up serving
+    snapshots = list(room_ref.collection('rounds').where('job', '!=', '').stream())
+    if snapshots:
+        batch = db.batch()
+        for snapshot in snapshots:
+            batch.delete(snapshot.reference)
+        batch.commit()
+    return len(snapshots)
+
+
+def write_game(db, room_ref, market_data, portfolios, market_index, room_updates=None):
+    batch = db.batch()
+    for index, round_data in enumerate(market_data):
+        batch.set(get_round_ref(room_ref, round_data['round_id']), dict(round_data, index=index))
+    for uid, portfolio in portfolios.items():
+        batch.set(get_portfolio_ref(room_ref, uid), portfolio)
+    batch.update(room_ref, {
+        'started': True,
+        'round_ids': [round_data['round_id'] for round_data in market_data],
+        'market_index': market_index.to_document(),
+        **(room_updates or {})
+    })
+    batch.commit()
+
+
+def append_round(transaction, room_ref, round_data, market_index, room_updates=None):
+    # Adds the next round to a started game in the caller's transaction;
+    # market_index already includes it
+    transaction.set(get_round_ref(room_ref, round_data['round_id']),
+                    dict(round_data, index=len(market_index.round_ids) - 1))
+    transaction.update(room_ref, {
+        'round_ids': market_index.round_ids,
+        'market_index': market_index.to_document(),
+        **(room_updates or {})
+    })
+
+
+@firestore.transactional
+def migrate_room_in_transaction(transaction, room_ref):
+    room = room_ref.get(transaction=transaction)
+    if not room.exists:
+        return None
+    room_data = room.to_dict()
+    if not is_legacy_room(room_data):
+        return room_data  # Someone else migrated it first
+
+    market_data = room_data.pop('market_data', [])
+    portfolios = room_data.pop('portfolios', {})
+    for index, round_data in enumerate(market_data):
+        transaction.set(get_round_ref(room_ref, round_data['round_id']), dict(round_data, index=index))
+    for uid, portfolio in portfolios.items():
+        transaction.set(get_portfolio_ref(room_ref, uid), portfolio)
+    room_data['round_ids'] = [round_data['round_id'] for round_data in market_data]
+    transaction.update(room_ref, {
+        'round_ids': room_data['round_ids'],
+        'market_data': firestore.DELETE_FIELD,
+        'portfolios': firestore.DELETE_FIELD
+    })
+    return room_data
+
+
+def migrate_room(db, room_ref):
+    return migrate_room_in_transaction(db.transaction(), room_ref)
+
+
+def get_room_data(db, room_ref):
+    # Room metadata, migrating rooms still in the old single-document layout
+    # the first time they are read. Returns None if the room doesn't exist.
+    room = room_ref.get()
+    if not room.exists:
+        return None
+    room_data = room.to_dict()
+    if is_legacy_room(room_data):
+        room_data = migrate_room(db, room_ref)
+    return room_data
+
+
+def migrate_all_rooms(db):
+    migrated = 0
+    for room in db.collection('rooms').stream():
+        if is_legacy_room(room.to_dict()):
+            migrate_room(db, room.reference)
+            migrated += 1
+    return migrated
@@ -0,0 +1,141 @@
+import fcntl
+import json
+import os
+import threading
+import time
+import uuid
+
+
+class ScenarioPool:
+    # Keeps a stock of pre-generated market_data lists on local disk, one
+    # directory per round count, so start_game can hand one out instead of
+    # generating a game inline. Files are claimed with an atomic rename, so
+    # several worker processes can share the same directory; refills take a
+    # file lock so only one process generates for the pool at a time.
+    #
+    # Nothing is generated up front: a bucket is only refilled once this
+    # process has been asked for a game of that length, so an instance that
+    # boots doesn't spend the LLM rate limit on games nobody has asked for.
+    # Scenarios older than max_age are deleted and don't count as stock.
+
+    def __init__(self, directory, round_counts, target_size, generate, max_age=None, refill_interval=60):
+        self.directory = directory
+        self.round_counts = sorted(set(round_counts))
+        self.target_size = target_size
+        self.generate = generate
+        self.max_age = max_age
+        self.refill_interval = refill_interval
+        self._wake = threading.Event()
+        self._thread = None
+        self._wanted = set()  # Buckets take() has been asked for
+        for rounds in self.round_counts:
+            os.makedirs(self.bucket_dir(rounds), exist_ok=True)
+
+    def bucket_dir(self, rounds):
+        return os.path.join(self.directory, str(rounds))
+
+    def scenario_files(self, rounds):
+        bucket = self.bucket_dir(rounds)
+        if not os.path.isdir(bucket):
+            return []
+        return sorted(name for name in os.listdir(bucket) if name.endswith('.json'))
+
+    def is_expired(self, name):
+        # Files are named <created unix time>-<uuid>.json
+        if not self.max_age:
+            return False
+        try:
+            created_at = int(name.split('-', 1)[0])
+        except ValueError:
+            return False
+        return time.time() - created_at > self.max_age
+
+    def size(self, rounds):
+        return sum(1 for name in self.scenario_files(rounds) if not self.is_expired(name))
+
+    def prune(self, rounds):
+        bucket = self.bucket_dir(rounds)
+        for name in self.scenario_files(rounds):
+            if self.is_expired(name):
+                try:
+                    os.remove(os.path.join(bucket, name))
+                except OSError:
+                    pass  # Claimed or pruned by another worker
+
+    def put(self, rounds, market_data):
+        bucket = self.bucket_dir(rounds)
+        os.makedirs(bucket, exist_ok=True)
+        name = '%d-%s.json' % (int(time.time()), uuid.uuid4().hex)
+        tmp_path = os.path.join(bucket, name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'created_at': time.time(), 'market_data': market_data}, f)
+        os.replace(tmp_path, os.path.join(bucket, name))
+
+    def claim(self, rounds):
+        bucket = self.bucket_dir(rounds)
+        for name in self.scenario_files(rounds):
+            path = os.path.join(bucket, name)
+            claimed_path = '%s.claimed-%d' % (path, os.getpid())
+            try:
+                os.rename(path, claimed_path)
+            except OSError:
+                continue  # Another worker got it first
+            try:
+                with open(claimed_path) as f:
+                    scenario = json.load(f)
+            except (OSError, ValueError):
+                scenario = None
+            finally:
+                os.remove(claimed_path)
+            if scenario is None:
+                continue
+            if self.max_age and time.time() - scenario['created_at'] > self.max_age:
+                continue
+            return scenario['market_data']
+        return None
+
+    def take(self, rounds):
+        # Prefer an exact match, then cut down the smallest longer scenario.
+        # Returns None when nothing fits so the caller can generate inline.
+        candidates = [rounds] + [r for r in self.round_counts if r > rounds]
+        wanted = [r for r in candidates if r in self.round_counts]
+        if wanted:
+            self._wanted.add(wanted[0])
+        try:
+            for bucket_rounds in candidates:
+                market_data = self.claim(bucket_rounds)
+                if market_data is not None:
+                    return market_data[:rounds]
+            return None
+        finally:
+            self._wake.set()
+
+    def stats(self):
+        return {str(rounds): self.size(rounds) for rounds in self.round_counts}
+
+    def refill_once(self):
+        with open(os.path.join(self.directory, '.refill.lock'), 'w') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return  # Another worker is already refilling
+            for rounds in self.round_counts:
+                self.prune(rounds)
+                if rounds not in self._wanted:
+                    continue
+                while self.size(rounds) < self.target_size:
+                    self.put(rounds, self.generate(rounds))
+
+    def run(self):
+        while True:
+            try:
+                self.refill_once()
+            except Exception as e:
+                print('Scenario pool refill failed: %s' % e)
+            self._wake.wait(self.refill_interval)
+            self._wake.clear()
+
+    def start(self):
+        if self._thread is None and self.target_size > 0:
+            self._thread = threading.Thread(target=self.run, name='scenario-pool', daemon=True)
+            self._thread.start()
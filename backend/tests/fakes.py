@@ -0,0 +1,260 @@
+import copy
+import itertools
+import json
+import threading
+import time
+import types
+import uuid
+
+from google.cloud.firestore_v1 import transforms
+
+# In-memory stand-ins for the clients create_app() can be given in place of
+# Firestore, Firebase Auth and OpenAI. Each covers the calls the app makes
+# and nothing more; none of them touch the network. Room listeners aren't
+# supported, so apps using these need ROOM_CACHE_LISTEN=false.
+
+
+class FakeSnapshot:
+    def __init__(self, reference, data, update_time):
+        self.reference = reference
+        self.id = reference.id
+        self.update_time = update_time
+        self._data = data
+
+    @property
+    def exists(self):
+        return self._data is not None
+
+    def to_dict(self):
+        return copy.deepcopy(self._data)
+
+
+def apply_updates(data, updates, paths=True):
+    # The transforms the app uses, and dotted field paths for updates
+    for path, value in updates.items():
+        *parents, field = path.split('.') if paths else [path]
+        target = data
+        for parent in parents:
+            target = target.setdefault(parent, {})
+        if value is transforms.DELETE_FIELD:
+            target.pop(field, None)
+        elif value is transforms.SERVER_TIMESTAMP:
+            target[field] = 'server-timestamp'
+        elif isinstance(value, transforms.ArrayUnion):
+            values = target.setdefault(field, [])
+            values.extend(item for item in value.values if item not in values)
+        elif isinstance(value, transforms.Increment):
+            target[field] = target.get(field, 0) + value.value
+        else:
+            target[field] = copy.deepcopy(value)
+
+
+FILTERS = {
+    '==': lambda value, expected: value == expected,
+    '!=': lambda value, expected: value is not None and value != expected,
+    '>=': lambda value, expected: value is not None and value >= expected,
+}
+
+
+class FakeDocument:
+    def __init__(self, db, path):
+        self.db = db
+        self.path = path
+        self.id = path[-1]
+
+    def collection(self, name):
+        return FakeCollection(self.db, self.path + (name,))
+
+    def get(self, transaction=None):
+        return self.db.read(self)
+
+    def set(self, data, merge=False):
+        self.db.write(self, data, merge=merge)
+
+    def update(self, updates):
+        self.db.write(self, updates, update=True)
+
+    def create(self, data):
+        self.db.write(self, data, create=True)
+
+    def delete(self):
+        self.db.write(self, None)
+
+
+class FakeCollection:
+    def __init__(self, db, path, filters=()):
+        self.db = db
+        self.path = path
+        self.filters = filters
+
+    def document(self, document_id=None):
+        return FakeDocument(self.db, self.path + (document_id or uuid.uuid4().hex,))
+
+    def where(self, field, op, value):
+        return FakeCollection(self.db, self.path, self.filters + ((field, FILTERS[op], value),))
+
+    def stream(self, transaction=None):
+        return [snapshot for snapshot in self.db.list(self.path)
+                if all(check(snapshot.to_dict().get(field), value) for field, check, value in self.filters)]
+
+    get = stream
+
+
+class FakeBatch:
+    def __init__(self, db):
+        self.db = db
+        self._writes = []
+
+    def set(self, reference, data, merge=False):
+        self._writes.append(lambda: reference.set(data, merge=merge))
+
+    def update(self, reference, updates):
+        self._writes.append(lambda: reference.update(updates))
+
+    def create(self, reference, data):
+        self._writes.append(lambda: reference.create(data))
+
+    def delete(self, reference):
+        self._writes.append(reference.delete)
+
+    def commit(self):
+        with self.db.lock:
+            for write in self._writes:
+                write()
+        self._writes = []
+
+
+class FakeTransaction(FakeBatch):
+    # What firestore.transactional needs to run a function in it. The whole
+    # attempt holds the database lock, so transactions never conflict.
+
+    def __init__(self, db, max_attempts=5):
+        super().__init__(db)
+        self._max_attempts = max_attempts
+        self._read_only = False
+        self._id = None
+
+    def _clean_up(self):
+        self._writes = []
+        self._id = None
+
+    def _begin(self, retry_id=None):
+        self.db.lock.acquire()
+        self._id = uuid.uuid4().bytes
+
+    def _commit(self):
+        try:
+            self.commit()
+        finally:
+            self._id = None
+            self.db.lock.release()
+
+    def _rollback(self):
+        if self._id is not None:
+            self._clean_up()
+            self.db.lock.release()
+
+
+class FakeFirestore:
+    def __init__(self):
+        self.documents = {}  # path -> (data, update_time)
+        self.lock = threading.RLock()
+        self._clock = itertools.count(1)
+
+    def collection(self, name):
+        return FakeCollection(self, (name,))
+
+    def document(self, path):
+        return FakeDocument(self, tuple(path.split('/')))
+
+    def batch(self):
+        return FakeBatch(self)
+
+    def transaction(self, max_attempts=5, **kwargs):
+        return FakeTransaction(self, max_attempts)
+
+    def get_all(self, references, transaction=None):
+        return [self.read(reference) for reference in references]
+
+    def read(self, reference):
+        with self.lock:
+            data, update_time = self.documents.get(reference.path, (None, None))
+            return FakeSnapshot(reference, copy.deepcopy(data), update_time)
+
+    def list(self, path):
+        with self.lock:
+            return [FakeSnapshot(FakeDocument(self, key), copy.deepcopy(data), update_time)
+                    for key, (data, update_time) in sorted(self.documents.items())
+                    if len(key) == len(path) + 1 and key[:-1] == path]
+
+    def write(self, reference, data, merge=False, update=False, create=False):
+        with self.lock:
+            current = self.documents.get(reference.path, (None, None))[0]
+            if data is None:
+                self.documents.pop(reference.path, None)
+                return
+            if create and current is not None:
+                raise ValueError('Document already exists: %s' % '/'.join(reference.path))
+            if update and current is None:
+                raise ValueError('No document to update: %s' % '/'.join(reference.path))
+            document = copy.deepcopy(current) if (merge or update) and current is not None else {}
+            apply_updates(document, data, paths=update)
+            self.documents[reference.path] = (document, next(self._clock))
+
+
+class FakeAuth:
+    # Firebase Auth, where the idToken 'token-<uid>' signs in as <uid>
+
+    def UidIdentifier(self, uid):
+        return types.SimpleNamespace(uid=uid)
+
+    def verify_id_token(self, id_token, *args, **kwargs):
+        if not id_token or not id_token.startswith('token-'):
+            raise ValueError('Invalid token')
+        return {'uid': id_token[len('token-'):], 'exp': time.time() + 3600}
+
+    def get_user(self, uid):
+        return types.SimpleNamespace(uid=uid, display_name=uid, email='%s@example.com' % uid)
+
+    def get_users(self, identifiers):
+        return types.SimpleNamespace(users=[self.get_user(identifier.uid) for identifier in identifiers],
+                                     not_found=[])
+
+
+class FakeCompletions:
+    # Answers batch pricing by raising every price 5% and the news prompts
+    # with numbered headlines. Tests can patch answer() to reply with
+    # something else.
+    def __init__(self):
+        self.calls = 0
+
+    def answer(self, prompt_input):
+        if isinstance(prompt_input, dict) and 'assets' in prompt_input:
+            return {'prices': {asset['ticker']: round(asset['current_price'] * 1.05, 2)
+                               for asset in prompt_input['assets']}}
+        if isinstance(prompt_input, dict) and 'tickers' in prompt_input:
+            reply = {'companies': {ticker: ['%s headline %d' % (ticker, i) for i in range(3)]
+                                   for ticker in prompt_input['tickers']}}
+            if prompt_input.get('include_global'):
+                reply['global'] = ['Global headline %d' % i for i in range(3)]
+            return reply
+        return {'headlines': ['Headline %d' % i for i in range(3)]}
+
+    def create(self, messages=None, model=None, **kwargs):
+        self.calls += 1
+        try:
+            prompt_input = json.loads(messages[-1]['content'][0]['text']
+                                      if isinstance(messages[-1]['content'], list) else messages[-1]['content'])
+        except ValueError:
+            prompt_input = None
+        message = types.SimpleNamespace(content=json.dumps(self.answer(prompt_input)))
+        return types.SimpleNamespace(
+            choices=[types.SimpleNamespace(message=message, finish_reason='stop')],
+            usage=types.SimpleNamespace(prompt_tokens=100, completion_tokens=20, total_tokens=120),
+            model=model
+        )
+
+
+class FakeOpenAI:
+    def __init__(self):
+        self.chat = types.SimpleNamespace(completions=FakeCompletions())
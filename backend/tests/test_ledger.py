@@ -0,0 +1,76 @@
+import unittest
+
+import ledger
+import valuation
+from market_index import MarketIndex
+
+
+def rounds(*prices):
+    # One round per dict of ticker -> price
+    return [{'round_id': 'R%d' % i, 'stocks': [{'ticker': t, 'price': p} for t, p in round_prices.items()]}
+            for i, round_prices in enumerate(prices)]
+
+
+class LedgerTest(unittest.TestCase):
+    def test_netted_positions_value_like_per_trade_holdings(self):
+        holdings = [
+            {'ticker': 'AAPL', 'shares': 10, 'price': 100.0},
+            {'ticker': 'AAPL', 'shares': 5, 'price': 120.0},
+            {'ticker': 'AAPL', 'shares': -4, 'price': 110.0},
+        ]
+        positions = ledger.positions_from_holdings(holdings)
+        self.assertEqual(positions['AAPL'], {'long_shares': 15, 'long_cost': 1600.0,
+                                             'short_shares': 4, 'short_cost': 440.0})
+        # A short is worth (entry - price) * shares + entry * shares
+        per_trade = 15 * 90.0 + (110.0 - 90.0) * 4 + 110.0 * 4
+        self.assertAlmostEqual(ledger.position_value(positions['AAPL'], 90.0), per_trade)
+
+    def test_close_leg(self):
+        positions = {}
+        ledger.apply_trade(positions, 'MSFT', -5, 200.0)
+        self.assertIsNone(ledger.close_leg(positions, 'MSFT', ledger.LONG, 150.0))
+        self.assertAlmostEqual(ledger.close_leg(positions, 'MSFT', ledger.SHORT, 150.0), 2 * 1000.0 - 750.0)
+        self.assertEqual(positions, {})
+
+    def test_portfolio_view(self):
+        portfolio = {'cash': 10.0, 'positions': {}}
+        ledger.apply_trade(portfolio['positions'], 'TSLA', 2, 50.0)
+        ledger.apply_trade(portfolio['positions'], 'TSLA', -1, 60.0)
+        self.assertEqual(ledger.portfolio_view(portfolio), {'cash': 10.0, 'holdings': [
+            {'id': 'TSLA:long', 'ticker': 'TSLA', 'price': 50.0, 'shares': 2},
+            {'id': 'TSLA:short', 'ticker': 'TSLA', 'price': 60.0, 'shares': -1},
+        ]})
+
+
+class ValuationTest(unittest.TestCase):
+    def test_mark_to_market_matches_ledger(self):
+        market_index = MarketIndex.from_rounds(rounds({'AAPL': 100.0, 'MSFT': 50.0}, {'AAPL': 80.0, 'MSFT': 70.0}))
+        portfolios = [{'cash': 1000.0, 'positions': {}}, {'cash': 500.0, 'positions': {}}]
+        ledger.apply_trade(portfolios[0]['positions'], 'AAPL', 3, 100.0)
+        ledger.apply_trade(portfolios[1]['positions'], 'MSFT', -2, 50.0)
+
+        values = valuation.mark_to_market(market_index, portfolios)
+        for i, portfolio in enumerate(portfolios):
+            for r, round_id in enumerate(market_index.round_ids):
+                expected = portfolio['cash'] + sum(
+                    ledger.position_value(position, market_index.price(round_id, ticker))
+                    for ticker, position in portfolio['positions'].items())
+                self.assertAlmostEqual(values[i, r], expected)
+
+    def test_unlisted_ticker_is_left_out(self):
+        market_index = MarketIndex.from_rounds(rounds({'AAPL': 100.0}, {'AAPL': 100.0, 'NEW': 10.0}))
+        portfolio = {'cash': 0.0, 'positions': {}}
+        ledger.apply_trade(portfolio['positions'], 'NEW', -1, 10.0)
+        self.assertEqual(valuation.mark_to_market(market_index, [portfolio]).tolist(), [[0.0, 10.0]])
+
+    def test_performance(self):
+        values = valuation.history_matrix([[110.0, 99.0], [90.0]], 3, [95.0, 120.0])
+        self.assertEqual(values[1, 1], 120.0)
+        result = valuation.performance(values, 100.0)
+        self.assertEqual(result['rank'][:, :2].tolist(), [[1.0, 2.0], [2.0, 1.0]])
+        self.assertAlmostEqual(result['total_return'][0], -0.01)
+        self.assertAlmostEqual(result['max_drawdown'][0], 99.0 / 110.0 - 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
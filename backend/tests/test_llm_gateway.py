@@ -0,0 +1,42 @@
+import unittest
+
+from llm_gateway import TokenBucket
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+class TokenBucketTest(unittest.TestCase):
+    def setUp(self):
+        self.clock = Clock()
+        self.bucket = TokenBucket(60, clock=self.clock)  # One a second, up to 60
+
+    def test_reserve_waits_in_order(self):
+        self.assertEqual(self.bucket.reserve(60), 0.0)
+        self.assertAlmostEqual(self.bucket.reserve(2), 2.0)
+        self.assertAlmostEqual(self.bucket.reserve(3), 5.0)
+        self.clock.now = 5.0
+        self.assertAlmostEqual(self.bucket.reserve(1), 1.0)
+
+    def test_try_reserve_and_refund(self):
+        self.assertTrue(self.bucket.try_reserve(50))
+        self.assertFalse(self.bucket.try_reserve(20))
+        self.bucket.refund(30)
+        self.assertTrue(self.bucket.try_reserve(20))
+        self.clock.now = 1000.0
+        self.assertTrue(self.bucket.try_reserve(60))
+        self.assertFalse(self.bucket.try_reserve(1))
+
+    def test_requests_larger_than_capacity(self):
+        # Capped at a minute's worth so a huge request can still go out
+        self.assertEqual(self.bucket.reserve(500), 0.0)
+        self.assertAlmostEqual(self.bucket.reserve(1), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,40 @@
+import unittest
+
+from market_index import MarketIndex
+
+
+class MarketIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.market_index = MarketIndex.from_rounds([
+            {'round_id': 'A', 'stocks': [{'ticker': 'AAPL', 'price': 100.0}]},
+            {'round_id': 'B', 'stocks': [{'ticker': 'AAPL', 'price': 110.0}, {'ticker': 'MSFT', 'price': 50.0}]},
+        ])
+
+    def test_lookups(self):
+        self.assertEqual(self.market_index.price('B', 'AAPL'), 110.0)
+        self.assertIsNone(self.market_index.price('A', 'MSFT'))
+        self.assertIsNone(self.market_index.price('C', 'AAPL'))
+        self.assertEqual(self.market_index.previous_price('B', 'AAPL'), 100.0)
+        self.assertEqual(self.market_index.previous_price('B', 'MSFT'), 50.0)
+        self.assertEqual(self.market_index.next_round_id('A'), 'B')
+        self.assertIsNone(self.market_index.next_round_id('B'))
+
+    def test_document_round_trip(self):
+        document = self.market_index.to_document()
+        self.assertEqual(document, {'tickers': ['AAPL', 'MSFT'], 'prices': [100.0, None, 110.0, 50.0]})
+        restored = MarketIndex.from_document(['A', 'B'], document)
+        self.assertEqual(restored.price('B', 'MSFT'), 50.0)
+        self.assertIsNone(restored.price('A', 'MSFT'))
+
+    def test_with_round(self):
+        extended = self.market_index.with_round(
+            {'round_id': 'C', 'stocks': [{'ticker': 'MSFT', 'price': 55.0}, {'ticker': 'TSLA', 'price': 20.0}]})
+        self.assertEqual(extended.round_ids, ['A', 'B', 'C'])
+        self.assertEqual(extended.price('C', 'TSLA'), 20.0)
+        self.assertIsNone(extended.price('B', 'TSLA'))
+        self.assertIsNone(extended.price('C', 'AAPL'))
+        self.assertEqual(self.market_index.round_ids, ['A', 'B'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,42 @@
+import contextlib
+import io
+import unittest
+from unittest import mock
+
+from google.cloud.firestore_v1 import _helpers
+
+import metrics
+import profiling
+
+
+class InstrumentDecodingTest(unittest.TestCase):
+    def test_times_the_outermost_decode(self):
+        calls = []
+
+        def decode_dict(value_fields, client):
+            calls.append(value_fields)
+            return {}
+
+        with mock.patch.object(_helpers, 'decode_dict', decode_dict):
+            metrics.instrument_decoding()
+            metrics.instrument_decoding()  # Wrapping twice is a no-op
+            profile = profiling.Profile('sample', 'GET', '/', '/')
+            token = profiling.current_profile.set(profile)
+            try:
+                self.assertEqual(_helpers.decode_dict({'a': 1}, None), {})
+            finally:
+                profiling.current_profile.reset(token)
+        self.assertEqual(calls, [{'a': 1}])
+        self.assertIn('firestore_decode', profile.phases)
+
+    def test_missing_decode_dict_only_warns(self):
+        output = io.StringIO()
+        with mock.patch.object(_helpers, 'decode_dict', None), contextlib.redirect_stdout(output):
+            delattr(_helpers, 'decode_dict')
+            metrics.instrument_decoding()
+            self.assertFalse(hasattr(_helpers, 'decode_dict'))
+        self.assertIn('will not be profiled', output.getvalue())
+
+
+if __name__ == '__main__':
+    unittest.main()
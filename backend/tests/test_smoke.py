@@ -0,0 +1,210 @@
+import os
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+# main reads its settings when it's imported
+SCRATCH_DIR = tempfile.mkdtemp()
+os.environ.update({
+    'ROOM_CACHE_LISTEN': 'false',
+    'SCENARIO_POOL_SIZE': '0',
+    'SCENARIO_POOL_DIR': os.path.join(SCRATCH_DIR, 'scenarios'),
+    'QUOTE_SNAPSHOT_PATH': os.path.join(SCRATCH_DIR, 'quotes.json'),
+    'LLM_CACHE_BACKEND': 'memory',
+    'METRICS_DIR': '',
+    'PROFILE_DIR': os.path.join(SCRATCH_DIR, 'profiles'),
+    'ADMIN_TOKEN': 'admin-secret',
+})
+
+import main
+from fakes import FakeAuth, FakeFirestore, FakeOpenAI
+
+QUOTES = {ticker: 100.0 + 10 * i for i, ticker in enumerate(main.TOP_STOCK_TICKERS)}
+
+
+class SmokeTest(unittest.TestCase):
+    # A game played through the API against in-memory Firestore, Firebase
+    # Auth and OpenAI: create, join, start, trade and complete a round
+
+    @classmethod
+    def setUpClass(cls):
+        main.quote_cache.fetch = lambda tickers: {ticker: QUOTES[ticker] for ticker in tickers}
+        cls.db = FakeFirestore()
+        cls.openai = FakeOpenAI()
+        cls.app = main.create_app(start_background_jobs=False, db=cls.db, firebase_auth=FakeAuth(),
+                                  openai_client=cls.openai)
+        cls.client = cls.app.test_client()
+
+    def post(self, path, uid, **data):
+        response = self.client.post(path, json=dict(data, idToken='token-' + uid))
+        return response.status_code, response.get_json()
+
+    def start_game(self, game_code, rounds=3, price_model='local'):
+        status, _ = self.post('/create_room', 'alice', gameCode=game_code, rounds=rounds, timePerRound=60,
+                              difficulty='easy', priceModel=price_model)
+        self.assertEqual(status, 200)
+        status, _ = self.post('/join_room', 'bob', gameCode=game_code)
+        self.assertEqual(status, 200)
+        status, body = self.post('/start_game', 'alice', gameCode=game_code)
+        self.assertEqual(status, 202, body)
+
+        deadline = time.time() + 30
+        while time.time() < deadline:
+            game = self.client.get('/check_game_status?gameCode=' + game_code).get_json()
+            if game['started']:
+                return game['roundCode']
+            self.assertNotEqual(game['job']['status'], 'failed', game)
+            time.sleep(0.05)
+        self.fail('Game %s did not start' % game_code)
+
+    def test_join_trade_complete_round(self):
+        round_code = self.start_game('SMOKE1')
+        room = main.room_cache.get_room_data('SMOKE1', fresh=True)
+        self.assertEqual(len(room['round_ids']), 3)
+        self.assertEqual(room['round_ids'][0], round_code)
+        ticker = main.TOP_STOCK_TICKERS[0]
+        price = main.room_cache.get_market_index('SMOKE1', room).price(round_code, ticker)
+
+        status, body = self.post('/transact', 'alice', gameCode='SMOKE1', roundCode=round_code, roundIndex=0,
+                                 ticker=ticker, operation='buy', amount=10)
+        self.assertEqual(status, 200, body)
+        self.assertAlmostEqual(body['portfolio']['cash'], main.STARTING_CASH - 10 * price)
+        self.assertEqual([(h['ticker'], h['shares']) for h in body['portfolio']['holdings']], [(ticker, 10)])
+
+        status, body = self.post('/transact', 'bob', gameCode='SMOKE1', roundCode=round_code, roundIndex=0,
+                                 ticker=ticker, operation='buy', amount=10 ** 6)
+        self.assertEqual(status, 400, body)
+
+        for uid in ('alice', 'bob'):
+            status, body = self.post('/complete_round', uid, gameCode='SMOKE1', roundCode=round_code)
+            self.assertEqual(status, 200, body)
+        history = main.room_cache.get_portfolios('SMOKE1')['alice']['value_history']
+        self.assertEqual(len(history), 2)
+
+        # Completing the same round again, e.g. a retried request, records nothing
+        status, body = self.post('/complete_round', 'alice', gameCode='SMOKE1', roundCode=round_code)
+        self.assertEqual(status, 200, body)
+        self.assertEqual(main.room_cache.get_portfolios('SMOKE1')['alice']['value_history'], history)
+
+        status, body = self.post('/check_round_completion', 'alice', gameCode='SMOKE1', roundCode=round_code)
+        self.assertEqual(status, 200)
+        self.assertEqual(body, {'allUsersCompleted': True, 'newRoundCode': room['round_ids'][1]})
+
+        leaderboard = self.client.get('/leaderboard?gameCode=SMOKE1').get_json()['leaderboard']
+        self.assertEqual(sorted(entry['name'] for entry in leaderboard), ['alice', 'bob'])
+
+    def test_llm_priced_game(self):
+        # Priced through the gateway and the LLM cache, with the rounds after
+        # the first generated as the game goes on
+        round_code = self.start_game('SMOKE5', price_model='llm')
+        room = main.room_cache.get_room_data('SMOKE5', fresh=True)
+        self.assertEqual(room['roundGeneration'], 'progressive')
+        self.assertLess(len(room['round_ids']), 3)
+        for uid in ('alice', 'bob'):
+            status, body = self.post('/complete_round', uid, gameCode='SMOKE5', roundCode=round_code)
+            self.assertEqual(status, 200, body)
+
+        deadline = time.time() + 30
+        while len(room['round_ids']) < 3 and time.time() < deadline:
+            time.sleep(0.05)
+            room = main.room_cache.get_room_data('SMOKE5', fresh=True)
+        self.assertEqual(len(room['round_ids']), 3)
+
+        market_index = main.room_cache.get_market_index('SMOKE5', room)
+        for previous, current in zip(room['round_ids'], room['round_ids'][1:]):
+            for ticker in main.TOP_STOCK_TICKERS:
+                self.assertAlmostEqual(market_index.price(current, ticker),
+                                       round(market_index.price(previous, ticker) * 1.05, 2))
+        gateway = main.llm_gateway.stats()['prompts']
+        self.assertGreaterEqual(gateway['stock_prices_batch']['completed'], 2)
+        self.assertGreaterEqual(main.llm_cache.stats()['entries'], 2)
+
+    def test_round_is_valued_at_its_own_prices(self):
+        round_code = self.start_game('SMOKE3')
+        room = main.room_cache.get_room_data('SMOKE3', fresh=True)
+        market_index = main.room_cache.get_market_index('SMOKE3', room)
+        ticker = main.TOP_STOCK_TICKERS[0]
+        # Later rounds' prices must not leak into the value of this one
+        self.assertNotEqual(market_index.price(round_code, ticker), market_index.price(room['round_ids'][-1], ticker))
+
+        status, body = self.post('/transact', 'alice', gameCode='SMOKE3', roundCode=round_code, roundIndex=0,
+                                 ticker=ticker, operation='buy', amount=10)
+        self.assertEqual(status, 200, body)
+        status, _ = self.post('/complete_round', 'alice', gameCode='SMOKE3', roundCode=round_code)
+        self.assertEqual(status, 200)
+
+        portfolio = main.room_cache.get_portfolios('SMOKE3')['alice']
+        self.assertAlmostEqual(portfolio['value_history'][-1],
+                               body['portfolio']['cash'] + 10 * market_index.price(round_code, ticker))
+
+        # Bob hasn't completed it, so it's still the round in play on the leaderboard
+        leaderboard = self.client.get('/leaderboard?gameCode=SMOKE3').get_json()['leaderboard']
+        values = {entry['name']: entry['value'] for entry in leaderboard}
+        self.assertAlmostEqual(values['alice'], portfolio['value_history'][-1])
+
+    def test_final_standings_include_the_last_round(self):
+        self.start_game('SMOKE4', rounds=2)
+        room = main.room_cache.get_room_data('SMOKE4', fresh=True)
+        ticker = main.TOP_STOCK_TICKERS[1]
+        status, body = self.post('/transact', 'alice', gameCode='SMOKE4', roundCode=room['round_ids'][0],
+                                 roundIndex=0, ticker=ticker, operation='buy', amount=20)
+        self.assertEqual(status, 200, body)
+        for round_code in room['round_ids']:
+            for uid in ('alice', 'bob'):
+                status, body = self.post('/complete_round', uid, gameCode='SMOKE4', roundCode=round_code)
+                self.assertEqual(status, 200, body)
+
+        portfolios = main.room_cache.get_portfolios('SMOKE4')
+        final_value = portfolios['alice']['value_history'][-1]
+        self.assertEqual(len(portfolios['alice']['value_history']), 3)
+
+        body = self.client.get('/leaderboard?gameCode=SMOKE4').get_json()
+        self.assertEqual(len(body['history']), 3)
+        self.assertAlmostEqual(body['history'][-1]['alice'], final_value)
+        entries = {entry['name']: entry for entry in body['leaderboard']}
+        self.assertAlmostEqual(entries['alice']['value'], final_value)
+        self.assertAlmostEqual(entries['alice']['return'], final_value / main.STARTING_CASH - 1)
+        self.assertEqual(entries['bob']['return'], 0.0)
+        self.assertEqual(entries['bob']['maxDrawdown'], 0.0)
+        self.assertEqual(sorted(entry['rank'] for entry in entries.values()), [1, 2])
+
+    def test_prompts_default_to_version_1(self):
+        response = self.client.get('/llm_stats', headers={'X-Admin-Token': 'admin-secret'})
+        self.assertEqual(response.get_json()['promptVersions'], {name: 1 for name in main.prompts.PROMPTS})
+
+    def test_unusable_price_replies_are_not_cached(self):
+        stocks = [{'ticker': 'AAPL', 'price': 123.45, 'news': ['Unusable'] * 3},
+                  {'ticker': 'MSFT', 'price': 234.56, 'news': ['Unusable'] * 3}]
+        completions = self.openai.chat.completions
+        before = main.llm_cache.stats()
+        with mock.patch.object(completions, 'answer', return_value={'headlines': ['Not a price']}):
+            self.assertEqual(main.predict_next_prices(stocks), {})
+        after = main.llm_cache.stats()
+
+        # Every retry asked the model again, and nothing was cached
+        batch = after['prompts']['stock_prices_batch']
+        self.assertEqual(batch['misses'] - before['prompts'].get('stock_prices_batch', {}).get('misses', 0),
+                         1 + main.PRICING_BATCH_RETRIES)
+        self.assertEqual(batch['hits'], before['prompts'].get('stock_prices_batch', {}).get('hits', 0))
+        self.assertEqual(after['entries'], before['entries'])
+
+    def test_operational_routes_need_the_admin_token(self):
+        for path in ('/metrics', '/llm_stats', '/room_cache_stats', '/auth_stats', '/profiles'):
+            self.assertEqual(self.client.get(path).status_code, 403, path)
+            self.assertEqual(self.client.get(path, headers={'X-Admin-Token': 'wrong'}).status_code, 403, path)
+            self.assertEqual(self.client.get(path, headers={'X-Admin-Token': 'admin-secret'}).status_code, 200, path)
+        response = self.client.get('/metrics', headers={'Authorization': 'Bearer admin-secret'})
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('http_requests_total', response.get_data(as_text=True))
+
+    def test_requires_a_valid_token(self):
+        round_code = self.start_game('SMOKE2', rounds=1)
+        status, _ = self.post('/complete_round', 'mallory', gameCode='SMOKE2', roundCode=round_code)
+        self.assertEqual(status, 403)
+        response = self.client.post('/join_room', json={'gameCode': 'SMOKE2', 'idToken': 'forged'})
+        self.assertEqual(response.status_code, 401)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+import numpy as np
+
+import ledger
+
+# Vectorized valuation for every player in a game at once. Positions are
+# laid out as players x tickers matrices over the MarketIndex columns, so
+# marking every player at every round is one matrix product against the
+# rounds x tickers price matrix.
+
+
+def position_matrices(market_index, portfolios):
+    # portfolios is a list of portfolio dicts. Returns each player's cash and
+    # their net shares and short cost per ticker column; tickers the game
+    # doesn't list are left out, as they have no price to mark against.
+    players, tickers = len(portfolios), len(market_index.tickers)
+    cash = np.zeros(players)
+    net_shares = np.zeros((players, tickers))
+    short_cost = np.zeros((players, tickers))
+    for i, portfolio in enumerate(portfolios):
+        cash[i] = portfolio.get('cash', 0.0)
+        for ticker, position in ledger.get_positions(portfolio).items():
+            j = market_index.ticker_column.get(ticker)
+            if j is not None:
+                net_shares[i, j] = position['long_shares'] - position['short_shares']
+                short_cost[i, j] = position['short_cost']
+    return cash, net_shares, short_cost
+
+
+def mark_to_market(market_index, portfolios, round_ids=None):
+    # Value of each player's current positions at each round's prices, as a
+    # players x rounds array (every round of the game unless round_ids is
+    # given). A ticker without a price in a round is left out of that
+    # round's value, short leg included.
+    rows = list(range(len(market_index.round_ids))) if round_ids is None else [
+        market_index.round_index[round_id] for round_id in round_ids
+    ]
+    prices = market_index.prices[rows]
+    listed = ~np.isnan(prices)
+
+    cash, net_shares, short_cost = position_matrices(market_index, portfolios)
+    # A long is worth price * shares and a short 2 * cost - price * shares
+    return cash[:, None] + net_shares @ np.where(listed, prices, 0.0).T + 2 * short_cost @ listed.T
+
+
+def history_matrix(value_histories, columns, live_values):
+    # Recorded value_history lists (the starting value, then one per round
+    # completed) as a players x columns array. Players who are behind the
+    # furthest player get their live value (what completing now would
+    # record) for the columns they haven't reached yet; later columns stay
+    # NaN. Every player has at least the first column.
+    values = np.full((len(value_histories), columns), np.nan)
+    current = min(max([len(history) for history in value_histories] + [1]), columns)
+    for i, history in enumerate(value_histories):
+        recorded = history[:columns]
+        values[i, :len(recorded)] = recorded
+        values[i, len(recorded):current] = live_values[i]
+    return values
+
+
+def performance(values, initial_value):
+    # values is players x columns, NaN where a player has no value yet.
+    # Returns per-round returns, drawdown from the running peak and rank
+    # (1 is best, ties share a rank), plus each player's total return and
+    # worst drawdown.
+    previous = np.concatenate([np.full((values.shape[0], 1), initial_value), values[:, :-1]], axis=1)
+    with np.errstate(invalid='ignore', divide='ignore'):
+        returns = values / previous - 1
+        peaks = np.fmax.accumulate(np.where(np.isnan(values), -np.inf, values), axis=1)
+        drawdown = values / peaks - 1
+
+    # Count of players strictly ahead in each round; NaN never compares greater
+    ahead = (values[None, :, :] > values[:, None, :]).sum(axis=1)
+    rank = np.where(np.isnan(values), np.nan, ahead + 1)
+
+    latest = np.array([row[~np.isnan(row)][-1] if (~np.isnan(row)).any() else np.nan for row in values])
+    return {
+        'returns': returns,
+        'drawdown': drawdown,
+        'rank': rank,
+        'total_return': latest / initial_value - 1,
+        'max_drawdown': np.where(np.isnan(drawdown), 0.0, drawdown).min(axis=1, initial=0.0)
+    }
@@ -282,7 +282,7 @@ function Portfolio({ game_code, round_code }) {
   
         if (checkResponse.ok) {
           const checkData = await checkResponse.json();
-          if (checkData.allUsersCompleted) {
+          if (checkData.allUsersCompleted && !checkData.pending) {
             clearInterval(checkCompletionInterval);
             if (checkData.newRoundCode && checkData.newRoundCode !== round_code && checkData.newRoundCode !== 'null' && checkData.newRoundCode !== '') {
               router.push(`/${game_code}/${checkData.newRoundCode}/portfolio`);
@@ -22,12 +22,18 @@ async function checkRoundCompletion(game_code, round_code, router) {
 
   if (response.ok) {
     const data = await response.json();
-    if (data.allUsersCompleted) {
-      if (data.newRoundCode && data.newRoundCode !== round_code && data.newRoundCode !== 'null' && data.newRoundCode !== '') {
-        router.push(`/${game_code}/${data.newRoundCode}/portfolio`);
-      } else {
-        router.push(`/${game_code}/game_concluded`);
-      }
+    goToNextRound(game_code, round_code, data, router);
+  }
+}
+
+function goToNextRound(game_code, round_code, data, router) {
+  // pending means the next round is still being generated; round_ended is
+  // sent again once it's ready
+  if (data.allUsersCompleted && !data.pending) {
+    if (data.newRoundCode && data.newRoundCode !== round_code && data.newRoundCode !== 'null' && data.newRoundCode !== '') {
+      router.push(`/${game_code}/${data.newRoundCode}/portfolio`);
+    } else {
+      router.push(`/${game_code}/game_concluded`);
     }
   }
 }
@@ -60,9 +66,26 @@ function WaitComponent({ game_code, round_code, roundDuration = 120 }) {
       checkRoundCompletion(game_code, round_code, router)
     }, 10000) // Check every 10 seconds
 
+    // Where the backend streams room events (ROOM_EVENTS_ENABLED), round_ended
+    // arrives as soon as the last player finishes. Polling keeps going in case
+    // the stream is refused or drops.
+    let events = null
+    if (process.env.NEXT_PUBLIC_ROOM_EVENTS === 'true') {
+      events = new EventSource(`https://finsimulator.uc.r.appspot.com/room_events?gameCode=${game_code}`)
+      events.addEventListener('round_ended', (event) => {
+        const data = JSON.parse(event.data)
+        if (data.roundCode === round_code) {
+          goToNextRound(game_code, round_code, data, router)
+        }
+      })
+    }
+
     return () => {
       clearInterval(timer)
       clearInterval(checkCompletionInterval)
+      if (events) {
+        events.close()
+      }
     }
   }, [roundDuration, router, game_code, round_code])
 
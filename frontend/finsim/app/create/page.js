@@ -118,21 +118,29 @@ export default function Create() {
                 gameCode,
                 idToken
             });
-            console.log('Game started:', response.data);
-            // Wait a second and check game status
-            setTimeout(async () => {
+            console.log('Game starting:', response.data);
+            // Rounds are generated in the background; poll until the game
+            // has started or the start job fails
+            const poll = async () => {
                 try {
                     const statusResponse = await axios.get(`https://finsimulator.uc.r.appspot.com/check_game_status?gameCode=${gameCode}`);
                     if (statusResponse.data.started) {
                         router.push(`/${statusResponse.data.gameCode}/${statusResponse.data.roundCode}/news`);
+                        return;
+                    }
+                    if (statusResponse.data.job && statusResponse.data.job.status === 'failed') {
+                        console.error('Error starting game:', statusResponse.data.job.error);
+                        setLoading(false);
+                        return;
                     }
                 } catch (error) {
                     console.error('Error checking game status:', error);
                 }
-            }, 1000);
+                setTimeout(poll, 2000);
+            };
+            setTimeout(poll, 1000);
         } catch (error) {
             console.error('Error starting game:', error);
-        } finally {
             setLoading(false);
         }
     };